@@ -0,0 +1,85 @@
+"""
+Maintenance of the Conversation activity columns (last_message,
+last_message_at, message_count) and of each participant's read state
+(last_read_message, last_read_at, unread_count).
+
+Each change is a single UPDATE per table computed by the database, so
+concurrent writers can't lose counts or move last_message backwards.
+chats.signals calls these for single saves and deletes; code
+that bypasses signals (bulk_create) must call them itself.
+"""
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import Conversation, ConversationParticipant, Message
+
+
+def record_new_messages(conversation_id, last_message, count=1):
+    """Add `count` messages to the conversation, `last_message` being the newest of them"""
+    newer = Q(last_message_at__isnull=True) | Q(last_message_at__lte=last_message.sent_at)
+    Conversation.objects.filter(pk=conversation_id).update(
+        message_count=F('message_count') + count,
+        last_message_at=Case(When(newer, then=Value(last_message.sent_at)), default=F('last_message_at')),
+        last_message=Case(When(newer, then=Value(last_message.pk)), default=F('last_message')),
+    )
+
+    # The messages are unread for everyone else; the sender has read up to them
+    is_sender = Q(user=last_message.sender_id_id)
+    ConversationParticipant.objects.filter(conversation_id=conversation_id).update(
+        unread_count=Case(When(is_sender, then=Value(0)), default=F('unread_count') + count),
+        last_read_at=Case(When(is_sender, then=Value(last_message.sent_at)), default=F('last_read_at')),
+        last_read_message=Case(When(is_sender, then=Value(last_message.pk)), default=F('last_read_message')),
+    )
+
+
+def record_message_deleted(message):
+    """
+    Take a deleted message off its conversation. If it was the last message
+    (the FK may already have been nulled by on_delete) the newest remaining
+    one takes its place.
+    """
+    latest = Message.objects.filter(conversation=OuterRef('pk')).order_by('-sent_at', '-message_id')
+    was_last = Q(last_message__isnull=True) | Q(last_message=message.pk)
+    Conversation.objects.filter(pk=message.conversation_id).update(
+        message_count=Case(When(message_count__gt=0, then=F('message_count') - 1), default=Value(0)),
+        last_message_at=Case(
+            When(was_last, then=Subquery(latest.values('sent_at')[:1])), default=F('last_message_at')
+        ),
+        last_message=Case(
+            When(was_last, then=Subquery(latest.values('pk')[:1])), default=F('last_message')
+        ),
+    )
+
+    # Participants who hadn't read it yet have one unread message less
+    ConversationParticipant.objects.filter(
+        Q(last_read_at__isnull=True) | Q(last_read_at__lt=message.sent_at),
+        conversation_id=message.conversation_id,
+        unread_count__gt=0,
+    ).exclude(user=message.sender_id_id).update(unread_count=F('unread_count') - 1)
+
+
+def mark_read(conversation_id, user_id, message=None):
+    """
+    Move the user's read cursor forward to `message` (never backwards) and
+    recount the messages from others sent after it. Without a message, as
+    in an empty conversation, only the unread count is cleared.
+    Returns the participant's read state as a dict.
+    """
+    participant = ConversationParticipant.objects.filter(conversation_id=conversation_id, user_id=user_id)
+    if message is None:
+        participant.update(unread_count=0)
+    else:
+        unread = (
+            Message.objects.filter(conversation_id=conversation_id, sent_at__gt=message.sent_at)
+            .exclude(sender_id=user_id)
+            .order_by()
+            .values('conversation')
+            .annotate(total=Count('pk'))
+            .values('total')
+        )
+        participant.filter(Q(last_read_at__isnull=True) | Q(last_read_at__lte=message.sent_at)).update(
+            last_read_message=message.pk,
+            last_read_at=message.sent_at,
+            unread_count=Coalesce(Subquery(unread), 0),
+        )
+    return participant.values('last_read_message', 'last_read_at', 'unread_count').get()
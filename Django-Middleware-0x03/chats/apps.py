@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ChatsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chats'
+
+    def ready(self):
+        # Import signals when app is ready
+        import chats.signals  # noqa
+        import chats.checks  # noqa
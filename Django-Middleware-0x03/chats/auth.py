@@ -1,8 +1,119 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework.exceptions import APIException, AuthenticationFailed
+
+from .caching import get_shared_cache_alias, is_shared_cache
+from .models import CustomUser
+
+# User fields copied into every issued token; together with the user id
+# they are enough to serve a request without loading the user row.
+TOKEN_USER_CLAIMS = ('username', 'first_name', 'last_name', 'email', 'role', 'is_active')
+
+
+def add_user_claims(token, user):
+    """Embed the TOKEN_USER_CLAIMS of `user` into a (refresh) token"""
+    for claim in TOKEN_USER_CLAIMS:
+        token[claim] = getattr(user, claim)
+    return token
+
+
+def token_revocation_key(user_id):
+    return f"chats:tokens-revoked:{user_id}"
+
+
+def get_revocation_cache():
+    """
+    The cache holding revocation markers (CHATS_TOKEN_REVOCATION_CACHE), or
+    None when it isn't shared by all workers. A marker written by one worker
+    must stop every worker from trusting the claims, so without a shared
+    cache token claims are never trusted (see chats.caching).
+    """
+    alias = get_shared_cache_alias('CHATS_TOKEN_REVOCATION_CACHE')
+    if alias is None or not is_shared_cache(alias):
+        return None
+    return caches[alias]
+
+
+def revoke_user_claims(user_id):
+    """
+    Mark claims in tokens issued to the user up to now as stale.
+
+    Stale tokens fall back to a database lookup, which rejects inactive
+    users. The marker only has to outlive the tokens it covers, so it
+    expires with the access token lifetime.
+    """
+    cache = get_revocation_cache()
+    if cache is None:
+        return
+    timeout = int(api_settings.ACCESS_TOKEN_LIFETIME.total_seconds())
+    cache.set(token_revocation_key(user_id), int(time.time()), timeout)
+
+
+def get_token_user(validated_token):
+    """
+    Build a CustomUser from the token claims without touching the database.
+
+    Returns None when the token predates the claims or has been revoked,
+    or when there is no shared revocation cache to check that against.
+    Fields not carried by the token are deferred and load lazily if used.
+    """
+    cache = get_revocation_cache()
+    if cache is None:
+        return None
+
+    try:
+        claims = {claim: validated_token[claim] for claim in TOKEN_USER_CLAIMS}
+        user_id = validated_token[api_settings.USER_ID_CLAIM]
+    except KeyError:
+        return None
+
+    revoked_at = cache.get(token_revocation_key(user_id))
+    if revoked_at is not None and validated_token.get('iat', 0) <= revoked_at:
+        return None
+
+    id_field = CustomUser._meta.get_field(api_settings.USER_ID_FIELD)
+    claims[id_field.attname] = id_field.to_python(user_id)
+
+    # from_db expects values in concrete field order
+    fields = [f.attname for f in CustomUser._meta.concrete_fields if f.attname in claims]
+    return CustomUser.from_db(DEFAULT_DB_ALIAS, fields, [claims[name] for name in fields])
+
+
+def authenticate_request(request):
+    """
+    Run CustomJWTAuthentication once per request and remember the outcome.
+
+    Accepts a Django HttpRequest or a DRF Request. Middleware and the DRF
+    authentication class all go through here, so the token is decoded and
+    the user resolved a single time; a failure is remembered too and
+    re-raised to every caller.
+    """
+    request = getattr(request, '_request', request)
+    if not hasattr(request, '_jwt_auth_result'):
+        try:
+            request._jwt_auth_result = (jwt_authenticator.authenticate_token(request), None)
+        except APIException as exc:
+            request._jwt_auth_result = (None, exc)
+
+    user_auth_tuple, error = request._jwt_auth_result
+    if error is not None:
+        raise error
+    return user_auth_tuple
+
 
 class CustomJWTAuthentication(JWTAuthentication):
     def authenticate(self, request):
+        """
+        Reuse the result of the shared per-request authentication pass.
+        """
+        return authenticate_request(request)
+
+    def authenticate_token(self, request):
         """
         Overrides default JWT authentication to add extra checks, e.g. user active status.
         """
@@ -18,4 +129,19 @@ class CustomJWTAuthentication(JWTAuthentication):
 
         # Add other custom checks here if needed
 
-        return (user, token)
\ No newline at end of file
+        return (user, token)
+
+    def get_user(self, validated_token):
+        """
+        With CHATS_STATELESS_JWT enabled, resolve the user from token claims
+        and skip the per-request user query; otherwise load it as usual.
+        """
+        if getattr(settings, 'CHATS_STATELESS_JWT', False):
+            user = get_token_user(validated_token)
+            if user is not None:
+                return user
+        return super().get_user(validated_token)
+
+
+# Shared, stateless instance used by authenticate_request
+jwt_authenticator = CustomJWTAuthentication()
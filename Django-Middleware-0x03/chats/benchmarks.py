@@ -0,0 +1,285 @@
+"""
+Micro-benchmarks for the chats app, run with ``python manage.py benchmark``.
+
+Every benchmark is a function registered with @benchmark that takes the
+number of iterations and returns (label, seconds per call, queries per call)
+rows. The command runs them against a throwaway test database.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.db import connection
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .auth import add_user_claims, authenticate_request, jwt_authenticator
+from .middleware import (
+    JWTAuthenticationMiddleware, OffensiveLanguageMiddleware, RequestLoggingMiddleware,
+    RestrictAccessByTimeMiddleware, RolepermissionMiddleware,
+)
+from .models import Conversation, CustomUser, Message
+from .renderers import ORJSONRenderer
+from .request_log import RequestLogWriter, stop_request_log
+from .routing import PrefixTrie
+from .serializers import CustomUserSerializer, MessageRowSerializer, MessageSerializer
+from .views import ConversationViewSet, MessageViewSet
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Register a benchmark under its function name"""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def measure(label, func, iterations):
+    """Call func `iterations` times and return (label, seconds per call, queries per call)"""
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count_queries):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - start
+    return label, elapsed / iterations, queries / iterations
+
+
+def make_user(username):
+    return CustomUser.objects.create_user(
+        username=username,
+        password='benchmark-password',
+        email=f'{username}@example.com',
+        first_name=username.title(),
+        last_name='Bench',
+    )
+
+
+@benchmark
+def auth(iterations):
+    """JWT decoding per request: three separate passes vs the shared pass"""
+    user = make_user('bench-auth')
+    token = str(add_user_claims(RefreshToken.for_user(user), user).access_token)
+    factory = RequestFactory()
+
+    def separate_passes():
+        request = factory.get('/api/conversations/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        JWTAuthentication().authenticate(request)      # RequestLoggingMiddleware
+        JWTAuthentication().authenticate(request)      # RolepermissionMiddleware
+        jwt_authenticator.authenticate_token(request)  # CustomJWTAuthentication
+
+    def shared_pass():
+        request = factory.get('/api/conversations/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        for _ in range(3):
+            authenticate_request(request)
+
+    rows = [
+        measure('three passes', separate_passes, iterations),
+        measure('shared pass', shared_pass, iterations),
+    ]
+    # Stateless tokens are only trusted with a shared revocation cache; a
+    # file-based cache stands in for Redis
+    with tempfile.TemporaryDirectory() as directory, override_settings(
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory},
+        },
+        CHATS_STATELESS_JWT=True,
+        CHATS_TOKEN_REVOCATION_CACHE='shared',
+    ):
+        rows.append(measure('shared pass, stateless', shared_pass, iterations))
+    return rows
+
+
+@benchmark
+def request_logging(iterations):
+    """Cost of logging one request on the request thread: FileHandler vs queued writer"""
+    entry = {'user': 'Bench User (bench@example.com)', 'method': 'GET', 'path': '/api/conversations/',
+             'status': 200, 'latency_ms': 1.25}
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        sync_logger = logging.getLogger('chats.benchmarks.sync')
+        sync_logger.propagate = False
+        sync_logger.setLevel(logging.INFO)
+        handler = logging.FileHandler(os.path.join(directory, 'sync.log'))
+        sync_logger.addHandler(handler)
+        rows.append(measure('FileHandler', lambda: sync_logger.info(entry), iterations))
+        sync_logger.removeHandler(handler)
+        handler.close()
+
+        async_logger = logging.getLogger('chats.benchmarks.async')
+        async_logger.propagate = False
+        async_logger.setLevel(logging.INFO)
+        writer = RequestLogWriter(os.path.join(directory, 'async.log'), queue_size=iterations + 1)
+        writer.start()
+        async_logger.addHandler(writer.queue_handler)
+        rows.append(measure('queued JSON writer', lambda: async_logger.info(entry), iterations))
+        async_logger.removeHandler(writer.queue_handler)
+        writer.stop()
+    return rows
+
+
+@benchmark
+def route_policy(iterations):
+    """Matching a request path against 5000 protected prefixes: any(startswith) vs prefix trie"""
+    prefixes = [f"/api/tenant-{i}/admin-actions/" for i in range(5000)]
+    trie = PrefixTrie({prefix: ('admin',) for prefix in prefixes})
+    path = "/api/conversations/3f1c9a52-0d4b-4a8e-9f3e-2b7c1d5e6a90/messages/"
+
+    return [
+        measure('any(startswith)', lambda: any(path.startswith(prefix) for prefix in prefixes), iterations),
+        measure('prefix trie', lambda: trie.longest_prefix(path), iterations),
+    ]
+
+
+@benchmark
+def asgi_middleware(iterations):
+    """ASGI requests through the chats middleware: sync-only chain vs async-capable chain"""
+    middleware_classes = [
+        JWTAuthenticationMiddleware, RequestLoggingMiddleware, RestrictAccessByTimeMiddleware,
+        OffensiveLanguageMiddleware, RolepermissionMiddleware,
+    ]
+    # The DRF views are sync either way; Django's async handler runs them in a thread
+    view = sync_to_async(lambda request: HttpResponse())
+
+    def sync_only_chain():
+        # What Django builds for sync-only middleware in an async stack:
+        # back to the loop for the view, and into a thread for the middleware
+        handler = async_to_sync(view)
+        for middleware_class in reversed(middleware_classes):
+            handler = middleware_class(handler)
+        return sync_to_async(handler)
+
+    def async_capable_chain():
+        handler = view
+        for middleware_class in reversed(middleware_classes):
+            handler = middleware_class(handler)
+        return handler
+
+    factory = AsyncRequestFactory()
+
+    async def run(chain, concurrency, rounds):
+        async def one():
+            await chain(factory.get('/api/conversations/'))
+        for _ in range(rounds):
+            await asyncio.gather(*(one() for _ in range(concurrency)))
+
+    rows = []
+    with tempfile.TemporaryDirectory() as directory, \
+            override_settings(CHATS_REQUEST_LOG_FILE=os.path.join(directory, 'requests.log')):
+        # RequestLoggingMiddleware starts the process-wide writer; restart
+        # it on the temporary file and stop it before the file goes away
+        stop_request_log()
+        try:
+            for label, build in (('sync-only', sync_only_chain), ('async-capable', async_capable_chain)):
+                chain = build()
+                for concurrency in (1, 50):
+                    rounds = max(1, iterations // concurrency)
+                    start = time.perf_counter()
+                    asyncio.run(run(chain, concurrency, rounds))
+                    elapsed = time.perf_counter() - start
+                    rows.append((f'{label}, {concurrency} concurrent', elapsed / (rounds * concurrency), 0.0))
+        finally:
+            stop_request_log()
+    return rows
+
+
+@benchmark
+def response_cache(iterations):
+    """Inbox and message list of an idle conversation: uncached vs served from the response cache"""
+    alice, bob = make_user('bench-cache-alice'), make_user('bench-cache-bob')
+    for _ in range(20):
+        conversation = Conversation.objects.create()
+        conversation.participants_id.set([alice, bob])
+        Message.objects.bulk_create(
+            Message(conversation=conversation, sender_id=bob, message_body=f'message {i}') for i in range(30)
+        )
+
+    factory = APIRequestFactory()
+    inbox = ConversationViewSet.as_view({'get': 'list'})
+    messages = MessageViewSet.as_view({'get': 'list'})
+
+    def get(view, path, **kwargs):
+        def call():
+            request = factory.get(path)
+            force_authenticate(request, alice)
+            view(request, **kwargs).render()
+        return call
+
+    rows = []
+    endpoints = (
+        ('inbox', inbox, '/api/conversations/', {}),
+        ('messages', messages, f'/api/conversations/{conversation.pk}/messages/',
+         {'conversation_pk': str(conversation.pk)}),
+    )
+    # One process, so its local cache can stand in for the shared ones
+    with override_settings(ALLOWED_HOSTS=['testserver'], CHATS_MEMBERSHIP_CACHE='default'):
+        for name, view, path, kwargs in endpoints:
+            with override_settings(CHATS_RESPONSE_CACHE=None):
+                rows.append(measure(f'{name}, uncached', get(view, path, **kwargs), iterations))
+            with override_settings(CHATS_RESPONSE_CACHE='default'):
+                get(view, path, **kwargs)()
+                rows.append(measure(f'{name}, cached', get(view, path, **kwargs), iterations))
+    return rows
+
+
+@benchmark
+def message_rendering(iterations):
+    """A 100-message page: fetch + serialize with MessageSerializer vs .values() rows, then render with json vs orjson"""
+    alice, bob = make_user('bench-render-alice'), make_user('bench-render-bob')
+    conversation = Conversation.objects.create()
+    conversation.participants_id.set([alice, bob])
+    Message.objects.bulk_create(
+        Message(conversation=conversation, sender_id=bob, message_body=f'message body number {i}') for i in range(100)
+    )
+    messages = Message.objects.filter(conversation=conversation).order_by('-sent_at', '-message_id')[:100]
+    page = MessageRowSerializer(list(MessageRowSerializer.rows(messages)), many=True).data
+
+    cases = (
+        ('MessageSerializer, fetch + serialize',
+         lambda: MessageSerializer(list(messages.with_sender()), many=True).data),
+        ('MessageRowSerializer, fetch + serialize',
+         lambda: MessageRowSerializer(list(MessageRowSerializer.rows(messages)), many=True).data),
+        ('JSONRenderer, render', lambda: JSONRenderer().render(page)),
+        ('ORJSONRenderer, render', lambda: ORJSONRenderer().render(page)),
+    )
+    rows = []
+    for label, func in cases:
+        label, seconds, queries = measure(label, func, iterations)
+        rows.append((f'{label}: {100 / seconds:,.0f} rows/s', seconds, queries))
+    return rows
+
+
+@benchmark
+def registration(iterations):
+    """Registering a user through CustomUserSerializer, with the configured hasher and with MD5"""
+    counter = iter(range(10 ** 9))
+
+    def register():
+        n = next(counter)
+        serializer = CustomUserSerializer(data={
+            'username': f'bench-register-{n}', 'email': f'bench-register-{n}@example.com',
+            'first_name': 'Bench', 'last_name': 'Register', 'phone_number': f'+254{n:09d}',
+            'password': 'Registration-Pa55', 'confirm_password': 'Registration-Pa55',
+        })
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+    # The configured hasher is deliberately slow, so it gets fewer rounds
+    rows = [measure('configured hasher', register, max(1, iterations // 50))]
+    with override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']):
+        rows.append(measure('MD5 hasher, validation and writes only', register, iterations))
+    return [(f'{label}: {1 / seconds:,.0f} registrations/s', seconds, queries) for label, seconds, queries in rows]
@@ -0,0 +1,35 @@
+"""
+Cache aliases for state every worker must agree on.
+
+Membership sets and similar entries are written by whichever process
+handles a change and read by all the others. A LocMemCache (what Django
+uses when CACHES isn't configured) is private to its process and a
+DummyCache keeps nothing, so neither can hold them once the app runs in
+more than one worker.
+
+A chats setting naming such an alias falls back to 'default' when it is
+unset, but only if the default cache is shared. chats.checks reports
+aliases explicitly set to a process-local cache.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+PROCESS_LOCAL_CACHES = (LocMemCache, DummyCache)
+
+
+def is_shared_cache(alias):
+    """True if every process using `alias` sees the same entries"""
+    return not isinstance(caches[alias], PROCESS_LOCAL_CACHES)
+
+
+def get_shared_cache_alias(setting_name):
+    """
+    Return the cache alias named by `setting_name`. When the setting is
+    unset, that is 'default' if the default cache is shared and None (no
+    caching) otherwise.
+    """
+    if hasattr(settings, setting_name):
+        return getattr(settings, setting_name)
+    return 'default' if is_shared_cache('default') else None
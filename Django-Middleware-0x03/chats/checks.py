@@ -0,0 +1,74 @@
+"""
+System checks for the chats settings (run by manage.py check, runserver,
+migrate and test).
+"""
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+from .caching import get_shared_cache_alias, is_shared_cache
+
+
+@register()
+def check_membership_cache(app_configs, **kwargs):
+    """
+    A membership set left in one worker's private cache keeps a removed
+    participant's access there until it expires.
+    """
+    alias = getattr(settings, 'CHATS_MEMBERSHIP_CACHE', None)
+    if alias is None or is_shared_cache(alias):
+        return []
+    return [Error(
+        f"CHATS_MEMBERSHIP_CACHE uses the process-local cache {alias!r}.",
+        hint="Point it at a cache shared by all workers (e.g. Redis), or unset it to disable the cache.",
+        id='chats.E001',
+    )]
+
+
+@register()
+def check_token_revocation_cache(app_configs, **kwargs):
+    """
+    Token claims are only trusted while revocations reach every worker.
+    """
+    if not getattr(settings, 'CHATS_STATELESS_JWT', False):
+        return []
+    alias = get_shared_cache_alias('CHATS_TOKEN_REVOCATION_CACHE')
+    if alias is not None and is_shared_cache(alias):
+        return []
+    return [Warning(
+        "CHATS_STATELESS_JWT has no effect: CHATS_TOKEN_REVOCATION_CACHE is not a shared cache.",
+        hint="Point CHATS_TOKEN_REVOCATION_CACHE (or the default cache) at a cache shared by all workers.",
+        id='chats.W001',
+    )]
+
+
+@register()
+def check_version_cache(app_configs, **kwargs):
+    """
+    Version bumps must reach every worker, or their ETags and long polls
+    never see writes handled elsewhere.
+    """
+    alias = getattr(settings, 'CHATS_VERSION_CACHE', 'default')
+    if is_shared_cache(alias):
+        return []
+    return [Warning(
+        f"CHATS_VERSION_CACHE uses the process-local cache {alias!r}; conversation versions "
+        "only change in the worker that handled the write.",
+        hint="Fine for a single process. With several workers point it (or CACHE_URL) at a shared cache.",
+        id='chats.W002',
+    )]
+
+
+@register()
+def check_response_cache(app_configs, **kwargs):
+    """
+    Cached pages are keyed on version stamps that only move in the worker
+    handling a write unless both caches are shared.
+    """
+    alias = get_shared_cache_alias('CHATS_RESPONSE_CACHE')
+    if alias is None or is_shared_cache(alias):
+        return []
+    return [Warning(
+        f"CHATS_RESPONSE_CACHE uses the process-local cache {alias!r}; other workers serve stale pages.",
+        hint="Point it at a cache shared by all workers, or set it to None.",
+        id='chats.W003',
+    )]
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from chats.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Maintain the message full-text search index (see chats.search)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['rebuild'], help="rebuild: recreate the SQLite FTS5 index and triggers")
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        if rebuild_search_index(options['database']):
+            self.stdout.write(self.style.SUCCESS("Rebuilt the message search index."))
+        else:
+            self.stdout.write("This database keeps its search index up to date itself; nothing to rebuild.")
@@ -0,0 +1,45 @@
+from django.db import models
+
+
+class MessageQuerySet(models.QuerySet):
+    """
+    Query helpers for Message lists.
+    """
+    def with_sender(self):
+        """
+        Join the sender so MessageSerializer.get_sender_name never
+        issues a query per row.
+        """
+        return self.select_related('sender_id')
+
+
+class ConversationQuerySet(models.QuerySet):
+    """
+    Query helpers for Conversation lists.
+    """
+    def with_participants(self):
+        """Prefetch participants in one query for the whole page"""
+        return self.prefetch_related('participants_id')
+
+    def with_last_message(self):
+        """Join the denormalized last message and its sender"""
+        return self.select_related('last_message__sender_id')
+
+    def by_activity(self):
+        """
+        Most recently active first, as a scan of conversation_activity_idx.
+        Conversations without messages sort where the database puts NULLs
+        (first on PostgreSQL, last on SQLite).
+        """
+        return self.order_by('-last_message_at')
+
+    def for_participant(self, user):
+        """
+        Conversations `user` takes part in, annotated with the user's
+        `unread_count` and `last_read_at`. Both come from the membership row
+        joined by the filter, so the badges need no extra query.
+        """
+        return self.filter(memberships__user=user).annotate(
+            unread_count=models.F('memberships__unread_count'),
+            last_read_at=models.F('memberships__last_read_at'),
+        )
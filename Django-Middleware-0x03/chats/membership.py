@@ -0,0 +1,99 @@
+import uuid
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .caching import get_shared_cache_alias
+from .models import ConversationParticipant
+
+
+def membership_cache_key(user_id):
+    return f"chats:memberships:{user_id}"
+
+
+def get_membership_cache():
+    """
+    The cache holding the user -> conversation ids sets (CHATS_MEMBERSHIP_CACHE),
+    or None when memberships aren't cached. It must be shared by all workers
+    (see chats.caching).
+    """
+    alias = get_shared_cache_alias('CHATS_MEMBERSHIP_CACHE')
+    return caches[alias] if alias else None
+
+
+def get_user_conversation_ids(user_id):
+    """
+    Return the frozenset of conversation ids the user takes part in.
+    Served from the cache; a miss loads the whole set with one query.
+    """
+    cache = get_membership_cache()
+    key = membership_cache_key(user_id)
+    conversation_ids = cache.get(key) if cache is not None else None
+    if conversation_ids is None:
+        conversation_ids = frozenset(
+            ConversationParticipant.objects.filter(user_id=user_id).values_list('conversation_id', flat=True)
+        )
+        if cache is not None:
+            cache.set(key, conversation_ids, getattr(settings, 'CHATS_MEMBERSHIP_CACHE_TIMEOUT', 300))
+    return conversation_ids
+
+
+def _delete_memberships(keys):
+    cache = get_membership_cache()
+    if cache is not None:
+        cache.delete_many(keys)
+
+
+def invalidate_memberships(user_ids):
+    """
+    Drop the cached sets of the given users (called from chats.signals).
+
+    They are dropped now and again once the transaction commits: until
+    then other requests still read the old rows and may cache the old set
+    again, which would keep a removed participant's access.
+    """
+    keys = [membership_cache_key(user_id) for user_id in user_ids]
+    if keys:
+        _delete_memberships(keys)
+        transaction.on_commit(partial(_delete_memberships, keys))
+
+
+def is_participant(request, conversation_id):
+    """
+    Return True if request.user takes part in the conversation.
+
+    Positive answers come from the user's cached conversation set, memoised
+    on the request so permission classes and viewset methods share it and
+    hot endpoints issue no membership query at all. A miss is confirmed with
+    an indexed EXISTS, which also repairs a set cached before the user joined.
+    """
+    user = request.user
+    if not user or not user.is_authenticated:
+        return False
+
+    try:
+        conversation_id = uuid.UUID(str(conversation_id))
+    except ValueError:
+        return False
+
+    conversation_ids = getattr(request, '_conversation_ids', None)
+    if conversation_ids is None:
+        conversation_ids = request._conversation_ids = get_user_conversation_ids(user.pk)
+    if conversation_id in conversation_ids:
+        return True
+
+    denied = getattr(request, '_denied_conversation_ids', None)
+    if denied is None:
+        denied = request._denied_conversation_ids = set()
+    if conversation_id in denied:
+        return False
+
+    if ConversationParticipant.objects.filter(conversation_id=conversation_id, user_id=user.pk).exists():
+        invalidate_memberships([user.pk])
+        request._conversation_ids = conversation_ids | {conversation_id}
+        return True
+
+    denied.add(conversation_id)
+    return False
@@ -1,47 +1,144 @@
 import logging
 import time
 from datetime import datetime
-from rest_framework_simplejwt.authentication import JWTAuthentication
-from django.utils.deprecation import MiddlewareMixin
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from rest_framework.exceptions import APIException
+from rest_framework_simplejwt.settings import api_settings
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.http import HttpResponse
 from http import HTTPStatus
+from .auth import authenticate_request
+from .ratelimit import get_rate_limiter
+from .request_log import start_request_log
+from .routing import PrefixTrie
 
-# Configuring a logger for request logging
+# Logger for request logging; RequestLoggingMiddleware attaches the
+# asynchronous JSON-lines writer (see chats.request_log)
 logger = logging.getLogger(__name__)
-handler = logging.FileHandler("requests.log")  # Logs saved in project root
-formatter = logging.Formatter('%(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 logger.setLevel(logging.INFO)
-    
 
-class RequestLoggingMiddleware(MiddlewareMixin):
+
+def get_jwt_user(request):
     """
-    Middleware to log every request with user details.
-    Works with JWT authentication and session-based auth (like Django admin).
+    Return the user authenticated by the request's JWT, or None.
+    Reads request.jwt_user once JWTAuthenticationMiddleware has set it;
+    otherwise uses the shared per-request authentication pass, so calling
+    this from several middleware never decodes the token twice.
+    """
+    if hasattr(request, 'jwt_user'):
+        return request.jwt_user
+    try:
+        auth_result = authenticate_request(request)
+    except APIException:
+        # Invalid or expired tokens are reported by DRF, not by middleware
+        return None
+    if auth_result is None:
+        return None
+    user, _ = auth_result
+    return user
+
+
+async def aget_jwt_user(request):
+    """
+    Async version of get_jwt_user. Only the database lookup of a first
+    authentication pass needs a thread; requests without a token or whose
+    pass already ran are answered on the event loop.
+    """
+    if (hasattr(request, 'jwt_user') or hasattr(request, '_jwt_auth_result')
+            or api_settings.AUTH_HEADER_NAME not in request.META):
+        return get_jwt_user(request)
+    return await sync_to_async(get_jwt_user)(request)
+
+
+def get_session_user(request):
+    """Return Django's session user (e.g. admin panel) if logged in, else None"""
+    if hasattr(request, "user") and request.user.is_authenticated:
+        return request.user
+    return None
+
+
+async def aget_session_user(request):
+    """Async version of get_session_user"""
+    if hasattr(request, "auser"):
+        user = await request.auser()
+        if user.is_authenticated:
+            return user
+    return None
+
+
+class AsyncCapableMiddleware:
     """
+    Base for middleware that run natively under both WSGI and ASGI.
+
+    Django hands an async get_response to async-capable middleware when
+    serving ASGI; subclasses then take their __acall__ path instead of
+    being wrapped in sync_to_async, which saves a thread switch per
+    middleware per request.
+    """
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response):
         self.get_response = get_response
-        self.jwt_authenticator = JWTAuthentication()
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+
+class JWTAuthenticationMiddleware(AsyncCapableMiddleware):
+    """
+    Middleware that authenticates the JWT once, up front, and stores the
+    user (or None) on request.jwt_user. get_jwt_user() and aget_jwt_user()
+    return it from then on.
+    """
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        request.jwt_user = get_jwt_user(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        request.jwt_user = await aget_jwt_user(request)
+        return await self.get_response(request)
+
+
+class RequestLoggingMiddleware(AsyncCapableMiddleware):
+    """
+    Middleware to log every request with user details, status and latency.
+    Works with JWT authentication and session-based auth (like Django admin).
+    Records are written off the request thread by chats.request_log.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        start_request_log(logger)
 
     def __call__(self, request):
-        user = None
+        if self.async_mode:
+            return self.__acall__(request)
+
+        start = time.perf_counter()
+        response = self.get_response(request)
+        latency_ms = (time.perf_counter() - start) * 1000
 
-        # Try to decode JWT token ---
-        try:
-            jwt_result = self.jwt_authenticator.authenticate(request)
-            if jwt_result is not None:
-                user, _ = jwt_result  # Extract user from JWT
-        except Exception:
-            # Ignore JWT errors to avoid breaking requests
-            pass
+        # User from the shared JWT pass (errors are ignored there),
+        # falling back to the session user ---
+        user = get_jwt_user(request) or get_session_user(request)
+        self.log_request(request, response, user, latency_ms)
+        return response
 
-        # Fallback to Django's session-based user (e.g., admin panel) ---
-        if not user and hasattr(request, "user") and request.user.is_authenticated:
-            user = request.user
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        latency_ms = (time.perf_counter() - start) * 1000
 
+        user = await aget_jwt_user(request) or await aget_session_user(request)
+        self.log_request(request, response, user, latency_ms)
+        return response
+
+    def log_request(self, request, response, user, latency_ms):
         # Build user info string ---
         if user:
             if hasattr(user, "get_full_name") and user.get_full_name():
@@ -55,23 +152,41 @@ class RequestLoggingMiddleware(MiddlewareMixin):
         else:
             user_info = "Anonymous"
 
-        # Log the request ---
-        logger.info(f"{datetime.now()} - User: {user_info} - Path: {request.path}")
-
-        # Continue processing request
-        return self.get_response(request)
+        # Queue the log record; formatting and disk I/O happen on the writer thread ---
+        logger.info({
+            'user': user_info,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'latency_ms': round(latency_ms, 2),
+        })
     
 
-class RestrictAccessByTimeMiddleware:
+class RestrictAccessByTimeMiddleware(AsyncCapableMiddleware):
     """
     Middleware to restrict access to the messaging app
     outside of 6 PM - 9 PM.
     """
 
-    def __init__(self, get_response):
-        self.get_response = get_response  # Called once when the server starts
-
     def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        forbidden = self.check_access_time()
+        if forbidden is not None:
+            return forbidden
+
+        # Pass the request to the next middleware/view
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        forbidden = self.check_access_time()
+        if forbidden is not None:
+            return forbidden
+        return await self.get_response(request)
+
+    def check_access_time(self):
+        """Return a 403 response outside the allowed hours, else None"""
         # Get current server hour
         current_hour = datetime.now().hour
 
@@ -84,114 +199,177 @@ class RestrictAccessByTimeMiddleware:
                 content_type="text/html",
                 status=HTTPStatus.FORBIDDEN
             )
-
-        # Pass the request to the next middleware/view
-        return self.get_response(request)
+        return None
     
 
-class OffensiveLanguageMiddleware:
+class OffensiveLanguageMiddleware(AsyncCapableMiddleware):
     """
-    Middleware to limit the number of chat messages a user can send 
-    based on their IP address within a certain time window.
+    Middleware to limit the number of chat messages that can be sent
+    per client IP and per authenticated user within a time window.
+
+    Limits come from CHATS_MESSAGE_RATE_LIMITS as {scope: (limit, seconds)}
+    for the 'ip' and 'user' scopes (None disables a scope); counters live in
+    the backend configured by CHATS_RATE_LIMITER (see chats.ratelimit).
+    Only POSTs resolved to a URL name in CHATS_RATE_LIMITED_URL_NAMES count.
+
+    CHATS_URL_RATE_LIMITS gives a URL name its own {scope: (limit, seconds)}
+    and its own counters, e.g. for the bulk endpoint, where one request
+    creates up to CHATS_BULK_MESSAGE_MAX_BATCH messages. Its URL names are
+    always limited.
     """
 
-    def __init__(self, get_response):
-        self.get_response = get_response
-        # Dictionary to track requests per IP: {ip: [timestamps]}
-        self.ip_message_log = {}
+    DEFAULT_RATE_LIMITS = {
+        'ip': (5, 60),      # 5 messages per minute per IP address
+        'user': (5, 60),    # 5 messages per minute per user
+    }
+    DEFAULT_RATE_LIMITED_URL_NAMES = ('conversation-messages-list',)
+    DEFAULT_URL_RATE_LIMITS = {
+        'conversation-messages-bulk': {'ip': (2, 60), 'user': (2, 60)},
+    }
 
-        # Settings
-        self.MESSAGE_LIMIT = 5        # Maximum messages
-        self.TIME_WINDOW = 60         # Time window in seconds (1 minute)
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if self.async_mode:
+            # Django adapts process_view by its own sync/async nature
+            self.process_view = self.aprocess_view
+        self.rate_limiter = get_rate_limiter()
+        self.rate_limits = {
+            **self.DEFAULT_RATE_LIMITS,
+            **getattr(settings, 'CHATS_MESSAGE_RATE_LIMITS', {}),
+        }
+        self.url_rate_limits = {
+            **self.DEFAULT_URL_RATE_LIMITS,
+            **getattr(settings, 'CHATS_URL_RATE_LIMITS', {}),
+        }
+        self.rate_limited_url_names = frozenset(
+            getattr(settings, 'CHATS_RATE_LIMITED_URL_NAMES', self.DEFAULT_RATE_LIMITED_URL_NAMES)
+        ) | frozenset(self.url_rate_limits)
 
     def __call__(self, request):
-        # Only apply this rule to POST requests targeting messages
-        if request.method == "POST" and "messages" in request.path.lower():
-            user_ip = self.get_client_ip(request)
-            current_time = time.time()
-
-            if user_ip not in self.ip_message_log:
-                self.ip_message_log[user_ip] = []
-
-            # Remove timestamps older than the time window
-            self.ip_message_log[user_ip] = [
-                timestamp for timestamp in self.ip_message_log[user_ip]
-                if current_time - timestamp < self.TIME_WINDOW
-            ]
-
-            # Check if the limit is exceeded
-            if len(self.ip_message_log[user_ip]) >= self.MESSAGE_LIMIT:
-                return HttpResponse(
-                    "<h1>429 Too Many Requests</h1>"
-                    "<p>You have exceeded the limit of 5 messages per minute.</p>",
-                    status=429,
-                    content_type="text/html"
-                )
-
-            # Log the current request timestamp
-            self.ip_message_log[user_ip].append(current_time)
-
         return self.get_response(request)
 
+    def is_rate_limited_view(self, request):
+        # Only apply this rule to POST requests to the message-creating views;
+        # the URL is already resolved here, so this is a set lookup
+        return request.method == "POST" and request.resolver_match.url_name in self.rate_limited_url_names
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if self.is_rate_limited_view(request):
+            user = get_jwt_user(request) or get_session_user(request)
+            for scope, key, limit, window in self.get_rate_limits(request, user):
+                if not self.rate_limiter.hit(key, limit, window):
+                    return self.too_many_requests(limit, window)
+
+        # Continue to the view
+        return None
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        if self.is_rate_limited_view(request):
+            user = await aget_jwt_user(request) or await aget_session_user(request)
+            for scope, key, limit, window in self.get_rate_limits(request, user):
+                if not await self.rate_limiter.ahit(key, limit, window):
+                    return self.too_many_requests(limit, window)
+        return None
+
+    def get_rate_limits(self, request, user):
+        """Return the enabled (scope, key, limit, window) checks for this request."""
+        url_name = request.resolver_match.url_name
+        if url_name in self.url_rate_limits:
+            rate_limits, prefix = self.url_rate_limits[url_name], f"{url_name}:"
+        else:
+            rate_limits, prefix = self.rate_limits, ""
+        checks = []
+        for scope, key in (('user', user.pk if user else None), ('ip', self.get_client_ip(request))):
+            if key is None or rate_limits.get(scope) is None:
+                continue
+            limit, window = rate_limits[scope]
+            checks.append((scope, f"{prefix}{scope}:{key}", limit, window))
+        return checks
+
+    def too_many_requests(self, limit, window):
+        return HttpResponse(
+            "<h1>429 Too Many Requests</h1>"
+            f"<p>You have exceeded the limit of {limit} messages "
+            f"per {window} seconds.</p>",
+            status=429,
+            content_type="text/html"
+        )
+
     def get_client_ip(self, request):
         """Get the client's real IP address."""
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
         if x_forwarded_for:
-            return x_forwarded_for.split(',')[0]
+            return x_forwarded_for.split(',')[0].strip()
         return request.META.get('REMOTE_ADDR')
     
 
-class RolepermissionMiddleware:
+class RolepermissionMiddleware(AsyncCapableMiddleware):
     """
     Middleware to check if a user has the correct role
     (admin or moderator) before allowing access to specific actions.
     """
 
+    # Path prefix -> roles allowed there; overridden by CHATS_ROLE_PROTECTED_PATHS
+    DEFAULT_PROTECTED_PATHS = {
+        "/api/admin-actions/": ("admin", "moderator"),    # Example protected endpoint
+        "/api/messages/delete/": ("admin", "moderator"),  # Example delete endpoint
+    }
+
     def __init__(self, get_response):
-        self.get_response = get_response
-        self.jwt_authenticator = JWTAuthentication()  # For JWT token decoding
+        super().__init__(get_response)
+        # Compiled once; the most specific (longest) matching prefix wins
+        protected_paths = getattr(settings, 'CHATS_ROLE_PROTECTED_PATHS', self.DEFAULT_PROTECTED_PATHS)
+        self.protected_paths = PrefixTrie({
+            prefix: frozenset(roles) for prefix, roles in protected_paths.items()
+        })
 
     def __call__(self, request):
-        # Define restricted paths or actions
-        protected_paths = [
-            "/api/admin-actions/",   # Example protected endpoint
-            "/api/messages/delete/", # Example delete endpoint
-        ]
+        if self.async_mode:
+            return self.__acall__(request)
+
+        allowed_roles = self.protected_paths.longest_prefix(request.path)
 
         # Apply middleware only to protected paths
-        if any(request.path.startswith(path) for path in protected_paths):
-            user = self.get_user_from_jwt(request)
-
-            # If no user or not authenticated
-            if not user:
-                return HttpResponse(
-                    "<h1>401 Unauthorized</h1>"
-                    "<p>Authentication required to access this resource.</p>",
-                    content_type="text/html",
-                    status=401
-                )
-
-            # Check user role
-            if user.role not in ["admin", "moderator"]:
-                return HttpResponse(
-                    "<h1>403 Forbidden</h1>"
-                    "<p>You do not have permission to perform this action.</p>",
-                    content_type="text/html",
-                    status=403
-                )
+        if allowed_roles is not None:
+            denied = self.check_role(self.get_user_from_jwt(request), allowed_roles)
+            if denied is not None:
+                return denied
 
         # Allow the request to continue
         return self.get_response(request)
 
+    async def __acall__(self, request):
+        allowed_roles = self.protected_paths.longest_prefix(request.path)
+        if allowed_roles is not None:
+            denied = self.check_role(await aget_jwt_user(request), allowed_roles)
+            if denied is not None:
+                return denied
+        return await self.get_response(request)
+
+    def check_role(self, user, allowed_roles):
+        """Return a 401/403 response unless `user` has one of `allowed_roles`"""
+        # If no user or not authenticated
+        if not user:
+            return HttpResponse(
+                "<h1>401 Unauthorized</h1>"
+                "<p>Authentication required to access this resource.</p>",
+                content_type="text/html",
+                status=401
+            )
+
+        # Check user role
+        if getattr(user, "role", None) not in allowed_roles:
+            return HttpResponse(
+                "<h1>403 Forbidden</h1>"
+                "<p>You do not have permission to perform this action.</p>",
+                content_type="text/html",
+                status=403
+            )
+
+        return None
+
     def get_user_from_jwt(self, request):
         """
-        Extract and return the user from the JWT token in the Authorization header.
+        Return the user from the shared JWT authentication pass.
         """
-        try:
-            auth_result = self.jwt_authenticator.authenticate(request)
-            if auth_result is not None:
-                user, _ = auth_result
-                return user
-            return None
-        except Exception:
-            return None
\ No newline at end of file
+        return get_jwt_user(request)
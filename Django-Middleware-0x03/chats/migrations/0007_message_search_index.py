@@ -0,0 +1,70 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+# Must match the vector built by chats.search.PostgresMessageSearch
+POSTGRES_SEARCH_INDEX = GinIndex(SearchVector('message_body', config='english'), name='message_body_search_idx')
+
+# External-content FTS5 table mirroring chats_message.message_body by rowid
+SQLITE_FTS5_SETUP = [
+    "CREATE VIRTUAL TABLE chats_message_fts USING fts5("
+    "message_body, content='chats_message', content_rowid='rowid', tokenize='porter unicode61')",
+    "CREATE TRIGGER chats_message_fts_insert AFTER INSERT ON chats_message BEGIN "
+    "INSERT INTO chats_message_fts(rowid, message_body) VALUES (new.rowid, new.message_body); END",
+    "CREATE TRIGGER chats_message_fts_delete AFTER DELETE ON chats_message BEGIN "
+    "INSERT INTO chats_message_fts(chats_message_fts, rowid, message_body) "
+    "VALUES ('delete', old.rowid, old.message_body); END",
+    "CREATE TRIGGER chats_message_fts_update AFTER UPDATE OF message_body ON chats_message BEGIN "
+    "INSERT INTO chats_message_fts(chats_message_fts, rowid, message_body) "
+    "VALUES ('delete', old.rowid, old.message_body); "
+    "INSERT INTO chats_message_fts(rowid, message_body) VALUES (new.rowid, new.message_body); END",
+    "INSERT INTO chats_message_fts(chats_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_FTS5_TEARDOWN = [
+    "DROP TRIGGER IF EXISTS chats_message_fts_insert",
+    "DROP TRIGGER IF EXISTS chats_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chats_message_fts_update",
+    "DROP TABLE IF EXISTS chats_message_fts",
+]
+
+
+def sqlite_has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.add_index(apps.get_model('chats', 'Message'), POSTGRES_SEARCH_INDEX)
+    elif connection.vendor == 'sqlite' and sqlite_has_fts5(connection):
+        for statement in SQLITE_FTS5_SETUP:
+            schema_editor.execute(statement)
+    # Other databases fall back to chats.search.IContainsMessageSearch
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.remove_index(apps.get_model('chats', 'Message'), POSTGRES_SEARCH_INDEX)
+    elif connection.vendor == 'sqlite':
+        for statement in SQLITE_FTS5_TEARDOWN:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0006_message_conv_keyset_idx'),
+    ]
+
+    operations = [
+        # A btree on a TextField can't serve '%term%' searches; it only slowed down writes
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chats_messa_message_94a457_idx',
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,83 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_read_state(apps, schema_editor):
+    """
+    Start every participant's read cursor at their own last message, the
+    point up to which the old unread heuristic counted them as caught up.
+    """
+    ConversationParticipant = apps.get_model('chats', 'ConversationParticipant')
+    Message = apps.get_model('chats', 'Message')
+
+    own_last = (
+        Message.objects.filter(conversation=OuterRef('conversation'), sender_id=OuterRef('user'))
+        .order_by('-sent_at', '-message_id')
+    )
+    ConversationParticipant.objects.update(
+        last_read_message=Subquery(own_last.values('pk')[:1]),
+        last_read_at=Subquery(own_last.values('sent_at')[:1]),
+    )
+
+    others = Message.objects.filter(conversation=OuterRef('conversation')).exclude(sender_id=OuterRef('user'))
+
+    def count(messages):
+        return Coalesce(Subquery(
+            messages.order_by().values('conversation').annotate(total=Count('pk')).values('total')
+        ), 0)
+
+    ConversationParticipant.objects.filter(last_read_at__isnull=True).update(unread_count=count(others))
+    ConversationParticipant.objects.filter(last_read_at__isnull=False).update(
+        unread_count=count(others.filter(sent_at__gt=OuterRef('last_read_at')))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0008_conversation_activity'),
+    ]
+
+    operations = [
+        # The through model takes over the existing auto-created table as is
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='ConversationParticipant',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='chats.conversation')),
+                        ('user', models.ForeignKey(db_column='customuser_id', on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'chats_conversation_participants_id',
+                        'unique_together': {('conversation', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='conversation',
+                    name='participants_id',
+                    field=models.ManyToManyField(related_name='conversations', through='chats.ConversationParticipant', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='conversationparticipant',
+            name='last_read_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chats.message'),
+        ),
+        migrations.AddField(
+            model_name='conversationparticipant',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversationparticipant',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_read_state, migrations.RunPython.noop),
+    ]
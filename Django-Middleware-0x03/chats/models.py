@@ -1,7 +1,8 @@
 import uuid
-from django.db import models
+from django.db import models, router, transaction
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import AbstractUser
+from .managers import ConversationQuerySet, MessageQuerySet
 
 # Create your models here.
 class CustomUser(AbstractUser):
@@ -37,6 +38,12 @@ class CustomUser(AbstractUser):
             models.Index(fields=['email']),
             models.Index(fields=['role']),
         ]
+        constraints = [
+            # Blank numbers are optional input, not values to keep unique
+            models.UniqueConstraint(
+                fields=['phone_number'], condition=~models.Q(phone_number=''), name='unique_user_phone_number'
+            ),
+        ]
         verbose_name = "User"
         verbose_name_plural = "Users"
 
@@ -51,9 +58,27 @@ class Conversation(models.Model):
         editable=False,
         db_index=True
     )
-    participants_id = models.ManyToManyField(CustomUser, related_name='conversations')
+    participants_id = models.ManyToManyField(
+        CustomUser, related_name='conversations', through='ConversationParticipant'
+    )
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # Activity summary kept up to date by chats.activity whenever messages
+    # are added or deleted, so the inbox needs no aggregate over messages
+    last_message = models.ForeignKey(
+        'Message', null=True, blank=True, editable=False, on_delete=models.SET_NULL, related_name='+'
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True, editable=False)
+    message_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = ConversationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Backs the most-recently-active inbox ordering
+            models.Index(fields=['-last_message_at'], name='conversation_activity_idx'),
+        ]
+
     def __str__(self):
         return f"Conversation {self.conversation_id}"
 
@@ -70,12 +95,49 @@ class Message(models.Model):
     message_body = models.TextField(null=False)
     sent_at = models.DateTimeField(auto_now_add=True)
 
+    objects = MessageQuerySet.as_manager()
+
     class Meta:
         ordering = ['sent_at']
+        # Full-text search indexes are vendor-specific and live in migration 0007
         indexes = [
-            models.Index(fields=['message_body', 'sent_at']),
+            # Backs keyset pagination: one range scan per page of a conversation
+            models.Index(fields=['conversation', 'sent_at', 'message_id'], name='message_conv_keyset_idx'),
         ]
 
+    def save(self, *args, **kwargs):
+        # Commit the row together with the conversation activity update
+        # made by the post_save handler in chats.signals
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+
     def __str__(self):
             preview = self.message_body[:50] + "..." if len(self.message_body) > 50 else self.message_body
-            return f"{self.sender_id}: {preview}"
\ No newline at end of file
+            return f"{self.sender_id}: {preview}"
+
+
+class ConversationParticipant(models.Model):
+    """
+    Membership of a user in a conversation, with the user's read state.
+
+    Keeps the table and columns of the former auto-created participants
+    table. unread_count is maintained by chats.activity: new messages from
+    others increment it and marking the conversation read resets it.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(
+        CustomUser, on_delete=models.CASCADE, related_name='memberships', db_column='customuser_id'
+    )
+    last_read_message = models.ForeignKey(
+        Message, null=True, blank=True, on_delete=models.SET_NULL, related_name='+'
+    )
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        db_table = 'chats_conversation_participants_id'
+        unique_together = [('conversation', 'user')]
+
+    def __str__(self):
+        return f"{self.user_id} in {self.conversation_id}"
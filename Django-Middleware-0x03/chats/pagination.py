@@ -1,5 +1,17 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import binascii
+import uuid
+from urllib import parse
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .search import SEARCH_RANK
+
 
 class CustomMessagePagination(PageNumberPagination):
     page_size = 20
@@ -12,4 +24,174 @@ class CustomMessagePagination(PageNumberPagination):
             'next': self.get_next_link(),
             'previous': self.get_previous_link(),
             'results': data,
-        })
\ No newline at end of file
+        })
+
+
+class KeysetMessagePagination(BasePagination):
+    """
+    Keyset (cursor) pagination over the (sent_at, message_id) ordering.
+
+    Every page is a single index range scan on
+    (conversation_id, sent_at, message_id), so page N costs the same as page 1.
+    Counting is opt-in through ?count=exact or ?count=estimate (capped).
+    Requests that still send ?page= fall back to CustomMessagePagination.
+
+    Search results annotated with SEARCH_RANK are paged best match first
+    over (search_rank, message_id) instead.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    legacy_page_query_param = 'page'
+
+    # ?count=estimate stops counting after this many rows
+    count_estimate_cap = 1000
+
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.legacy_paginator = None
+        if self.legacy_page_query_param in request.query_params:
+            self.legacy_paginator = CustomMessagePagination()
+            return self.legacy_paginator.paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.key_field = SEARCH_RANK if SEARCH_RANK in queryset.query.annotations else 'sent_at'
+        self.descending = self.key_field == SEARCH_RANK or self.is_descending(queryset)
+        self.count, self.count_capped = self.get_count(queryset, request)
+
+        cursor = self.decode_cursor(request)
+        reverse = cursor[2] if cursor else False
+
+        # Walking backwards means flipping the scan direction, then flipping
+        # the rows back so that every page is returned in the requested order.
+        descending = self.descending != reverse
+        if descending:
+            queryset = queryset.order_by(f'-{self.key_field}', '-message_id')
+        else:
+            queryset = queryset.order_by(self.key_field, 'message_id')
+
+        if cursor:
+            queryset = queryset.filter(self.get_keyset_filter(cursor, descending))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+
+        if cursor is None:
+            self.has_next, self.has_previous = has_more, False
+        elif reverse:
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, True
+
+        return self.page
+
+    def get_paginated_response(self, data):
+        if self.legacy_paginator is not None:
+            return self.legacy_paginator.get_paginated_response(data)
+
+        payload = {
+            'count': self.count,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if self.count_capped is not None:
+            payload['count_capped'] = self.count_capped
+        return Response(payload)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def is_descending(self, queryset):
+        """Follow the direction OrderingFilter put on sent_at (newest first by default)"""
+        ordering = queryset.query.order_by
+        if ordering and ordering[0] == 'sent_at':
+            return False
+        return True
+
+    def get_count(self, queryset, request):
+        """Return (count, count_capped); counting is skipped unless asked for"""
+        mode = request.query_params.get(self.count_query_param)
+        if mode == 'exact':
+            return queryset.count(), None
+        if mode == 'estimate':
+            # LIMIT inside the COUNT keeps this bounded on huge conversations
+            count = queryset.order_by()[:self.count_estimate_cap + 1].count()
+            if count > self.count_estimate_cap:
+                return self.count_estimate_cap, True
+            return count, False
+        return None, None
+
+    def get_keyset_filter(self, cursor, descending):
+        key, message_id, _ = cursor
+        lookup = f'{self.key_field}__lt' if descending else f'{self.key_field}__gt'
+        id_lookup = 'message_id__lt' if descending else 'message_id__gt'
+        return Q(**{lookup: key}) | Q(**{self.key_field: key, id_lookup: message_id})
+
+    def get_next_link(self):
+        if self.legacy_paginator is not None:
+            return self.legacy_paginator.get_next_link()
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if self.legacy_paginator is not None:
+            return self.legacy_paginator.get_previous_link()
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def encode_cursor(self, message, reverse):
+        """Build an opaque link for the position just past `message`"""
+        url = remove_query_param(self.base_url, self.legacy_page_query_param)
+        token = encode_position(message, reverse, self.key_field)
+        return replace_query_param(url, self.cursor_query_param, token)
+
+    def decode_cursor(self, request):
+        """Return (sent_at, message_id, reverse) or None when no cursor was sent"""
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        return decode_position(token, self.invalid_cursor_message, self.key_field)
+
+
+def encode_position(message, reverse=False, key_field='sent_at'):
+    """Opaque token for the (key_field, message_id) position of a message or .values() row"""
+    if isinstance(message, dict):
+        key, message_id = message[key_field], message['message_id']
+    else:
+        key, message_id = getattr(message, key_field), message.message_id
+    key = repr(key) if key_field == SEARCH_RANK else key.isoformat()
+    position = f"{key}|{message_id.hex}|{int(reverse)}"
+    return base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+
+def decode_position(token, invalid_message='Invalid cursor', key_field='sent_at'):
+    """Return (key, message_id, reverse) from a token, raising NotFound if it is malformed"""
+    try:
+        position = base64.urlsafe_b64decode(parse.unquote(token).encode('ascii')).decode('ascii')
+        key, message_id, reverse = position.split('|')
+        key = float(key) if key_field == SEARCH_RANK else parse_datetime(key)
+        message_id = uuid.UUID(message_id)
+        reverse = bool(int(reverse))
+    except (TypeError, ValueError, UnicodeError, binascii.Error):
+        raise NotFound(invalid_message)
+
+    if key is None:
+        raise NotFound(invalid_message)
+    return key, message_id, reverse
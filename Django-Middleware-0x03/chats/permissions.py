@@ -1,6 +1,7 @@
 from rest_framework.permissions import BasePermission
 from .models import Conversation, Message
 from rest_framework import permissions
+from .membership import is_participant
 
 class IsParticipantOfConversation(BasePermission):
     """
@@ -18,11 +19,11 @@ class IsParticipantOfConversation(BasePermission):
         
         # Everyone can view if they are the participant
         if request.method in ['GET', 'HEAD', 'OPTIONS']:
-            return request.user in obj.participants_id.all()
+            return is_participant(request, obj.pk)
         
         # Only the participant can modify or delete
         if request.method in ['PUT', 'PATCH', 'DELETE']:
-            return request.user in obj.participants_id.all()
+            return is_participant(request, obj.pk)
         
         return False
 
@@ -40,7 +41,7 @@ class CanAccessMessagesInUserConversations(BasePermission):
         # Step 2: Check if this message is in a conversation the user is part of
         # obj is the message we're trying to access
         if isinstance(obj, Message):
-            return request.user in obj.conversation.participants_id.all()
+            return is_participant(request, obj.conversation_id)
         return False
 
 
@@ -57,7 +58,7 @@ class CanOnlyEditOwnMessages(BasePermission):
         
         # For viewing: check if user is in the conversation
         if request.method in ['GET', 'HEAD', 'OPTIONS']:
-            return request.user in obj.conversation.participants_id.all()
+            return is_participant(request, obj.conversation_id)
         
         # For editing/deleting: must be the person who sent the message
-        return obj.sender_id == request.user
\ No newline at end of file
+        return obj.sender_id_id == request.user.pk
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""
+Rate limiting backends for OffensiveLanguageMiddleware.
+
+Both backends implement the sliding-window counter: a hit is allowed when
+    previous_window_count * (share of the previous window still in range)
+    + current_window_count < limit
+which needs two counters per key and O(1) work per hit.
+
+Configure the backend like CACHES:
+
+    CHATS_RATE_LIMITER = {
+        'BACKEND': 'chats.ratelimit.CacheRateLimiter',
+        'OPTIONS': {'cache_alias': 'default'},
+    }
+
+InMemoryRateLimiter (the default) is per process; CacheRateLimiter shares
+its counters through any Django cache, e.g. Redis, between workers and pods.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class InMemoryRateLimiter:
+    """
+    Per-process limiter keeping at most `max_keys` keys; the least recently
+    seen key is evicted first, so idle IPs and users don't accumulate.
+    """
+
+    def __init__(self, max_keys=10000, clock=time.time):
+        self.max_keys = max_keys
+        self.clock = clock
+        # key -> [window index, previous window count, current window count]
+        self.counters = OrderedDict()
+        self.lock = threading.Lock()
+
+    def hit(self, key, limit, window):
+        """Record a hit for `key` and return False if it is over `limit` per `window` seconds"""
+        now = self.clock()
+        current_window = int(now // window)
+
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = self.counters[key] = [current_window, 0, 0]
+                if len(self.counters) > self.max_keys:
+                    self.counters.popitem(last=False)
+            else:
+                self.counters.move_to_end(key)
+
+            if counter[0] != current_window:
+                # Roll forward; anything older than the previous window no longer counts
+                counter[1] = counter[2] if counter[0] == current_window - 1 else 0
+                counter[2] = 0
+                counter[0] = current_window
+
+            if sliding_count(counter[1], counter[2], now, window) >= limit:
+                return False
+            counter[2] += 1
+            return True
+
+    async def ahit(self, key, limit, window):
+        """Async hit(); in-memory counters never block, so no thread is needed"""
+        return self.hit(key, limit, window)
+
+
+class CacheRateLimiter:
+    """
+    Limiter storing its counters in a Django cache so that all gunicorn
+    workers and pods share them. Each window's counter expires on its own.
+    """
+
+    def __init__(self, cache_alias='default', key_prefix='chats:ratelimit', clock=time.time):
+        self.cache = caches[cache_alias]
+        self.key_prefix = key_prefix
+        self.clock = clock
+
+    def window_keys(self, key, now, window):
+        """Cache keys of the previous and current window counters of `key`"""
+        current_window = int(now // window)
+        return (
+            f"{self.key_prefix}:{key}:{current_window - 1}",
+            f"{self.key_prefix}:{key}:{current_window}",
+        )
+
+    def hit(self, key, limit, window):
+        """Record a hit for `key` and return False if it is over `limit` per `window` seconds"""
+        now = self.clock()
+        previous_key, current_key = self.window_keys(key, now, window)
+
+        counts = self.cache.get_many([previous_key, current_key])
+        if sliding_count(counts.get(previous_key, 0), counts.get(current_key, 0), now, window) >= limit:
+            return False
+
+        if not self.cache.add(current_key, 1, timeout=window * 2):
+            try:
+                self.cache.incr(current_key)
+            except ValueError:
+                # Expired between add() and incr()
+                self.cache.set(current_key, 1, timeout=window * 2)
+        return True
+
+    async def ahit(self, key, limit, window):
+        """Async hit() through the cache's async API"""
+        now = self.clock()
+        previous_key, current_key = self.window_keys(key, now, window)
+
+        counts = await self.cache.aget_many([previous_key, current_key])
+        if sliding_count(counts.get(previous_key, 0), counts.get(current_key, 0), now, window) >= limit:
+            return False
+
+        if not await self.cache.aadd(current_key, 1, timeout=window * 2):
+            try:
+                await self.cache.aincr(current_key)
+            except ValueError:
+                await self.cache.aset(current_key, 1, timeout=window * 2)
+        return True
+
+
+def sliding_count(previous, current, now, window):
+    """Estimate the hits in the last `window` seconds from two fixed-window counters"""
+    elapsed = (now % window) / window
+    return previous * (1 - elapsed) + current
+
+
+def get_rate_limiter():
+    """Build the limiter configured by CHATS_RATE_LIMITER"""
+    config = getattr(settings, 'CHATS_RATE_LIMITER', {})
+    backend = import_string(config.get('BACKEND', 'chats.ratelimit.InMemoryRateLimiter'))
+    return backend(**config.get('OPTIONS', {}))
@@ -0,0 +1,231 @@
+"""
+Real-time message delivery over WebSockets.
+
+Clients connect to ``/ws/conversations/<conversation_id>/?token=<access token>``
+(the token may also be sent as an ``Authorization: Bearer`` header) and
+receive every message created in that conversation as a JSON text frame.
+The endpoint is a plain ASGI application mounted by messaging_app.asgi.
+
+Access is checked again before every delivery, so a participant removed
+from the conversation (or whose token was revoked) gets no further
+messages, and the socket is closed once the token expires.
+
+Messages saved by MessageViewSet are published once the transaction
+commits to a channel layer, which fans them out to the subscribers of the
+conversation group. The layer is configured like CACHES:
+
+    CHATS_CHANNEL_LAYER = {
+        'BACKEND': 'chats.realtime.InProcessChannelLayer',
+        'OPTIONS': {'queue_size': 100},
+    }
+
+InProcessChannelLayer only reaches sockets served by the same process; a
+multi-process deployment needs a backend with the same subscribe()/publish()
+interface on top of a shared broker.
+"""
+import asyncio
+import json
+import re
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.http import HttpRequest
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import APIException
+from rest_framework_simplejwt.settings import api_settings
+
+from .auth import authenticate_request
+from .membership import is_participant
+
+CONVERSATION_PATH = re.compile(r'^/ws/conversations/(?P<conversation_id>[0-9a-fA-F-]{32,36})/$')
+
+# WebSocket close codes
+CLOSE_NOT_FOUND = 4404
+CLOSE_FORBIDDEN = 4403
+CLOSE_TOKEN_EXPIRED = 4401
+
+
+def conversation_group(conversation_id):
+    return f"conversation:{conversation_id}"
+
+
+class Subscription:
+    """
+    One socket's inbox. Messages may be delivered from any thread; they are
+    handed to the subscriber's event loop. A subscriber that falls
+    `queue_size` messages behind loses the oldest ones rather than
+    holding up the publisher.
+    """
+
+    def __init__(self, layer, group, queue_size):
+        self.layer = layer
+        self.group = group
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(queue_size)
+
+    def deliver(self, message):
+        self.loop.call_soon_threadsafe(self._put, message)
+
+    def _put(self, message):
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.layer.unsubscribe(self)
+
+
+class InProcessChannelLayer:
+    """
+    Group fan-out between the threads and event loops of one process.
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.groups = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def subscribe(self, group):
+        """Subscribe the running event loop to `group`"""
+        subscription = Subscription(self, group, self.queue_size)
+        with self.lock:
+            self.groups[group].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.groups.get(subscription.group)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.groups[subscription.group]
+
+    def publish(self, group, message):
+        """Send the text `message` to every subscriber of `group`"""
+        with self.lock:
+            subscribers = list(self.groups.get(group, ()))
+        for subscription in subscribers:
+            subscription.deliver(message)
+
+
+_channel_layer = None
+_channel_layer_lock = threading.Lock()
+
+
+def get_channel_layer():
+    """Return the process-wide layer configured by CHATS_CHANNEL_LAYER"""
+    global _channel_layer
+    with _channel_layer_lock:
+        if _channel_layer is None:
+            config = getattr(settings, 'CHATS_CHANNEL_LAYER', {})
+            backend = import_string(config.get('BACKEND', 'chats.realtime.InProcessChannelLayer'))
+            _channel_layer = backend(**config.get('OPTIONS', {}))
+    return _channel_layer
+
+
+def publish_message(conversation_id, data):
+    """
+    Push serialized message `data` to the conversation's sockets once the
+    current transaction commits. It is encoded once for all subscribers.
+    """
+    message = json.dumps({'type': 'message.created', 'conversation_id': str(conversation_id), 'message': data},
+                         default=str)
+    transaction.on_commit(lambda: get_channel_layer().publish(conversation_group(conversation_id), message))
+
+
+def get_token(scope):
+    """Read the access token from ?token= or the Authorization header"""
+    token = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('token')
+    if token:
+        return token[0]
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            parts = value.decode('latin-1').split()
+            if len(parts) == 2:
+                return parts[1]
+    return None
+
+
+def authorize(token, conversation_id):
+    """
+    Authenticate `token` with CustomJWTAuthentication and check that its
+    user takes part in the conversation. Returns the validated token or
+    None.
+    """
+    close_old_connections()
+    try:
+        request = HttpRequest()
+        request.META[api_settings.AUTH_HEADER_NAME] = f"{api_settings.AUTH_HEADER_TYPES[0]} {token}"
+        try:
+            auth_result = authenticate_request(request)
+        except APIException:
+            return None
+        if auth_result is None:
+            return None
+
+        request.user, validated_token = auth_result
+        if not is_participant(request, conversation_id):
+            return None
+        return validated_token
+    finally:
+        close_old_connections()
+
+
+async def websocket_application(scope, receive, send):
+    """ASGI application serving the conversation sockets"""
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    match = CONVERSATION_PATH.match(scope['path'])
+    if match is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+
+    conversation_id = match.group('conversation_id')
+    token = get_token(scope)
+    validated_token = await sync_to_async(authorize)(token, conversation_id) if token else None
+    if validated_token is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+        return
+
+    subscription = get_channel_layer().subscribe(conversation_group(conversation_id))
+    await send({'type': 'websocket.accept'})
+
+    receive_task = asyncio.ensure_future(receive())
+    message_task = asyncio.ensure_future(subscription.get())
+    expiry_task = asyncio.ensure_future(asyncio.sleep(max(validated_token['exp'] - time.time(), 0)))
+    try:
+        while True:
+            done, _ = await asyncio.wait({receive_task, message_task, expiry_task},
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if receive_task in done:
+                # The socket is push-only; anything but a disconnect is ignored
+                if receive_task.result()['type'] == 'websocket.disconnect':
+                    break
+                receive_task = asyncio.ensure_future(receive())
+            if expiry_task in done:
+                await send({'type': 'websocket.close', 'code': CLOSE_TOKEN_EXPIRED})
+                break
+            if message_task in done:
+                # Membership may have changed since the handshake. With
+                # CHATS_MEMBERSHIP_CACHE and CHATS_STATELESS_JWT this check
+                # doesn't touch the database.
+                if await sync_to_async(authorize)(token, conversation_id) is None:
+                    await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+                    break
+                await send({'type': 'websocket.send', 'text': message_task.result()})
+                message_task = asyncio.ensure_future(subscription.get())
+    finally:
+        receive_task.cancel()
+        message_task.cancel()
+        expiry_task.cancel()
+        subscription.close()
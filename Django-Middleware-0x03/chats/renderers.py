@@ -0,0 +1,31 @@
+"""
+orjson-based JSON renderer.
+
+Opt in by listing it first in REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'] or
+in a view's renderer_classes. orjson is an optional dependency: without it
+the renderer behaves exactly like DRF's JSONRenderer.
+"""
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    Renders compact UTF-8 JSON with orjson. Datetimes and the types orjson
+    doesn't know (lazy strings, Decimal, ...) go through DRF's JSONEncoder,
+    so the output matches JSONRenderer. Indented output, as requested by
+    the browsable API, is left to JSONRenderer.
+    """
+    encoder = JSONEncoder()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return orjson.dumps(data, default=self.encoder.default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
@@ -0,0 +1,186 @@
+"""
+Asynchronous request log for RequestLoggingMiddleware.
+
+The request thread only builds a LogRecord and drops it on a bounded queue.
+A background thread formats the records as JSON lines and writes them in
+batches to a size-rotated file, flushing once per batch, so disk I/O never
+runs on the request path. When the queue is full records are dropped and
+counted rather than blocking the request.
+
+Settings (all optional):
+    CHATS_REQUEST_LOG_FILE            path of the log file ("requests.log")
+    CHATS_REQUEST_LOG_MAX_BYTES       rotate after this size (10 MB)
+    CHATS_REQUEST_LOG_BACKUP_COUNT    rotated files to keep (5)
+    CHATS_REQUEST_LOG_QUEUE_SIZE      records buffered before dropping (10000)
+    CHATS_REQUEST_LOG_BATCH_SIZE      records written per flush (256)
+    CHATS_REQUEST_LOG_FLUSH_INTERVAL  seconds to wait for a batch to fill (0.2)
+"""
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+from django.conf import settings
+
+# Put on the queue to make the writer drain what is left and exit
+_STOP = object()
+
+
+class JSONLineFormatter(logging.Formatter):
+    """Format a record whose msg is a dict as one JSON object per line"""
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds')}
+        if isinstance(record.msg, dict):
+            entry.update(record.msg)
+        else:
+            entry['message'] = record.getMessage()
+        return json.dumps(entry, default=str)
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that writes and flushes a whole batch at once"""
+
+    def emit_batch(self, records):
+        try:
+            lines = ''.join(self.format(record) + self.terminator for record in records)
+        except Exception:
+            self.handleError(records[0])
+            return
+
+        self.acquire()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(lines)
+            self.stream.flush()
+            if self.maxBytes and self.stream.tell() >= self.maxBytes:
+                self.doRollover()
+        except Exception:
+            self.handleError(records[0])
+        finally:
+            self.release()
+
+
+class RequestQueueHandler(QueueHandler):
+    """
+    QueueHandler for a same-process queue: records are enqueued untouched
+    (formatting happens on the writer thread) and never block when full.
+    """
+
+    def __init__(self, queue, maxsize):
+        super().__init__(queue)
+        self.maxsize = maxsize
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        # SimpleQueue is unbounded and lock-free; the size check is approximate
+        if self.queue.qsize() >= self.maxsize:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class RequestLogWriter:
+    """
+    Owns the queue, the file handler and the background writer thread.
+    """
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5,
+                 queue_size=10000, batch_size=256, flush_interval=0.2):
+        self.queue = queue.SimpleQueue()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.handler = BatchRotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True
+        )
+        self.handler.setFormatter(JSONLineFormatter())
+        self.queue_handler = RequestQueueHandler(self.queue, queue_size)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='chats-request-log', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Write everything still queued, then stop the thread"""
+        if self._thread is None:
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        self.handler.close()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # Give a batch a short while to fill up before writing it
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not _STOP and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stopping = batch[-1] is _STOP
+            records = [record for record in batch if record is not _STOP]
+            if records:
+                self.handler.emit_batch(records)
+            if stopping:
+                return
+
+
+_writer = None
+_writer_lock = threading.Lock()
+# Loggers the process-wide writer's queue handler is attached to
+_writer_loggers = set()
+
+
+def start_request_log(logger):
+    """
+    Start the process-wide writer (once) and attach its queue handler to `logger`.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = RequestLogWriter(
+                getattr(settings, 'CHATS_REQUEST_LOG_FILE', 'requests.log'),
+                max_bytes=getattr(settings, 'CHATS_REQUEST_LOG_MAX_BYTES', 10 * 1024 * 1024),
+                backup_count=getattr(settings, 'CHATS_REQUEST_LOG_BACKUP_COUNT', 5),
+                queue_size=getattr(settings, 'CHATS_REQUEST_LOG_QUEUE_SIZE', 10000),
+                batch_size=getattr(settings, 'CHATS_REQUEST_LOG_BATCH_SIZE', 256),
+                flush_interval=getattr(settings, 'CHATS_REQUEST_LOG_FLUSH_INTERVAL', 0.2),
+            )
+            _writer.start()
+            atexit.register(_writer.stop)
+        if _writer.queue_handler not in logger.handlers:
+            logger.addHandler(_writer.queue_handler)
+            _writer_loggers.add(logger)
+    return _writer
+
+
+def stop_request_log():
+    """
+    Drain and stop the process-wide writer and detach it from its loggers;
+    the next start_request_log() starts a new one with the current settings.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            return
+        for logger in _writer_loggers:
+            logger.removeHandler(_writer.queue_handler)
+        _writer_loggers.clear()
+        _writer.stop()
+        _writer = None
@@ -0,0 +1,92 @@
+"""
+Response cache for the conversation and message list endpoints.
+
+A list response is stored per user under a key that embeds a version stamp
+of everything it was built from (see chats.versions). Any write bumps a
+version, which changes the key, so entries are never invalidated
+explicitly; stale ones just stop being read and expire. A hit skips the
+queries and the serializer: only the stamp lookups (cache reads) remain.
+
+The cache and the version stamps must be shared by all workers, or the
+others keep serving pages built before a write (see chats.caching). Left
+unset, the alias is 'default' when that cache is shared and caching is off
+otherwise:
+
+    CHATS_RESPONSE_CACHE = 'default'        # alias; None disables caching
+    CHATS_RESPONSE_CACHE_TIMEOUT = 300      # seconds an entry is kept
+
+Hits and misses are counted per endpoint in `response_cache_stats` and
+reported on each response in the X-Cache header.
+"""
+import hashlib
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.response import Response
+
+from .caching import get_shared_cache_alias
+
+
+class ResponseCacheStats:
+    """Thread-safe hit/miss counters per endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+    def record(self, endpoint, hit):
+        with self.lock:
+            self.counts[endpoint]['hits' if hit else 'misses'] += 1
+
+    def snapshot(self):
+        """Return {endpoint: {'hits', 'misses', 'hit_ratio'}}"""
+        with self.lock:
+            return {
+                endpoint: {**counts, 'hit_ratio': counts['hits'] / ((counts['hits'] + counts['misses']) or 1)}
+                for endpoint, counts in self.counts.items()
+            }
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+
+response_cache_stats = ResponseCacheStats()
+
+
+class CachedListMixin:
+    """
+    Serve list() from the response cache. Views implement
+    get_list_cache_stamp(request), returning a string that changes whenever
+    the list could, or None when the request must not be cached. It runs
+    before the cache is read, so it is also where access is checked.
+    """
+
+    def get_list_cache_stamp(self, request):
+        raise NotImplementedError
+
+    def get_list_cache_key(self, request, stamp):
+        query = hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+        return f"chats:response:{self.basename}:{request.user.pk}:{stamp}:{query}"
+
+    def list(self, request, *args, **kwargs):
+        alias = get_shared_cache_alias('CHATS_RESPONSE_CACHE')
+        stamp = self.get_list_cache_stamp(request) if alias else None
+        if stamp is None:
+            return super().list(request, *args, **kwargs)
+
+        cache = caches[alias]
+        key = self.get_list_cache_key(request, stamp)
+        data = cache.get(key)
+        if data is not None:
+            response_cache_stats.record(self.basename, hit=True)
+            return Response(data, headers={'X-Cache': 'HIT'})
+
+        response_cache_stats.record(self.basename, hit=False)
+        response = super().list(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, getattr(settings, 'CHATS_RESPONSE_CACHE_TIMEOUT', 300))
+        response['X-Cache'] = 'MISS'
+        return response
@@ -0,0 +1,42 @@
+"""
+Route policy lookups for the chats middleware, compiled once at startup.
+"""
+
+# Trie node key holding the value stored at that prefix (paths are str,
+# so None can never collide with a character)
+_VALUE = None
+
+
+class PrefixTrie:
+    """
+    Character trie mapping path prefixes to values.
+
+    longest_prefix() walks the path once, so a lookup costs O(len(path))
+    whatever the number of prefixes, and allocates nothing.
+    """
+
+    def __init__(self, mapping=None):
+        self.root = {}
+        for prefix, value in (mapping or {}).items():
+            self.insert(prefix, value)
+
+    def insert(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[_VALUE] = value
+
+    def longest_prefix(self, path, default=None):
+        """Return the value of the longest stored prefix of `path`, or `default`"""
+        node = self.root
+        value = node.get(_VALUE, default)
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            if _VALUE in node:
+                value = node[_VALUE]
+        return value
+
+    def __bool__(self):
+        return bool(self.root)
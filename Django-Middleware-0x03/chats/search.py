@@ -0,0 +1,175 @@
+"""
+Full-text message search.
+
+?search= on the messages endpoints goes through a search backend instead of
+DRF's SearchFilter, whose ILIKE '%term%' over joined tables scans every row.
+A backend filters the queryset to the matching messages and annotates
+SEARCH_RANK (higher is better), which KeysetMessagePagination pages over.
+
+    PostgresMessageSearch      to_tsvector/websearch_to_tsquery, served by the
+                               GIN expression index message_body_search_idx
+    SQLiteFTS5MessageSearch    the chats_message_fts FTS5 table, kept in sync
+                               by triggers (local development and tests)
+    IContainsMessageSearch     unranked icontains on the body, for databases
+                               without either index
+
+Both indexes are created by migration 0007. The FTS5 table is keyed on the
+implicit rowid of chats_message, whose primary key is a UUID, and is kept
+in sync by triggers on that table. A VACUUM can renumber those rowids, and
+a table remake (as Django's SQLite schema editor does for most AlterField
+operations) drops the triggers. After either, rebuild it:
+
+    python manage.py search_index rebuild
+
+The backend is picked from the database vendor unless CHATS_MESSAGE_SEARCH
+names one:
+
+    CHATS_MESSAGE_SEARCH = {
+        'BACKEND': 'chats.search.PostgresMessageSearch',
+        'OPTIONS': {'config': 'english'},
+    }
+"""
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connections, router, transaction
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+from django.utils.module_loading import import_string
+from rest_framework.filters import BaseFilterBackend
+
+SEARCH_RANK = 'search_rank'
+
+FTS5_TABLE = 'chats_message_fts'
+
+# Drops and recreates the FTS5 table and its triggers, then reindexes every
+# message under its current rowid (same definitions as migration 0007)
+FTS5_REBUILD = [
+    f"DROP TRIGGER IF EXISTS {FTS5_TABLE}_insert",
+    f"DROP TRIGGER IF EXISTS {FTS5_TABLE}_delete",
+    f"DROP TRIGGER IF EXISTS {FTS5_TABLE}_update",
+    f"DROP TABLE IF EXISTS {FTS5_TABLE}",
+    f"CREATE VIRTUAL TABLE {FTS5_TABLE} USING fts5("
+    "message_body, content='chats_message', content_rowid='rowid', tokenize='porter unicode61')",
+    f"CREATE TRIGGER {FTS5_TABLE}_insert AFTER INSERT ON chats_message BEGIN "
+    f"INSERT INTO {FTS5_TABLE}(rowid, message_body) VALUES (new.rowid, new.message_body); END",
+    f"CREATE TRIGGER {FTS5_TABLE}_delete AFTER DELETE ON chats_message BEGIN "
+    f"INSERT INTO {FTS5_TABLE}({FTS5_TABLE}, rowid, message_body) "
+    "VALUES ('delete', old.rowid, old.message_body); END",
+    f"CREATE TRIGGER {FTS5_TABLE}_update AFTER UPDATE OF message_body ON chats_message BEGIN "
+    f"INSERT INTO {FTS5_TABLE}({FTS5_TABLE}, rowid, message_body) "
+    "VALUES ('delete', old.rowid, old.message_body); "
+    f"INSERT INTO {FTS5_TABLE}(rowid, message_body) VALUES (new.rowid, new.message_body); END",
+    f"INSERT INTO {FTS5_TABLE}({FTS5_TABLE}) VALUES ('rebuild')",
+]
+
+# Database alias -> whether FTS5_TABLE exists, looked up once per process
+_fts5_tables = {}
+
+
+class PostgresMessageSearch:
+    """
+    The vector expression must stay identical to the one in
+    message_body_search_idx for PostgreSQL to use the index.
+
+    ts_rank returns a float4 while cursors carry the rank back as a Python
+    float, so the rank is cast to double precision; otherwise the keyset
+    comparisons miss or repeat rows between pages.
+    """
+
+    def __init__(self, config='english'):
+        self.config = config
+
+    def search(self, queryset, terms):
+        vector = SearchVector('message_body', config=self.config)
+        query = SearchQuery(terms, config=self.config, search_type='websearch')
+        return (
+            queryset.alias(body_vector=vector)
+            .filter(body_vector=query)
+            .annotate(**{SEARCH_RANK: Cast(SearchRank(vector, query), FloatField())})
+        )
+
+
+class SQLiteFTS5MessageSearch:
+    """
+    Matches against the FTS5 mirror of message_body. bm25() is negated so
+    that, as with ts_rank, a higher rank is a better match.
+    """
+
+    def search(self, queryset, terms):
+        match = self.to_match_expression(terms)
+        if not match:
+            return queryset.none()
+
+        table = queryset.model._meta.db_table
+        matching_rowids = RawSQL(f'SELECT rowid FROM {FTS5_TABLE} WHERE {FTS5_TABLE} MATCH %s', [match])
+        rank = RawSQL(
+            f'-(SELECT bm25({FTS5_TABLE}) FROM {FTS5_TABLE} '
+            f'WHERE {FTS5_TABLE} MATCH %s AND {FTS5_TABLE}.rowid = {table}.rowid)',
+            [match],
+            output_field=FloatField(),
+        )
+        return (
+            queryset.alias(body_rowid=RawSQL(f'{table}.rowid', ()))
+            .filter(body_rowid__in=matching_rowids)
+            .annotate(**{SEARCH_RANK: rank})
+        )
+
+    def to_match_expression(self, terms):
+        """Quote every word so user input can't break the FTS5 query syntax"""
+        words = ['"{}"'.format(word.replace('"', '""')) for word in terms.split()]
+        return ' '.join(words)
+
+
+class IContainsMessageSearch:
+    """Unranked substring match; results keep the sent_at ordering"""
+
+    def search(self, queryset, terms):
+        return queryset.filter(message_body__icontains=terms)
+
+
+def get_message_search(model):
+    """Build the backend from CHATS_MESSAGE_SEARCH, or pick one for the database of `model`"""
+    config = getattr(settings, 'CHATS_MESSAGE_SEARCH', None) or {}
+    if config.get('BACKEND'):
+        return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+    connection = connections[router.db_for_read(model)]
+    if connection.vendor == 'postgresql':
+        return PostgresMessageSearch(**config.get('OPTIONS', {}))
+    if connection.vendor == 'sqlite':
+        if connection.alias not in _fts5_tables:
+            _fts5_tables[connection.alias] = FTS5_TABLE in connection.introspection.table_names()
+        if _fts5_tables[connection.alias]:
+            return SQLiteFTS5MessageSearch()
+    return IContainsMessageSearch()
+
+
+def rebuild_search_index(using='default'):
+    """
+    Recreate the SQLite FTS5 table and triggers and reindex every message.
+    PostgreSQL maintains its expression index itself, so there is nothing
+    to do there. Returns True if an index was rebuilt.
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return False
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        if not cursor.fetchone()[0]:
+            return False
+        for statement in FTS5_REBUILD:
+            cursor.execute(statement)
+    _fts5_tables.pop(using, None)
+    return True
+
+
+class MessageSearchFilter(BaseFilterBackend):
+    """?search= filter backed by the configured full-text search backend"""
+    search_param = 'search'
+
+    def filter_queryset(self, request, queryset, view):
+        terms = request.query_params.get(self.search_param, '').strip()
+        if not terms:
+            return queryset
+        return get_message_search(queryset.model).search(queryset, terms)
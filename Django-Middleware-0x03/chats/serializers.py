@@ -1,14 +1,24 @@
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
 from rest_framework import serializers
-from .models import CustomUser, Message, Conversation
+from .models import ConversationParticipant, CustomUser, Message, Conversation
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth import authenticate
 from rest_framework_simplejwt.tokens import RefreshToken
 import re
+from .auth import add_user_claims
 
 class CustomUserSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, validators=[validate_password])
     confirm_password = serializers.CharField(write_only=True)
-    created_at = serializers.DateTimeField(format="%d %b %Y %H:%M:%S")
+    created_at = serializers.DateTimeField(format="%d %b %Y %H:%M:%S", read_only=True)
+
+    # Checked together in one query by validate(); the database's unique
+    # constraints reject registrations that race past that check
+    unique_fields = ('username', 'email', 'phone_number')
 
     class Meta:
         model = CustomUser
@@ -20,19 +30,15 @@ class CustomUserSerializer(serializers.ModelSerializer):
 
         extra_kwargs = {
             'password': {'write_only': True},
-            'created_at': {'read_only': True},
+            # Drop the per-field UniqueValidators, one query each
+            'username': {'validators': [CustomUser.username_validator]},
+            'email': {'validators': []},
+            'phone_number': {'validators': []},
         }
 
-    def validate_username(self, username):
-        if CustomUser.objects.filter(username=username).exists():
-            raise serializers.ValidationError("A user with this username already exists.")
-        return username
-
     def validate_email(self, email):
-        """Validate email format and uniqueness"""
-        if CustomUser.objects.filter(email=email).exists():
-            raise serializers.ValidationError("A user with this email already exists.")
-        return email
+        """Normalize the email the way create_user() will store it"""
+        return CustomUser.objects.normalize_email(email)
     
     def validate_phone_number(self, phone_number):
         """Validate phone number format if provided"""
@@ -41,24 +47,47 @@ class CustomUserSerializer(serializers.ModelSerializer):
             phone_template = re.compile(r'^\+254\d{9}')
             if not phone_template.match(phone_number):
                 raise serializers.ValidationError("Enter a valid phone number. +254*********")
-            if CustomUser.objects.filter(phone_number=phone_number).exists():
-                raise serializers.ValidationError("A user with this phone_number already exists.")
         return phone_number
     
     def validate(self, validated_data):
-        """Validate password confirmation matches password"""
+        """Validate password confirmation matches password and that the user is new"""
         if validated_data.get('password') != validated_data.get('confirm_password'):
             raise serializers.ValidationError("Password confirmation does not match.")
+        conflicts = self.get_unique_conflicts(validated_data)
+        if conflicts:
+            raise serializers.ValidationError(conflicts)
         return validated_data
+
+    def get_unique_conflicts(self, validated_data):
+        """Return {field: [error]} for every unique value already taken, with a single query"""
+        values = {field: validated_data[field] for field in self.unique_fields if validated_data.get(field)}
+        if not values:
+            return {}
+        condition = Q()
+        for field, value in values.items():
+            condition |= Q(**{field: value})
+        taken = CustomUser.objects.filter(condition)
+        if self.instance is not None:
+            taken = taken.exclude(pk=self.instance.pk)
+
+        conflicts = {}
+        for row in taken.values(*values):
+            for field, value in values.items():
+                if row[field] == value:
+                    conflicts[field] = [f"A user with this {field} already exists."]
+        return conflicts
     
     def create(self, validated_data):
-        """Create user with encrypted password"""
+        """Create user with encrypted password: one hash, one INSERT"""
         validated_data.pop('confirm_password')
-        password = validated_data.pop('password')
-        user = CustomUser.objects.create_user(**validated_data)
-        user.set_password(password)
-        user.save()
-        return user
+        try:
+            with transaction.atomic():
+                return CustomUser.objects.create_user(**validated_data)
+        except IntegrityError:
+            conflicts = self.get_unique_conflicts(validated_data)
+            if not conflicts:
+                raise
+            raise serializers.ValidationError(conflicts)
 
 
 class LoginSerializer(serializers.Serializer):
@@ -78,7 +107,7 @@ class LoginSerializer(serializers.Serializer):
                 if not user.is_active:
                      raise serializers.ValidationError("User account is disabled")
                 
-                refresh = RefreshToken.for_user(user)
+                refresh = add_user_claims(RefreshToken.for_user(user), user)
                 
                 data['user'] = user
                 data['refresh'] = str(refresh)
@@ -89,6 +118,18 @@ class LoginSerializer(serializers.Serializer):
             raise serializers.ValidationError("Both username and password are required")
 
 
+class BulkMessageSerializer(serializers.ListSerializer):
+    """
+    Saves a validated batch of messages with bulk_create: one INSERT per
+    batch_size rows instead of one per message. No post_save signals are sent.
+    """
+    batch_size = 500
+
+    def create(self, validated_data):
+        messages = [Message(**attrs) for attrs in validated_data]
+        return Message.objects.bulk_create(messages, batch_size=self.batch_size)
+
+
 class MessageSerializer(serializers.ModelSerializer):
     sender_name = serializers.SerializerMethodField()
     sent_at = serializers.DateTimeField(format="%d %b %Y %H:%M:%S", read_only=True)
@@ -96,6 +137,7 @@ class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = ['message_id', 'sender_id', 'sender_name', 'message_body', 'sent_at']
+        list_serializer_class = BulkMessageSerializer
 
         extra_kwargs = {
             'message_id': {'read_only': True},
@@ -116,13 +158,36 @@ class MessageSerializer(serializers.ModelSerializer):
         return message_body.strip()
 
 class ConversationSerializer(serializers.ModelSerializer):
-    messages = MessageSerializer(many=True, read_only=True)
+    """
+    Conversation summary: participants, the last message and the unread count.
+    The full history is paged through the nested conversation-messages route.
+    """
+    last_message = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
     participant_name = serializers.SerializerMethodField()
     created_at = serializers.DateTimeField(format="%d %b %Y %H:%M:%S", read_only=True)
+    last_message_at = serializers.DateTimeField(format="%d %b %Y %H:%M:%S", read_only=True)
+    # Annotated by ConversationQuerySet.for_participant; null when absent
+    last_read_at = serializers.DateTimeField(format="%d %b %Y %H:%M:%S", read_only=True, allow_null=True)
+    # Declared explicitly: DRF makes relations with a custom through model read-only
+    participants_id = serializers.PrimaryKeyRelatedField(many=True, queryset=CustomUser.objects.all())
 
     class Meta:
         model = Conversation
-        fields = ['conversation_id', 'participants_id', 'participant_name', 'created_at', 'messages']
+        fields = [
+            'conversation_id', 'participants_id', 'participant_name', 'created_at',
+            'last_message', 'last_message_at', 'message_count', 'unread_count', 'last_read_at',
+        ]
+
+    def get_last_message(self, obj):
+        """Return the newest message from the denormalized last_message"""
+        if obj.last_message is None:
+            return None
+        return MessageSerializer(obj.last_message, context=self.context).data
+
+    def get_unread_count(self, obj):
+        """Return the annotated unread count (0 for freshly created conversations)"""
+        return getattr(obj, 'unread_count', 0)
 
     def get_participant_name(self, obj):
         """Return participant's full name"""
@@ -139,4 +204,104 @@ class ConversationSerializer(serializers.ModelSerializer):
                     f"Participant {participant.username} account is not active."
                 )
 
-        return participants_id
\ No newline at end of file
+        return participants_id
+
+# Read-only fast path for list responses. These build the same output as
+# MessageSerializer/ConversationSerializer straight from .values() rows,
+# skipping the per-field serializer machinery and model instantiation.
+
+MONTH_ABBREVIATIONS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def format_timestamp(value):
+    """Same as DateTimeField(format="%d %b %Y %H:%M:%S") in the current timezone"""
+    if value is None:
+        return None
+    value = timezone.localtime(value)
+    return (
+        f"{value.day:02d} {MONTH_ABBREVIATIONS[value.month - 1]} {value.year} "
+        f"{value.hour:02d}:{value.minute:02d}:{value.second:02d}"
+    )
+
+
+class RowSerializer:
+    """
+    Minimal read-only serializer over .values() rows: only `instance`,
+    `many` and `data` are supported.
+    """
+    values_fields = ()
+
+    def __init__(self, instance=None, many=False, **kwargs):
+        self.instance = instance
+        self.many = many
+
+    @classmethod
+    def rows(cls, queryset):
+        return queryset.values(*cls.values_fields)
+
+    @property
+    def data(self):
+        if self.many:
+            return [self.to_representation(row) for row in self.instance]
+        return self.to_representation(self.instance)
+
+
+class MessageRowSerializer(RowSerializer):
+    values_fields = (
+        'message_id', 'sender_id', 'sender_id__first_name', 'sender_id__last_name', 'message_body', 'sent_at',
+    )
+
+    def to_representation(self, row):
+        return {
+            'message_id': str(row['message_id']),
+            'sender_id': str(row['sender_id']),
+            'sender_name': f"{row['sender_id__first_name']} {row['sender_id__last_name']}",
+            'message_body': row['message_body'],
+            'sent_at': format_timestamp(row['sent_at']),
+        }
+
+
+class ConversationRowSerializer(RowSerializer):
+    """
+    Rows come from ConversationQuerySet.for_participant(); participants of
+    the whole page are loaded with one extra query, like the prefetch.
+    """
+    values_fields = (
+        'conversation_id', 'created_at', 'last_message_at', 'message_count', 'unread_count', 'last_read_at',
+        'last_message__message_id', 'last_message__sender_id', 'last_message__sender_id__first_name',
+        'last_message__sender_id__last_name', 'last_message__message_body', 'last_message__sent_at',
+    )
+
+    @property
+    def data(self):
+        rows = list(self.instance) if self.many else [self.instance]
+        self.participants = defaultdict(list)
+        memberships = ConversationParticipant.objects.filter(
+            conversation_id__in=[row['conversation_id'] for row in rows]
+        ).values_list('conversation_id', 'user_id', 'user__first_name', 'user__last_name')
+        for conversation_id, user_id, first_name, last_name in memberships:
+            self.participants[conversation_id].append((user_id, f"{first_name} {last_name}"))
+        return super().data
+
+    def to_representation(self, row):
+        participants = self.participants[row['conversation_id']]
+        last_message = None
+        if row['last_message__message_id'] is not None:
+            last_message = {
+                'message_id': str(row['last_message__message_id']),
+                'sender_id': str(row['last_message__sender_id']),
+                'sender_name': f"{row['last_message__sender_id__first_name']} {row['last_message__sender_id__last_name']}",
+                'message_body': row['last_message__message_body'],
+                'sent_at': format_timestamp(row['last_message__sent_at']),
+            }
+        return {
+            'conversation_id': str(row['conversation_id']),
+            'participants_id': [str(user_id) for user_id, _ in participants],
+            'participant_name': ', '.join(name for _, name in participants),
+            'created_at': format_timestamp(row['created_at']),
+            'last_message': last_message,
+            'last_message_at': format_timestamp(row['last_message_at']),
+            'message_count': row['message_count'],
+            'unread_count': row['unread_count'],
+            'last_read_at': format_timestamp(row['last_read_at']),
+        }
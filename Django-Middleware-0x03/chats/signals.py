@@ -0,0 +1,107 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from .models import Conversation, ConversationParticipant, CustomUser, Message
+from .membership import invalidate_memberships
+from .auth import revoke_user_claims
+from .versions import bump_conversation_version
+from .activity import record_message_deleted, record_new_messages
+
+
+def bump_versions_on_commit(conversation_ids):
+    """
+    A participant joining or leaving changes the conversation as listed in
+    every member's inbox, so its version moves once the change commits.
+    """
+    for conversation_id in set(conversation_ids):
+        transaction.on_commit(partial(bump_conversation_version, conversation_id))
+
+
+@receiver(m2m_changed, sender=Conversation.participants_id.through)
+def invalidate_participant_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Drop cached membership sets whenever conversation participants change.
+    Handles both conversation.participants_id.* and user.conversations.*.
+    """
+    if reverse:
+        # instance is the user whose conversations changed
+        if action == 'pre_clear':
+            instance._cleared_conversation_ids = list(instance.conversations.values_list('pk', flat=True))
+        elif action in ('post_add', 'post_remove'):
+            invalidate_memberships([instance.pk])
+            bump_versions_on_commit(pk_set)
+        elif action == 'post_clear':
+            invalidate_memberships([instance.pk])
+            bump_versions_on_commit(getattr(instance, '_cleared_conversation_ids', []))
+        return
+
+    if action == 'pre_clear':
+        # pk_set is None on clear, so remember who is about to be removed
+        instance._cleared_participant_ids = list(instance.participants_id.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        invalidate_memberships(pk_set)
+        bump_versions_on_commit([instance.pk])
+    elif action == 'post_clear':
+        invalidate_memberships(getattr(instance, '_cleared_participant_ids', []))
+        bump_versions_on_commit([instance.pk])
+
+
+@receiver(post_save, sender=ConversationParticipant)
+def invalidate_membership_on_participant_create(sender, instance, created, **kwargs):
+    """
+    Memberships created through ConversationParticipant directly don't send
+    m2m_changed. Read-state saves leave the cached set alone.
+    """
+    if created:
+        invalidate_memberships([instance.user_id])
+        bump_versions_on_commit([instance.conversation_id])
+
+
+@receiver(post_delete, sender=ConversationParticipant)
+def invalidate_membership_on_participant_delete(sender, instance, **kwargs):
+    invalidate_memberships([instance.user_id])
+    bump_versions_on_commit([instance.conversation_id])
+
+
+@receiver(pre_delete, sender=Conversation)
+def invalidate_memberships_on_conversation_delete(sender, instance, **kwargs):
+    """
+    Cascading deletes don't send m2m_changed, so drop the participants'
+    cached sets before the conversation goes away.
+    """
+    invalidate_memberships(instance.participants_id.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def revoke_claims_on_user_change(sender, instance, created=False, **kwargs):
+    """
+    Any change to a user (deactivation, role or name edits) or its deletion
+    makes the claims in already-issued tokens stale.
+    """
+    if not created:
+        revoke_user_claims(instance.pk)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def bump_version_on_message_change(sender, instance, **kwargs):
+    """
+    New, edited and deleted messages all change what a poller would see.
+    The bump waits for the commit so no one re-queries before the row is visible.
+    """
+    transaction.on_commit(partial(bump_conversation_version, instance.conversation_id))
+
+
+@receiver(post_save, sender=Message)
+def record_activity_on_message_create(sender, instance, created, **kwargs):
+    """Count the new message and make it the conversation's last one"""
+    if created:
+        record_new_messages(instance.conversation_id, instance)
+
+
+@receiver(post_delete, sender=Message)
+def record_activity_on_message_delete(sender, instance, **kwargs):
+    record_message_deleted(instance)
@@ -1,3 +1,1097 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from unittest.mock import patch
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .auth import CustomJWTAuthentication, jwt_authenticator
+from .checks import (
+    check_membership_cache, check_response_cache, check_token_revocation_cache, check_version_cache,
+)
+from .middleware import (
+    JWTAuthenticationMiddleware, OffensiveLanguageMiddleware, RequestLoggingMiddleware,
+    RestrictAccessByTimeMiddleware, RolepermissionMiddleware, aget_jwt_user, get_jwt_user,
+)
+from .membership import membership_cache_key
+from .models import Conversation, ConversationParticipant, CustomUser, Message
+from .ratelimit import CacheRateLimiter, InMemoryRateLimiter
+from .renderers import ORJSONRenderer
+from .pagination import encode_position
+from .realtime import (
+    CLOSE_FORBIDDEN, CLOSE_TOKEN_EXPIRED, conversation_group, get_channel_layer, websocket_application,
+)
+from .request_log import RequestLogWriter, start_request_log, stop_request_log
+from .response_cache import response_cache_stats
+from .routing import PrefixTrie
+from .search import SQLiteFTS5MessageSearch, get_message_search
+from .versions import bump_conversation_version, get_conversation_version, wait_for_new_version
+
+# The chats middleware logs to requests.log and blocks requests by wall-clock
+# hour, so API tests run with Django's own middleware only.
+DEFAULT_MIDDLEWARE = [m for m in settings.MIDDLEWARE if not m.startswith('chats.')]
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+# Adds a cache all processes share, for features that refuse a process-local one
+SHARED_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'chats-tests-shared-cache'),
+    },
+}
+
+
+def create_user(username, **extra):
+    return CustomUser.objects.create_user(
+        username=username,
+        password='password123',
+        email=f'{username}@example.com',
+        first_name=username.title(),
+        last_name='Tester',
+        **extra
+    )
+
+
+# Version stamps are bumped on commit, which TestCase never reaches, so the
+# response cache is only enabled where a test drives the commit hooks itself.
+@override_settings(MIDDLEWARE=DEFAULT_MIDDLEWARE, PASSWORD_HASHERS=FAST_HASHERS, CHATS_RESPONSE_CACHE=None)
+class ChatsAPITestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = create_user('alice')
+        self.bob = create_user('bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants_id.set([self.alice, self.bob])
+        self.client.force_authenticate(self.alice)
+
+    def create_messages(self, count, conversation=None, sender=None):
+        """Create `count` messages one second apart, oldest first"""
+        conversation = conversation or self.conversation
+        sender = sender or self.alice
+        start = timezone.now() - timedelta(seconds=count)
+        messages = []
+        for i in range(count):
+            message = Message.objects.create(
+                conversation=conversation, sender_id=sender, message_body=f'message {i}'
+            )
+            Message.objects.filter(pk=message.pk).update(sent_at=start + timedelta(seconds=i))
+            messages.append(message)
+        return messages
+
+    def messages_url(self, conversation=None):
+        conversation = conversation or self.conversation
+        return f'/api/conversations/{conversation.pk}/messages/'
+
+
+class KeysetMessagePaginationTests(ChatsAPITestCase):
+
+    def walk(self, url):
+        """Follow next links to the end, returning every message body seen"""
+        bodies = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            bodies.extend(item['message_body'] for item in response.data['results'])
+            url = response.data['next']
+        return bodies
+
+    def test_pages_cover_every_message_newest_first(self):
+        self.create_messages(25)
+        bodies = self.walk(self.messages_url() + '?page_size=10')
+        self.assertEqual(bodies, [f'message {i}' for i in reversed(range(25))])
+
+    def test_ascending_ordering_and_timestamp_ties(self):
+        self.create_messages(5)
+        Message.objects.update(sent_at=timezone.now())
+        bodies = self.walk(self.messages_url() + '?ordering=sent_at&page_size=2')
+        self.assertEqual(len(bodies), 5)
+        self.assertEqual(len(set(bodies)), 5)
+
+    def test_previous_link_returns_the_earlier_page(self):
+        self.create_messages(6)
+        first = self.client.get(self.messages_url() + '?page_size=3')
+        second = self.client.get(first.data['next'])
+        self.assertIsNone(first.data['previous'])
+        self.assertIsNone(second.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(back.data['results'], first.data['results'])
+
+    def test_count_is_opt_in(self):
+        self.create_messages(4)
+        self.assertIsNone(self.client.get(self.messages_url()).data['count'])
+        self.assertEqual(self.client.get(self.messages_url() + '?count=exact').data['count'], 4)
+
+        response = self.client.get(self.messages_url() + '?count=estimate')
+        self.assertEqual(response.data['count'], 4)
+        self.assertFalse(response.data['count_capped'])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(self.messages_url() + '?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+    def test_page_number_requests_still_work(self):
+        self.create_messages(3)
+        response = self.client.get(self.messages_url() + '?page=1')
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(len(response.data['results']), 3)
+
+
+class LongPollTests(ChatsAPITestCase):
+
+    def poll(self, since='', **headers):
+        return self.client.get(self.messages_url() + f'?since={since}', **headers)
+
+    def test_returns_only_newer_messages_oldest_first(self):
+        messages = self.create_messages(4)
+        messages[1].refresh_from_db()
+        response = self.poll(encode_position(messages[1]))
+        self.assertEqual([m['message_body'] for m in response.data['results']], ['message 2', 'message 3'])
+        self.assertFalse(response.data['has_more'])
+
+        # The returned position picks up where the last batch ended
+        self.assertEqual(self.poll(response.data['since']).data['results'], [])
+
+    def test_unchanged_conversation_answers_304_without_querying_messages(self):
+        self.create_messages(2)
+        first = self.poll()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.poll(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], first['ETag'])
+        self.assertFalse(any('"chats_message"' in q['sql'] for q in queries.captured_queries))
+
+    def test_new_message_changes_the_etag(self):
+        first = self.poll()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.messages_url(), {'message_body': 'hello'})
+        response = self.poll(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['message_body'] for m in response.data['results']], ['hello'])
+
+    def test_etag_covers_the_query(self):
+        self.create_messages(3)
+        first = self.poll()
+        response = self.client.get(self.messages_url() + '?since=&page_size=1', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+        response = self.client.get(self.messages_url() + '?since=&search=message', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+        # ?wait= doesn't change the response, so it doesn't change the ETag
+        response = self.client.get(self.messages_url() + '?since=&wait=0', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_process_local_version_cache_is_reported(self):
+        self.assertEqual([warning.id for warning in check_version_cache(None)], ['chats.W002'])
+        with override_settings(CACHES=SHARED_CACHES, CHATS_VERSION_CACHE='shared'):
+            self.assertEqual(check_version_cache(None), [])
+
+    @override_settings(CHATS_LONG_POLL_INTERVAL=0.01)
+    def test_wait_times_out_with_304(self):
+        first = self.poll()
+        response = self.client.get(self.messages_url() + '?since=&wait=0.05', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_non_finite_wait_does_not_hold_the_request(self):
+        first = self.poll()
+        for wait in ('nan', 'inf', '-inf'):
+            start = time.monotonic()
+            response = self.client.get(
+                self.messages_url() + f'?since=&wait={wait}', HTTP_IF_NONE_MATCH=first['ETag']
+            )
+            self.assertEqual(response.status_code, 304)
+            self.assertLess(time.monotonic() - start, 1)
+        version = get_conversation_version(self.conversation.pk)
+        self.assertEqual(wait_for_new_version(self.conversation.pk, version, float('nan'), interval=0.01), version)
+
+    def test_wait_for_new_version_wakes_on_bump(self):
+        version = get_conversation_version(self.conversation.pk)
+        timer = threading.Timer(0.05, bump_conversation_version, [self.conversation.pk])
+        timer.start()
+        self.assertNotEqual(wait_for_new_version(self.conversation.pk, version, 5, interval=0.01), version)
+        timer.join()
+
+
+class BulkMessageCreateTests(ChatsAPITestCase):
+
+    def bulk_url(self, conversation=None):
+        return self.messages_url(conversation) + 'bulk/'
+
+    def test_creates_the_batch_with_one_insert(self):
+        payload = [{'message_body': f'imported {i}'} for i in range(50)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.bulk_url(), payload, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([m['message_body'] for m in response.data], [p['message_body'] for p in payload])
+        self.assertEqual(Message.objects.filter(conversation=self.conversation, sender_id=self.alice).count(), 50)
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+
+    def test_sender_names_need_no_query_per_message(self):
+        payload = [{'message_body': f'imported {i}'} for i in range(50)]
+        # membership, then savepoint, INSERT, conversation and read-state
+        # updates, release; the sender is the request user on every instance
+        with self.assertNumQueries(6):
+            response = self.client.post(self.bulk_url(), payload, format='json')
+        self.assertEqual({m['sender_name'] for m in response.data}, {'Alice Tester'})
+
+    def test_one_invalid_message_rejects_the_batch(self):
+        response = self.client.post(self.bulk_url(), [{'message_body': 'ok'}, {'message_body': '  '}], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.exists())
+
+    @override_settings(CHATS_BULK_MESSAGE_MAX_BATCH=2)
+    def test_batch_size_is_capped(self):
+        response = self.client.post(self.bulk_url(), [{'message_body': 'x'}] * 3, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_non_participant_is_refused(self):
+        other = Conversation.objects.create()
+        response = self.client.post(self.bulk_url(other), [{'message_body': 'x'}], format='json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_batch_is_published_and_bumps_the_version(self):
+        version = get_conversation_version(self.conversation.pk)
+        with patch.object(get_channel_layer(), 'publish') as publish, self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.bulk_url(), [{'message_body': 'a'}, {'message_body': 'b'}], format='json')
+        self.assertEqual(publish.call_count, 2)
+        self.assertNotEqual(get_conversation_version(self.conversation.pk), version)
+
+
+class MessageSearchTests(ChatsAPITestCase):
+
+    def search(self, terms, **params):
+        return self.client.get(self.messages_url(), {'search': terms, **params})
+
+    def bodies(self, response):
+        return [m['message_body'] for m in response.data['results']]
+
+    def test_uses_the_fts5_index_with_stemming(self):
+        self.assertIsInstance(get_message_search(Message), SQLiteFTS5MessageSearch)
+        Message.objects.create(conversation=self.conversation, sender_id=self.alice, message_body='Deploying tonight')
+        Message.objects.create(conversation=self.conversation, sender_id=self.alice, message_body='Lunch?')
+        self.assertEqual(self.bodies(self.search('deploy')), ['Deploying tonight'])
+
+    def test_best_matches_come_first(self):
+        for body in ('release notes', 'release release release', 'unrelated'):
+            Message.objects.create(conversation=self.conversation, sender_id=self.alice, message_body=body)
+        self.assertEqual(self.bodies(self.search('release')), ['release release release', 'release notes'])
+
+    def test_ranked_results_page_by_cursor(self):
+        for i in range(7):
+            Message.objects.create(conversation=self.conversation, sender_id=self.alice,
+                                   message_body='ping ' * (i + 1))
+        seen, url, params = [], self.messages_url(), {'search': 'ping', 'page_size': 3}
+        while url:
+            response = self.client.get(url, params)
+            seen.extend(self.bodies(response))
+            url, params = response.data['next'], None
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(len(set(seen)), 7)
+
+    def test_edits_and_deletes_update_the_index(self):
+        message = Message.objects.create(conversation=self.conversation, sender_id=self.alice, message_body='draft')
+        Message.objects.filter(pk=message.pk).update(message_body='final')
+        self.assertEqual(self.bodies(self.search('draft')), [])
+        self.assertEqual(self.bodies(self.search('final')), ['final'])
+        message.delete()
+        self.assertEqual(self.bodies(self.search('final')), [])
+
+    def test_rebuild_restores_an_index_that_lost_its_triggers(self):
+        # what a remake of chats_message leaves behind
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER chats_message_fts_insert')
+        Message.objects.create(conversation=self.conversation, sender_id=self.alice, message_body='after the remake')
+        self.assertEqual(self.bodies(self.search('remake')), [])
+
+        call_command('search_index', 'rebuild', stdout=io.StringIO())
+        self.assertEqual(self.bodies(self.search('remake')), ['after the remake'])
+        Message.objects.create(conversation=self.conversation, sender_id=self.alice, message_body='remake again')
+        self.assertEqual(len(self.bodies(self.search('remake'))), 2)
+
+    def test_query_syntax_in_terms_is_treated_as_text(self):
+        Message.objects.create(conversation=self.conversation, sender_id=self.alice, message_body='say "hi" NEAR me')
+        response = self.search('"hi" NEAR(')
+        self.assertEqual(response.status_code, 200)
+
+    def test_search_is_limited_to_the_conversation(self):
+        other = Conversation.objects.create()
+        other.participants_id.set([self.alice])
+        Message.objects.create(conversation=other, sender_id=self.alice, message_body='secret plan')
+        self.assertEqual(self.bodies(self.search('plan')), [])
+
+
+@override_settings(CHATS_RESPONSE_CACHE='default', CHATS_MEMBERSHIP_CACHE='default')
+class ResponseCacheTests(ChatsAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        response_cache_stats.reset()
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        return response, len(queries)
+
+    def test_repeated_reads_are_served_without_queries(self):
+        self.create_messages(3)
+        for url in (self.messages_url(), '/api/conversations/'):
+            first, _ = self.get(url)
+            second, queries = self.get(url)
+            self.assertEqual((first['X-Cache'], second['X-Cache']), ('MISS', 'HIT'))
+            self.assertEqual(second.data, first.data)
+            self.assertEqual(queries, 0)
+
+        stats = response_cache_stats.snapshot()
+        self.assertEqual(stats['conversation-messages']['hits'], 1)
+        self.assertEqual(stats['conversations']['misses'], 1)
+
+    def test_new_message_invalidates_both_lists(self):
+        self.get(self.messages_url())
+        self.get('/api/conversations/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.messages_url(), {'message_body': 'fresh'})
+
+        response, _ = self.get(self.messages_url())
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][0]['message_body'], 'fresh')
+        response, _ = self.get('/api/conversations/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+
+    def test_mark_read_invalidates_only_the_readers_inbox(self):
+        self.create_messages(1, sender=self.bob)
+        self.get('/api/conversations/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/conversations/{self.conversation.pk}/read/')
+        response, _ = self.get('/api/conversations/')
+        self.assertEqual((response['X-Cache'], response.data['results'][0]['unread_count']), ('MISS', 0))
+
+    def test_participant_changes_invalidate_every_members_inbox(self):
+        carol = create_user('carol')
+        self.get('/api/conversations/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conversation.participants_id.add(carol)
+        response, _ = self.get('/api/conversations/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.data['results'][0]['participants_id']), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            carol.conversations.clear()
+        response, _ = self.get('/api/conversations/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.data['results'][0]['participants_id']), 2)
+
+    def test_responses_are_not_cached_without_a_shared_cache(self):
+        with override_settings():
+            del settings.CHATS_RESPONSE_CACHE
+            response, _ = self.get('/api/conversations/')
+            self.assertEqual(check_response_cache(None), [])
+        self.assertNotIn('X-Cache', response)
+        # naming the process-local cache explicitly is reported
+        self.assertEqual([warning.id for warning in check_response_cache(None)], ['chats.W003'])
+
+    def test_entries_are_per_user_and_respect_membership(self):
+        self.get(self.messages_url())
+        self.client.force_authenticate(create_user('mallory'))
+        self.assertEqual(self.client.get(self.messages_url()).status_code, 403)
+
+
+class RowSerializerTests(ChatsAPITestCase):
+    """The .values() fast path must render exactly what the model serializers do"""
+
+    def assert_same_output(self, url):
+        fast = self.client.get(url)
+        with override_settings(CHATS_FAST_LIST_SERIALIZERS=False):
+            slow = self.client.get(url)
+        self.assertEqual(fast.status_code, 200)
+        self.assertEqual(fast.content, slow.content)
+
+    def test_message_lists_match(self):
+        self.create_messages(3)
+        self.create_messages(2, sender=self.bob)
+        self.assert_same_output(self.messages_url())
+        self.assert_same_output(self.messages_url() + '?search=message')
+
+    def test_conversation_list_matches(self):
+        self.create_messages(2, sender=self.bob)
+        Conversation.objects.create().participants_id.set([self.alice])
+        self.assert_same_output('/api/conversations/')
+
+    def test_orjson_renders_like_json_renderer(self):
+        self.create_messages(2)
+        data = self.client.get(self.messages_url()).data
+        self.assertEqual(json.loads(ORJSONRenderer().render(data)), json.loads(JSONRenderer().render(data)))
+
+
+class ListQueryCountTests(ChatsAPITestCase):
+    """List endpoints must cost the same number of queries whatever the page holds"""
+
+    def count_queries(self, url):
+        # measure with a cold membership cache every time
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def add_conversations(self, count):
+        for _ in range(count):
+            conversation = Conversation.objects.create()
+            conversation.participants_id.set([self.alice, self.bob, create_user(f'user{Conversation.objects.count()}')])
+            self.create_messages(3, conversation=conversation, sender=self.bob)
+
+    def test_conversation_list_query_count_is_constant(self):
+        self.add_conversations(1)
+        baseline = self.count_queries('/api/conversations/')
+        self.add_conversations(8)
+        self.assertEqual(self.count_queries('/api/conversations/'), baseline)
+
+    def test_message_list_query_count_is_constant(self):
+        self.create_messages(2, sender=self.bob)
+        baseline = self.count_queries(self.messages_url() + '?page_size=2')
+        self.create_messages(40, sender=self.bob)
+        self.assertEqual(self.count_queries(self.messages_url() + '?page_size=40'), baseline)
+
+
+class ConversationSummaryTests(ChatsAPITestCase):
+
+    def test_summary_has_last_message_and_no_history(self):
+        self.create_messages(30, sender=self.bob)
+        conversation = self.client.get('/api/conversations/').data['results'][0]
+        self.assertNotIn('messages', conversation)
+        self.assertEqual(conversation['last_message']['message_body'], 'message 29')
+        self.assertCountEqual(conversation['participant_name'].split(', '), ['Alice Tester', 'Bob Tester'])
+
+    def test_posting_marks_the_conversation_read_for_the_sender(self):
+        self.create_messages(3, sender=self.bob)
+        self.assertEqual(self.client.get('/api/conversations/').data['results'][0]['unread_count'], 3)
+
+        self.create_messages(1, sender=self.alice)
+        self.assertEqual(self.client.get('/api/conversations/').data['results'][0]['unread_count'], 0)
+
+        Message.objects.create(conversation=self.conversation, sender_id=self.bob, message_body='new')
+        self.assertEqual(self.client.get('/api/conversations/').data['results'][0]['unread_count'], 1)
+
+    def test_empty_conversation_summary(self):
+        conversation = self.client.get('/api/conversations/').data['results'][0]
+        self.assertIsNone(conversation['last_message'])
+        self.assertEqual(conversation['unread_count'], 0)
+
+
+class ConversationActivityTests(ChatsAPITestCase):
+
+    def post(self, body, conversation=None):
+        return Message.objects.create(conversation=conversation or self.conversation, sender_id=self.alice,
+                                      message_body=body)
+
+    def test_new_messages_update_the_activity_columns(self):
+        first = self.post('one')
+        second = self.post('two')
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 2)
+        self.assertEqual(self.conversation.last_message_id, second.pk)
+        self.assertEqual(self.conversation.last_message_at, second.sent_at)
+        self.assertGreaterEqual(second.sent_at, first.sent_at)
+
+    def test_deleting_the_last_message_falls_back_to_the_previous_one(self):
+        first = self.post('one')
+        second = self.post('two')
+        second.delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.message_count, self.conversation.last_message_id), (1, first.pk))
+
+        first.delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.message_count, self.conversation.last_message_id), (0, None))
+        self.assertIsNone(self.conversation.last_message_at)
+
+    def test_bulk_create_updates_the_activity_columns(self):
+        self.client.post(self.messages_url() + 'bulk/', [{'message_body': 'a'}, {'message_body': 'b'}], format='json')
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 2)
+        self.assertEqual(self.conversation.last_message.message_body, 'b')
+
+    def test_inbox_lists_most_recently_active_first(self):
+        quiet = Conversation.objects.create()
+        quiet.participants_id.set([self.alice])
+        self.post('old news', conversation=quiet)
+        self.post('latest')
+        ids = [c['conversation_id'] for c in self.client.get('/api/conversations/').data['results']]
+        self.assertEqual(ids, [str(self.conversation.pk), str(quiet.pk)])
+
+
+class ReadStateTests(ChatsAPITestCase):
+
+    def read_url(self, conversation=None):
+        return f'/api/conversations/{(conversation or self.conversation).pk}/read/'
+
+    def post(self, body, sender=None):
+        return Message.objects.create(conversation=self.conversation, sender_id=sender or self.bob, message_body=body)
+
+    def membership(self, user=None):
+        return ConversationParticipant.objects.get(conversation=self.conversation, user=user or self.alice)
+
+    def test_messages_from_others_count_as_unread(self):
+        self.post('one')
+        self.post('two')
+        self.assertEqual(self.membership().unread_count, 2)
+        self.assertEqual(self.membership(self.bob).unread_count, 0)
+
+    def test_mark_read_up_to_the_last_message(self):
+        self.post('one')
+        last = self.post('two')
+        response = self.client.post(self.read_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['unread_count'], 0)
+        self.assertEqual(response.data['last_read_message'], last.pk)
+        self.assertEqual(self.client.get('/api/conversations/').data['results'][0]['unread_count'], 0)
+
+    def test_mark_read_up_to_a_given_message_recounts_the_rest(self):
+        first = self.post('one')
+        self.post('two')
+        self.post('three')
+        Message.objects.filter(pk=first.pk).update(sent_at=timezone.now() - timedelta(minutes=1))
+        response = self.client.post(self.read_url(), {'message_id': str(first.pk)})
+        self.assertEqual(response.data['unread_count'], 2)
+
+        # The cursor never moves backwards
+        self.client.post(self.read_url())
+        response = self.client.post(self.read_url(), {'message_id': str(first.pk)})
+        self.assertEqual(response.data['unread_count'], 0)
+
+    def test_deleting_an_unread_message_decrements_the_counter(self):
+        message = self.post('oops')
+        message.delete()
+        self.assertEqual(self.membership().unread_count, 0)
+
+    def test_only_participants_can_mark_read(self):
+        other = Conversation.objects.create()
+        self.assertEqual(self.client.post(self.read_url(other)).status_code, 403)
+
+        foreign = Message.objects.create(conversation=other, sender_id=self.bob, message_body='x')
+        response = self.client.post(self.read_url(), {'message_id': str(foreign.pk)})
+        self.assertEqual(response.status_code, 400)
+
+    def test_malformed_message_id_is_rejected(self):
+        for message_id in ('nope', 12):
+            response = self.client.post(self.read_url(), {'message_id': message_id})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('message_id', response.data)
+
+    def test_conversations_can_still_be_created_with_participants(self):
+        response = self.client.post('/api/conversations/', {'participants_id': [str(self.alice.pk), str(self.bob.pk)]})
+        self.assertEqual(response.status_code, 201)
+        conversation = Conversation.objects.get(pk=response.data['conversation_id'])
+        self.assertCountEqual(conversation.participants_id.all(), [self.alice, self.bob])
+
+
+class MembershipCheckTests(ChatsAPITestCase):
+
+    def test_message_detail_runs_one_membership_query(self):
+        message = self.create_messages(1, sender=self.bob)[0]
+        # membership EXISTS + the message itself; both permission classes reuse the answer
+        with self.assertNumQueries(2):
+            response = self.client.get(f'{self.messages_url()}{message.pk}/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_outsider_cannot_read_or_post(self):
+        self.client.force_authenticate(create_user('mallory'))
+        self.assertEqual(self.client.get(self.messages_url()).status_code, 403)
+        response = self.client.post(self.messages_url(), {'message_body': 'hi'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_participant_can_post(self):
+        response = self.client.post(self.messages_url(), {'message_body': 'hello'})
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Message.objects.filter(conversation=self.conversation, sender_id=self.alice).exists())
+
+    def test_only_sender_can_edit(self):
+        message = self.create_messages(1, sender=self.bob)[0]
+        response = self.client.patch(f'{self.messages_url()}{message.pk}/', {'message_body': 'edited'})
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(CHATS_MEMBERSHIP_CACHE='default')
+class MembershipCacheTests(ChatsAPITestCase):
+
+    def test_warm_cache_skips_membership_query(self):
+        self.client.get(self.messages_url())
+        # only the message page itself
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(self.messages_url()).status_code, 200)
+
+    def test_removed_participant_loses_access(self):
+        self.client.get(self.messages_url())
+        self.conversation.participants_id.remove(self.alice)
+        self.assertEqual(self.client.get(self.messages_url()).status_code, 403)
+
+    def test_set_cached_before_commit_is_dropped_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conversation.participants_id.remove(self.alice)
+            # a concurrent request still sees the old rows and caches them
+            cache.set(membership_cache_key(self.alice.pk), frozenset([self.conversation.pk]))
+        self.assertEqual(self.client.get(self.messages_url()).status_code, 403)
+
+    def test_memberships_are_not_cached_without_a_shared_cache(self):
+        with override_settings():
+            del settings.CHATS_MEMBERSHIP_CACHE
+            self.client.get(self.messages_url())
+            self.assertIsNone(cache.get(membership_cache_key(self.alice.pk)))
+
+    def test_process_local_membership_cache_fails_the_checks(self):
+        self.assertEqual([error.id for error in check_membership_cache(None)], ['chats.E001'])
+
+    def test_cleared_participants_lose_access(self):
+        self.client.get(self.messages_url())
+        self.conversation.participants_id.clear()
+        self.assertEqual(self.client.get(self.messages_url()).status_code, 403)
+
+    def test_added_participant_gains_access(self):
+        carol = create_user('carol')
+        self.client.force_authenticate(carol)
+        self.assertEqual(self.client.get(self.messages_url()).status_code, 403)
+        carol.conversations.add(self.conversation)
+        self.assertEqual(self.client.get(self.messages_url()).status_code, 200)
+
+
+@override_settings(CHATS_STATELESS_JWT=True, CACHES=SHARED_CACHES, CHATS_TOKEN_REVOCATION_CACHE='shared')
+class StatelessJWTTests(ChatsAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        caches['shared'].clear()
+        self.client.force_authenticate(None)
+        response = self.client.post('/api/login/', {'username': 'alice', 'password': 'password123'})
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+
+    def user_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        return response, [q['sql'] for q in context.captured_queries if 'FROM "chats_customuser"' in q['sql']]
+
+    def test_authenticated_read_issues_no_user_query(self):
+        response, queries = self.user_queries(self.messages_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, [])
+
+    def test_token_user_can_post(self):
+        response = self.client.post(self.messages_url(), {'message_body': 'hello'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['sender_name'], 'Alice Tester')
+
+    def test_deactivated_user_is_rejected(self):
+        self.alice.is_active = False
+        self.alice.save()
+        self.assertEqual(self.client.get(self.messages_url()).status_code, 401)
+
+    @override_settings(CHATS_TOKEN_REVOCATION_CACHE='default')
+    def test_claims_are_not_trusted_without_a_shared_revocation_cache(self):
+        response, queries = self.user_queries(self.messages_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([warning.id for warning in check_token_revocation_cache(None)], ['chats.W001'])
+
+
+class RegistrationTests(ChatsAPITestCase):
+    url = '/api-auth/register/'
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(None)
+
+    def payload(self, username, **overrides):
+        return {
+            'username': username, 'email': f'{username}@example.com', 'first_name': 'New', 'last_name': 'User',
+            'phone_number': '+254700000001', 'password': 'Registration-Pa55', 'confirm_password': 'Registration-Pa55',
+            **overrides,
+        }
+
+    def test_registration_checks_uniqueness_once_and_inserts_once(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.url, self.payload('carol'))
+        self.assertEqual(response.status_code, 201, response.data)
+        statements = [q['sql'].split()[0] for q in context.captured_queries if 'chats_customuser' in q['sql']]
+        self.assertEqual(statements, ['SELECT', 'INSERT'])
+        self.assertTrue(CustomUser.objects.get(username='carol').check_password('Registration-Pa55'))
+
+    def test_every_taken_value_is_reported(self):
+        self.client.post(self.url, self.payload('carol'))
+        response = self.client.post(self.url, self.payload('carol', email='CAROL@EXAMPLE.COM'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data), {'username', 'phone_number'})
+
+        response = self.client.post(self.url, self.payload('dave', email='carol@EXAMPLE.COM', phone_number=''))
+        self.assertEqual(set(response.data), {'email'})
+
+    def test_database_constraint_catches_a_race(self):
+        self.client.post(self.url, self.payload('carol'))
+        with patch('chats.serializers.CustomUserSerializer.get_unique_conflicts', side_effect=[{}, {'x': ['taken']}]):
+            response = self.client.post(self.url, self.payload('dave'))
+        self.assertEqual((response.status_code, response.data), (400, {'x': ['taken']}))
+
+    def test_blank_phone_numbers_do_not_collide(self):
+        for username in ('carol', 'dave'):
+            response = self.client.post(self.url, self.payload(username, phone_number=''))
+            self.assertEqual(response.status_code, 201, response.data)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class SharedAuthenticationTests(TestCase):
+
+    def test_token_is_decoded_once_per_request(self):
+        user = create_user('alice')
+        request = RequestFactory().get('/api/conversations/', HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        get_response = lambda request: HttpResponse()
+
+        with patch.object(jwt_authenticator, 'get_validated_token', wraps=jwt_authenticator.get_validated_token) as decode, \
+                patch('chats.middleware.logger'):
+            JWTAuthenticationMiddleware(get_response)(request)
+            RequestLoggingMiddleware(get_response)(request)
+            drf_user, _ = CustomJWTAuthentication().authenticate(Request(request))
+
+        self.assertEqual(decode.call_count, 1)
+        self.assertEqual(request.jwt_user, user)
+        self.assertEqual(drf_user, user)
+
+
+    def test_get_jwt_user_reads_the_user_stored_by_the_middleware(self):
+        user = create_user('alice')
+        request = RequestFactory().get('/api/conversations/', HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        JWTAuthenticationMiddleware(lambda request: HttpResponse())(request)
+
+        request.jwt_user = other = create_user('bob')
+        self.assertEqual(get_jwt_user(request), other)
+        self.assertEqual(async_to_sync(aget_jwt_user)(request), other)
+
+
+class RequestLogWriterTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'requests.log')
+        self.logger = logging.getLogger('chats.tests.request_log')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def start_writer(self, **options):
+        writer = RequestLogWriter(self.path, **options)
+        writer.start()
+        self.logger.addHandler(writer.queue_handler)
+        self.addCleanup(self.logger.removeHandler, writer.queue_handler)
+        return writer
+
+    def test_records_are_written_as_json_lines(self):
+        writer = self.start_writer()
+        for status in (200, 201, 404):
+            self.logger.info({'path': '/api/conversations/', 'status': status, 'latency_ms': 1.5})
+        writer.stop()
+
+        with open(self.path) as log_file:
+            entries = [json.loads(line) for line in log_file]
+        self.assertEqual([entry['status'] for entry in entries], [200, 201, 404])
+        self.assertIn('time', entries[0])
+        self.assertEqual(entries[0]['latency_ms'], 1.5)
+
+    def test_file_rotates_by_size(self):
+        writer = self.start_writer(max_bytes=200, backup_count=2, batch_size=1)
+        for i in range(20):
+            self.logger.info({'path': f'/api/{i}/', 'status': 200})
+        writer.stop()
+        self.assertTrue(os.path.exists(self.path + '.1'))
+
+    def test_stopping_the_process_wide_writer_drains_and_detaches_it(self):
+        stop_request_log()
+        with override_settings(CHATS_REQUEST_LOG_FILE=self.path):
+            writer = start_request_log(self.logger)
+            self.logger.info({'path': '/api/conversations/', 'status': 200})
+            stop_request_log()
+
+        self.assertNotIn(writer.queue_handler, self.logger.handlers)
+        with open(self.path) as log_file:
+            self.assertEqual(len(log_file.readlines()), 1)
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        writer = RequestLogWriter(self.path, queue_size=2)
+        self.logger.addHandler(writer.queue_handler)
+        self.addCleanup(self.logger.removeHandler, writer.queue_handler)
+        for i in range(5):
+            self.logger.info({'path': f'/api/{i}/'})
+        self.assertEqual(writer.queue_handler.dropped, 3)
+
+
+class FakeClock:
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimiterTestsMixin:
+
+    def test_limit_within_window(self):
+        results = [self.limiter.hit('ip:1.2.3.4', 3, 60) for _ in range(4)]
+        self.assertEqual(results, [True, True, True, False])
+
+    def test_previous_window_weighs_in_then_expires(self):
+        for _ in range(3):
+            self.limiter.hit('ip:1.2.3.4', 3, 60)
+        # 30s into the next window half of the previous hits still count
+        self.clock.now = 1290.0
+        self.assertEqual([self.limiter.hit('ip:1.2.3.4', 3, 60) for _ in range(3)], [True, True, False])
+        self.clock.now = 1400.0
+        self.assertTrue(self.limiter.hit('ip:1.2.3.4', 3, 60))
+
+    def test_keys_are_independent(self):
+        self.limiter.hit('ip:1.2.3.4', 1, 60)
+        self.assertFalse(self.limiter.hit('ip:1.2.3.4', 1, 60))
+        self.assertTrue(self.limiter.hit('ip:5.6.7.8', 1, 60))
+
+    async def test_async_hits_share_counters(self):
+        self.assertTrue(await self.limiter.ahit('ip:1.2.3.4', 2, 60))
+        self.assertTrue(self.limiter.hit('ip:1.2.3.4', 2, 60))
+        self.assertFalse(await self.limiter.ahit('ip:1.2.3.4', 2, 60))
+
+
+class InMemoryRateLimiterTests(RateLimiterTestsMixin, TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(1200.0)
+        self.limiter = InMemoryRateLimiter(max_keys=2, clock=self.clock)
+
+    def test_least_recently_seen_key_is_evicted(self):
+        for key in ('a', 'b', 'a', 'c'):
+            self.limiter.hit(key, 5, 60)
+        self.assertEqual(list(self.limiter.counters), ['a', 'c'])
+
+
+class CacheRateLimiterTests(RateLimiterTestsMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.clock = FakeClock(1200.0)
+        self.limiter = CacheRateLimiter(clock=self.clock)
+
+
+@override_settings(
+    CHATS_MESSAGE_RATE_LIMITS={'ip': (3, 60), 'user': (2, 60)},
+    CHATS_RATE_LIMITER={'BACKEND': 'chats.ratelimit.InMemoryRateLimiter'},
+    PASSWORD_HASHERS=FAST_HASHERS,
+)
+class OffensiveLanguageMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.middleware = OffensiveLanguageMiddleware(lambda request: HttpResponse())
+        self.factory = RequestFactory()
+
+    def call(self, request):
+        request.resolver_match = resolve(request.path)
+        response = self.middleware.process_view(request, None, (), {})
+        return (response or self.middleware(request)).status_code
+
+    def post(self, user=None, ip='10.0.0.1'):
+        request = self.factory.post(f'/api/conversations/{uuid.uuid4()}/messages/', REMOTE_ADDR=ip)
+        if user is not None:
+            request.user = user
+        return self.call(request)
+
+    def test_ip_limit(self):
+        self.assertEqual([self.post() for _ in range(4)], [200, 200, 200, 429])
+        self.assertEqual(self.post(ip='10.0.0.2'), 200)
+
+    def test_user_limit_applies_across_ips(self):
+        user = create_user('alice')
+        self.assertEqual(self.post(user, ip='10.0.0.1'), 200)
+        self.assertEqual(self.post(user, ip='10.0.0.2'), 200)
+        self.assertEqual(self.post(user, ip='10.0.0.3'), 429)
+
+    @override_settings(CHATS_URL_RATE_LIMITS={'conversation-messages-bulk': {'user': (1, 60)}})
+    def test_bulk_posts_have_their_own_limit(self):
+        self.middleware = OffensiveLanguageMiddleware(lambda request: HttpResponse())
+        user = create_user('alice')
+        conversation_id = uuid.uuid4()
+
+        def bulk():
+            request = self.factory.post(f'/api/conversations/{conversation_id}/messages/bulk/')
+            request.user = user
+            return self.call(request)
+
+        self.assertEqual([bulk(), bulk()], [200, 429])
+        # single messages keep their own counters
+        self.assertEqual(self.post(user), 200)
+
+    def test_other_requests_are_not_limited(self):
+        for _ in range(5):
+            self.assertEqual(self.call(self.factory.get(f'/api/conversations/{uuid.uuid4()}/messages/')), 200)
+            self.assertEqual(self.call(self.factory.post('/api/conversations/')), 200)
+
+
+class PrefixTrieTests(TestCase):
+
+    def test_longest_prefix_wins(self):
+        trie = PrefixTrie({'/api/': 'api', '/api/admin-actions/': 'admin'})
+        self.assertEqual(trie.longest_prefix('/api/admin-actions/purge/'), 'admin')
+        self.assertEqual(trie.longest_prefix('/api/conversations/'), 'api')
+        self.assertIsNone(trie.longest_prefix('/admin/'))
+        self.assertEqual(trie.longest_prefix('/ap', default='none'), 'none')
+
+
+@override_settings(
+    CHATS_ROLE_PROTECTED_PATHS={'/api/admin-actions/': ['admin']},
+    PASSWORD_HASHERS=FAST_HASHERS,
+)
+class RolepermissionMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.middleware = RolepermissionMiddleware(lambda request: HttpResponse())
+        self.factory = RequestFactory()
+
+    def get(self, path, user=None):
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(user)}'} if user else {}
+        return self.middleware(self.factory.get(path, **headers)).status_code
+
+    def test_protected_path_requires_role(self):
+        self.assertEqual(self.get('/api/admin-actions/purge/'), 401)
+        self.assertEqual(self.get('/api/admin-actions/purge/', create_user('guest')), 403)
+        self.assertEqual(self.get('/api/admin-actions/purge/', create_user('boss', role='admin')), 200)
+
+    def test_other_paths_pass_through(self):
+        self.assertEqual(self.get('/api/conversations/'), 200)
+
+
+async def async_ok(request):
+    return HttpResponse()
+
+
+@override_settings(
+    CHATS_ROLE_PROTECTED_PATHS={'/api/admin-actions/': ['admin']},
+    CHATS_MESSAGE_RATE_LIMITS={'ip': (1, 60), 'user': None},
+    CHATS_RATE_LIMITER={'BACKEND': 'chats.ratelimit.InMemoryRateLimiter'},
+)
+class AsyncMiddlewareTests(TestCase):
+    """Under ASGI the middleware run on the event loop instead of being wrapped in sync_to_async"""
+
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+
+    def test_async_get_response_selects_async_mode(self):
+        for middleware_class in (JWTAuthenticationMiddleware, RequestLoggingMiddleware, RestrictAccessByTimeMiddleware,
+                                 OffensiveLanguageMiddleware, RolepermissionMiddleware):
+            self.assertTrue(iscoroutinefunction(middleware_class(async_ok)), middleware_class)
+            self.assertFalse(iscoroutinefunction(middleware_class(lambda request: HttpResponse())), middleware_class)
+
+    async def test_role_check(self):
+        middleware = RolepermissionMiddleware(async_ok)
+        self.assertEqual((await middleware(self.factory.get('/api/admin-actions/purge/'))).status_code, 401)
+        self.assertEqual((await middleware(self.factory.get('/api/conversations/'))).status_code, 200)
+
+    async def test_rate_limit(self):
+        middleware = OffensiveLanguageMiddleware(async_ok)
+        self.assertTrue(iscoroutinefunction(middleware.process_view))
+        statuses = []
+        for _ in range(2):
+            request = self.factory.post(f'/api/conversations/{uuid.uuid4()}/messages/', REMOTE_ADDR='10.0.0.9')
+            request.resolver_match = resolve(request.path)
+            response = await middleware.process_view(request, None, (), {})
+            statuses.append(response.status_code if response else 200)
+        self.assertEqual(statuses, [200, 429])
+
+    async def test_request_logging(self):
+        middleware = RequestLoggingMiddleware(async_ok)
+        with patch('chats.middleware.logger') as logger:
+            response = await middleware(self.factory.get('/api/conversations/'))
+        self.assertEqual(response.status_code, 200)
+        entry = logger.info.call_args.args[0]
+        self.assertEqual((entry['user'], entry['status']), ('Anonymous', 200))
+
+
+class RealtimeDeliveryTests(ChatsAPITestCase):
+
+    async def connect(self, user, conversation=None, token=None):
+        """Open a socket on websocket_application; returns (task, inbox, sent events)"""
+        conversation = conversation or self.conversation
+        token = token or AccessToken.for_user(user)
+        inbox, sent = asyncio.Queue(), asyncio.Queue()
+        scope = {
+            'type': 'websocket',
+            'path': f'/ws/conversations/{conversation.pk}/',
+            'query_string': f'token={token}'.encode(),
+            'headers': [],
+        }
+        await inbox.put({'type': 'websocket.connect'})
+        task = asyncio.ensure_future(websocket_application(scope, inbox.get, sent.put))
+        return task, inbox, sent
+
+    def test_created_message_is_published_after_commit(self):
+        layer = get_channel_layer()
+        with patch.object(layer, 'publish') as publish, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.messages_url(), {'message_body': 'hello'})
+        self.assertEqual(response.status_code, 201)
+
+        group, text = publish.call_args.args
+        self.assertEqual(group, conversation_group(self.conversation.pk))
+        payload = json.loads(text)
+        self.assertEqual(payload['type'], 'message.created')
+        self.assertEqual(payload['message']['message_body'], 'hello')
+
+    async def test_participant_receives_published_messages(self):
+        task, inbox, sent = await self.connect(self.bob)
+        self.assertEqual((await asyncio.wait_for(sent.get(), 5))['type'], 'websocket.accept')
+
+        get_channel_layer().publish(conversation_group(self.conversation.pk), '{"type": "message.created"}')
+        event = await asyncio.wait_for(sent.get(), 5)
+        self.assertEqual(event, {'type': 'websocket.send', 'text': '{"type": "message.created"}'})
+
+        await inbox.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(task, 5)
+        self.assertNotIn(conversation_group(self.conversation.pk), get_channel_layer().groups)
+
+    async def test_removed_participant_stops_receiving_messages(self):
+        task, inbox, sent = await self.connect(self.bob)
+        self.assertEqual((await asyncio.wait_for(sent.get(), 5))['type'], 'websocket.accept')
+
+        await self.conversation.participants_id.aremove(self.bob)
+        get_channel_layer().publish(conversation_group(self.conversation.pk), '{"type": "message.created"}')
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(await sent.get(), {'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+        self.assertTrue(sent.empty())
+        self.assertNotIn(conversation_group(self.conversation.pk), get_channel_layer().groups)
+
+    async def test_socket_is_closed_when_the_token_expires(self):
+        token = AccessToken.for_user(self.bob)
+        token.set_exp(lifetime=timedelta(seconds=1))
+        task, inbox, sent = await self.connect(self.bob, token=token)
+        self.assertEqual((await asyncio.wait_for(sent.get(), 5))['type'], 'websocket.accept')
+
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(await sent.get(), {'type': 'websocket.close', 'code': CLOSE_TOKEN_EXPIRED})
+
+    async def test_non_participant_is_rejected(self):
+        outsider = await CustomUser.objects.acreate(username='mallory', email='mallory@example.com')
+        task, _, sent = await self.connect(outsider)
+        await asyncio.wait_for(task, 5)
+        self.assertEqual((await sent.get())['type'], 'websocket.close')
@@ -0,0 +1,86 @@
+"""
+Version counters for conversations and users.
+
+Every committed change to a conversation's messages bumps its counter
+(see chats.signals), so "has anything changed since version N?" is a single
+cache read. A user's counter is bumped by changes that only that user sees,
+such as marking a conversation read. The counters back the ETags of the
+long-poll messages mode and the keys of chats.response_cache.
+
+A missing counter (never set, or evicted) is seeded from the clock, so a
+reseeded counter never repeats a version handed out before.
+
+The counters live in the CHATS_VERSION_CACHE alias ('default'). A bump
+only reaches the workers sharing that cache, so with a process-local one
+other workers keep answering 304 and never wake their long polls;
+chats.checks warns about that at startup.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def get_version_cache():
+    return caches[getattr(settings, 'CHATS_VERSION_CACHE', 'default')]
+
+
+def conversation_version_key(conversation_id):
+    return f"chats:conversation-version:{conversation_id}"
+
+
+def user_version_key(user_id):
+    return f"chats:user-version:{user_id}"
+
+
+def get_versions(keys):
+    """Return {key: version} for `keys` with one cache round trip when all are set"""
+    cache = get_version_cache()
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    for key in missing:
+        cache.add(key, time.time_ns(), None)
+    if missing:
+        versions.update(cache.get_many(missing))
+    return versions
+
+
+def bump_version(key):
+    cache = get_version_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), None)
+
+
+def get_conversation_version(conversation_id):
+    key = conversation_version_key(conversation_id)
+    return get_versions([key])[key]
+
+
+def bump_conversation_version(conversation_id):
+    bump_version(conversation_version_key(conversation_id))
+
+
+def get_user_version(user_id):
+    key = user_version_key(user_id)
+    return get_versions([key])[key]
+
+
+def bump_user_version(user_id):
+    bump_version(user_version_key(user_id))
+
+
+def wait_for_new_version(conversation_id, version, timeout, interval=0.5):
+    """
+    Poll the counter until it moves past `version` or `timeout` seconds pass.
+    Returns the latest version; each check is one cache read, no database work.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        current = get_conversation_version(conversation_id)
+        remaining = deadline - time.monotonic()
+        # `not remaining > 0` also ends the wait for a NaN timeout
+        if current != version or not remaining > 0:
+            return current
+        time.sleep(min(interval, remaining))
@@ -1,18 +1,60 @@
 from rest_framework import viewsets, filters, status, mixins
-from .serializers import ConversationSerializer, MessageSerializer, CustomUserSerializer, LoginSerializer
+from .serializers import (
+    ConversationSerializer, MessageSerializer, CustomUserSerializer, LoginSerializer, ConversationRowSerializer,
+    MessageRowSerializer,
+)
 from .models import Conversation, Message
 from rest_framework import serializers
 from . models import CustomUser
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from .permissions import IsParticipantOfConversation, CanAccessMessagesInUserConversations, CanOnlyEditOwnMessages
 from .auth import CustomJWTAuthentication
+from .membership import get_user_conversation_ids, is_participant
+from .realtime import publish_message
 from rest_framework import status
 from rest_framework.response import Response
-from .pagination import CustomMessagePagination
+from .pagination import KeysetMessagePagination, decode_position, encode_position
+from .search import MessageSearchFilter
+from .activity import mark_read, record_new_messages
+from .versions import (
+    bump_conversation_version, bump_user_version, conversation_version_key, get_conversation_version, get_versions,
+    user_version_key, wait_for_new_version,
+)
+from .response_cache import CachedListMixin
+from rest_framework.decorators import action
 from rest_framework.exceptions import PermissionDenied
+from functools import partial
+import hashlib
+import math
+import uuid
+from django.db import transaction
+from django.conf import settings
+from django.db.models import Q
+from django.utils.http import parse_etags, quote_etag, urlencode
 
 
 # Create your views here.
+class RowListMixin:
+    """
+    Serve GET list() through `row_serializer_class`, which builds the
+    response from .values() rows; get_queryset() returns rows when
+    uses_rows() is true. Disabled by CHATS_FAST_LIST_SERIALIZERS = False.
+    """
+    row_serializer_class = None
+
+    def uses_rows(self):
+        request = getattr(self, 'request', None)
+        return (
+            getattr(settings, 'CHATS_FAST_LIST_SERIALIZERS', True)
+            and self.action == 'list' and request is not None and request.method == 'GET'
+        )
+
+    def get_serializer_class(self):
+        if self.uses_rows():
+            return self.row_serializer_class
+        return super().get_serializer_class()
+
+
 class RegisterViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
     queryset = CustomUser.objects.all()
     serializer_class = CustomUserSerializer
@@ -42,35 +84,79 @@ class LoginViewSet(viewsets.ViewSet):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class ConversationViewSet(viewsets.ModelViewSet):
+class ConversationViewSet(CachedListMixin, RowListMixin, viewsets.ModelViewSet):
     queryset = Conversation.objects.all()
     serializer_class = ConversationSerializer
+    row_serializer_class = ConversationRowSerializer
     permission_classes = [IsParticipantOfConversation]
     authentication_classes = [CustomJWTAuthentication]
     
     # Enable filtering, searching, and ordering
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['participants_id__first_name', 'participants_id__last_name', 'participants_id__email']
-    ordering_fields = ['created_at']
-    ordering = ['-created_at']
+    ordering_fields = ['created_at', 'last_message_at']
 
     def get_queryset(self):
-        user = self.request.user
-        return Conversation.objects.filter(participants_id=user).distinct()
+        queryset = Conversation.objects.for_participant(self.request.user).by_activity()
+        if self.uses_rows():
+            return ConversationRowSerializer.rows(queryset)
+        return queryset.with_participants().with_last_message()
+
+    def get_list_cache_stamp(self, request):
+        """
+        The inbox changes with the user's memberships, any of their
+        conversations' versions, or their own read state.
+        """
+        user_id = request.user.pk
+        keys = [conversation_version_key(pk) for pk in sorted(get_user_conversation_ids(user_id))]
+        keys.append(user_version_key(user_id))
+        versions = get_versions(keys)
+        return hashlib.md5('|'.join(f"{key}={versions[key]}" for key in keys).encode('utf-8')).hexdigest()
+
+    @action(detail=True, methods=['post'], url_path='read')
+    def mark_read(self, request, pk=None):
+        """
+        Mark the conversation read up to "message_id" (default: its last
+        message) and return the caller's read state.
+        """
+        if not is_participant(request, pk):
+            raise PermissionDenied("You are not a participant of this conversation")
+
+        message_id = request.data.get('message_id')
+        if message_id:
+            try:
+                message_id = uuid.UUID(str(message_id))
+            except ValueError:
+                raise serializers.ValidationError({'message_id': "Must be a valid UUID."})
+            message = Message.objects.filter(pk=message_id, conversation_id=pk).only('message_id', 'sent_at').first()
+            if message is None:
+                raise serializers.ValidationError({'message_id': "No such message in this conversation."})
+        else:
+            message = Conversation.objects.select_related('last_message').only(
+                'last_message__message_id', 'last_message__sent_at'
+            ).get(pk=pk).last_message
+
+        read_state = mark_read(pk, request.user.pk, message)
+        transaction.on_commit(partial(bump_user_version, request.user.pk))
+        return Response({'conversation_id': pk, **read_state})
 
-class MessageViewSet(viewsets.ModelViewSet):
+class MessageViewSet(CachedListMixin, RowListMixin, viewsets.ModelViewSet):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
+    row_serializer_class = MessageRowSerializer
     permission_classes = [CanAccessMessagesInUserConversations, CanOnlyEditOwnMessages]
     authentication_classes = [CustomJWTAuthentication]
-    pagination_class = CustomMessagePagination
+    pagination_class = KeysetMessagePagination
 
-     # Enable filtering, searching, and ordering
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['message_body', 'sender_id__first_name', 'sender_id__last_name']
+     # Enable filtering, full-text searching, and ordering
+    filter_backends = [MessageSearchFilter, filters.OrderingFilter]
     ordering_fields = ['sent_at']
     ordering = ['-sent_at'] 
 
+    # Long-poll mode: ?since=<cursor>[&wait=<seconds>]
+    since_query_param = 'since'
+    wait_query_param = 'wait'
+
     def get_queryset(self):
         """Filter messages by conversation when accessed through nested route"""
         conversation_pk = self.kwargs.get('conversation_pk')
@@ -78,23 +164,155 @@ class MessageViewSet(viewsets.ModelViewSet):
 
         if conversation_pk:
             # Check if user has access to this conversation
-            if not Conversation.objects.filter(pk=conversation_pk, participants_id=user).exists():
+            if not is_participant(self.request, conversation_pk):
                 raise PermissionDenied("You don't have permission to access this conversation")
-            return Message.objects.filter(conversation_id=conversation_pk, conversation__participants_id=user)
-        return Message.objects.filter(conversation__participants_id=user)
+            queryset = Message.objects.filter(conversation_id=conversation_pk)
+        else:
+            queryset = Message.objects.filter(conversation__participants_id=user)
+
+        if self.uses_rows():
+            return MessageRowSerializer.rows(queryset)
+        return queryset.with_sender()
+
+    def list(self, request, *args, **kwargs):
+        if self.since_query_param in request.query_params and self.kwargs.get('conversation_pk'):
+            return self.list_since(request)
+        return super().list(request, *args, **kwargs)
+
+    def get_list_cache_stamp(self, request):
+        """A conversation's pages change only with its version"""
+        conversation_pk = self.kwargs.get('conversation_pk')
+        if not conversation_pk or not is_participant(request, conversation_pk):
+            # Uncached; the regular path raises the permission error
+            return None
+        return str(get_conversation_version(conversation_pk))
+
+    def list_since(self, request):
+        """
+        Return the messages newer than the ?since= position, oldest first.
+        An empty ?since= starts at the beginning of the conversation; each
+        response carries the position to send next time.
+
+        The response carries an ETag built from the conversation's version
+        counter; a matching If-None-Match gets 304 without querying messages.
+        With ?wait=N the request is held for up to N seconds (capped by
+        CHATS_LONG_POLL_MAX_WAIT) until a new message arrives.
+        """
+        conversation_pk = self.kwargs['conversation_pk']
+        queryset = self.filter_queryset(self.get_queryset())
+        since = request.query_params[self.since_query_param]
+        if since:
+            sent_at, message_id, _ = decode_position(since)
+            queryset = queryset.filter(Q(sent_at__gt=sent_at) | Q(sent_at=sent_at, message_id__gt=message_id))
+        queryset = queryset.order_by('sent_at', 'message_id')
+        wait = self.get_wait(request)
+
+        # Read the version before the rows: a message committed in between
+        # only makes the returned ETag stale, it is never missed.
+        version = get_conversation_version(conversation_pk)
+        if self.etag_matches(request, version):
+            if wait:
+                version = wait_for_new_version(conversation_pk, version, wait, self.get_poll_interval())
+            if self.etag_matches(request, version):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': self.get_etag(request, version)})
+
+        page_size = self.paginator.get_page_size(request)
+        messages = list(queryset[:page_size + 1])
+        if not messages and wait:
+            new_version = wait_for_new_version(conversation_pk, version, wait, self.get_poll_interval())
+            if new_version != version:
+                version = new_version
+                messages = list(queryset[:page_size + 1])
+
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
+        return Response({
+            'since': encode_position(messages[-1]) if messages else since,
+            'has_more': has_more,
+            'results': self.get_serializer(messages, many=True).data,
+        }, headers={'ETag': self.get_etag(request, version)})
+
+    def get_wait(self, request):
+        max_wait = getattr(settings, 'CHATS_LONG_POLL_MAX_WAIT', 25)
+        try:
+            wait = float(request.query_params.get(self.wait_query_param, 0))
+        except ValueError:
+            return 0
+        if not math.isfinite(wait):
+            # NaN slips through min()/max() and would never time out
+            return 0
+        return min(max(wait, 0), max_wait)
+
+    def get_poll_interval(self):
+        return getattr(settings, 'CHATS_LONG_POLL_INTERVAL', 0.5)
+
+    def get_etag(self, request, version):
+        """
+        The version plus every query parameter shaping the response (since,
+        page_size, search, ...); only ?wait= is left out.
+        """
+        params = sorted(
+            (key, value) for key, values in request.query_params.lists()
+            if key != self.wait_query_param for value in values
+        )
+        query = hashlib.md5(urlencode(params).encode('utf-8')).hexdigest()
+        return quote_etag(f"{version}:{query}")
+
+    def etag_matches(self, request, version):
+        etags = parse_etags(request.headers.get('If-None-Match', ''))
+        return '*' in etags or self.get_etag(request, version) in etags
+
+    def check_can_post(self, conversation_pk):
+        """Raise unless the user is a participant of the conversation"""
+        if not is_participant(self.request, conversation_pk):
+            if not Conversation.objects.filter(pk=conversation_pk).exists():
+                raise serializers.ValidationError("Conversation not found")
+            raise PermissionDenied("You don't have permission to post messages in this conversation")
 
     def perform_create(self, serializer):
         """Automatically set the conversation when creating a message through nested route"""
         conversation_pk = self.kwargs.get('conversation_pk')
 
         if conversation_pk:
-            try:
-                conversation = Conversation.objects.get(pk=conversation_pk)
-                # Check if user is participant of the conversation
-                if not conversation.participants_id.filter(user_id=self.request.user.user_id).exists():
-                    raise PermissionDenied("You don't have permission to post messages in this conversation")
-                serializer.save(conversation=conversation, sender_id=self.request.user)
-            except Conversation.DoesNotExist:
-                raise serializers.ValidationError("Conversation not found")
+            # Check if user is participant of the conversation
+            self.check_can_post(conversation_pk)
+            message = serializer.save(conversation_id=conversation_pk, sender_id=self.request.user)
         else:
-            serializer.save(sender_id=self.request.user)
\ No newline at end of file
+            message = serializer.save(sender_id=self.request.user)
+
+        # Push the new message to the conversation's open WebSockets
+        publish_message(message.conversation_id, serializer.data)
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request, conversation_pk=None):
+        """
+        Create a batch of messages in one request: a JSON list of
+        {"message_body": ...} objects, at most CHATS_BULK_MESSAGE_MAX_BATCH.
+
+        The batch costs one membership check and a bulk INSERT; the created
+        messages are returned in the order they were sent.
+        """
+        if conversation_pk is None:
+            raise serializers.ValidationError("Bulk create is only available on a conversation's messages")
+        self.check_can_post(conversation_pk)
+
+        max_batch = getattr(settings, 'CHATS_BULK_MESSAGE_MAX_BATCH', 1000)
+        if not isinstance(request.data, list) or not request.data:
+            raise serializers.ValidationError("Expected a non-empty list of messages.")
+        if len(request.data) > max_batch:
+            raise serializers.ValidationError(f"A batch may contain at most {max_batch} messages.")
+
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            messages = serializer.save(conversation_id=conversation_pk, sender_id=request.user)
+
+            # bulk_create sends no post_save, so do what the signals and
+            # perform_create would have done for each message
+            newest = max(messages, key=lambda message: (message.sent_at, message.pk))
+            record_new_messages(conversation_pk, newest, count=len(messages))
+            transaction.on_commit(partial(bump_conversation_version, conversation_pk))
+            for data in serializer.data:
+                publish_message(conversation_pk, data)
+
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -56,6 +56,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
     # Custom middleware
+    'chats.middleware.JWTAuthenticationMiddleware',
     'chats.middleware.RequestLoggingMiddleware',
     'chats.middleware.RestrictAccessByTimeMiddleware',
     'chats.middleware.OffensiveLanguageMiddleware',
@@ -97,6 +98,13 @@ DATABASES = {
     'default': env.db()
 }
 
+# Without CACHE_URL every process keeps its own LocMemCache, and the chats
+# caches that must be shared by all workers stay off (see chats.caching).
+# Set it (e.g. redis://...) when running several workers or pods.
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://')
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -156,6 +164,62 @@ REST_FRAMEWORK = {
 
 AUTH_USER_MODEL = env('AUTH_USER_MODEL')
 
+# Resolve API users from JWT claims instead of a per-request user query.
+# Needs a shared cache for revocations (CHATS_TOKEN_REVOCATION_CACHE, the
+# default cache if unset); without one the user is loaded as usual.
+CHATS_STATELESS_JWT = env.bool('CHATS_STATELESS_JWT', default=False)
+
+# Message rate limits as {scope: (messages, seconds)}; None disables a scope
+CHATS_MESSAGE_RATE_LIMITS = {
+    'ip': (5, 60),
+    'user': (5, 60),
+}
+
+# URL names whose POSTs count against the message rate limits
+CHATS_RATE_LIMITED_URL_NAMES = ['conversation-messages-list']
+
+# URL names limited separately, with their own counters. A bulk request
+# creates up to CHATS_BULK_MESSAGE_MAX_BATCH messages.
+CHATS_URL_RATE_LIMITS = {
+    'conversation-messages-bulk': {'ip': (2, 60), 'user': (2, 60)},
+}
+
+# Path prefixes only the listed roles may access (longest prefix wins)
+CHATS_ROLE_PROTECTED_PATHS = {
+    '/api/admin-actions/': ['admin', 'moderator'],
+    '/api/messages/delete/': ['admin', 'moderator'],
+}
+
+# Fan-out of new messages to WebSocket subscribers (see chats.realtime).
+# The in-process layer only reaches sockets served by the same process.
+CHATS_CHANNEL_LAYER = {
+    'BACKEND': 'chats.realtime.InProcessChannelLayer',
+    'OPTIONS': {'queue_size': 100},
+}
+
+# Longest a ?since=...&wait= messages request is held open, and how often
+# it checks for new messages meanwhile (seconds). The conversation versions
+# they wait on live in CHATS_VERSION_CACHE ('default'), which must be
+# shared when running several workers.
+CHATS_LONG_POLL_MAX_WAIT = 25
+CHATS_LONG_POLL_INTERVAL = 0.5
+
+# Largest list accepted by POST /api/conversations/<id>/messages/bulk/
+CHATS_BULK_MESSAGE_MAX_BATCH = 1000
+
+# Conversation and message list responses are cached in CHATS_RESPONSE_CACHE
+# (None disables it), which is the default cache when CACHE_URL points at a
+# shared one and off otherwise. Entries are keyed on version stamps, so
+# writes never serve stale pages; the timeout only bounds memory.
+CHATS_RESPONSE_CACHE_TIMEOUT = 300
+
+# Counter storage for the rate limits. Switch to chats.ratelimit.CacheRateLimiter
+# with a shared cache (e.g. Redis) when running several workers or pods.
+CHATS_RATE_LIMITER = {
+    'BACKEND': 'chats.ratelimit.InMemoryRateLimiter',
+    'OPTIONS': {'max_keys': 10000},
+}
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(days=1),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=2),
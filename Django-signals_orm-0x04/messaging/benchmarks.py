@@ -0,0 +1,190 @@
+"""
+Micro-benchmarks for the messaging app, run with ``python manage.py benchmark``.
+
+Every benchmark is a function registered with @benchmark that takes the
+number of iterations and returns (label, seconds per call, queries per call)
+rows. The command runs them against a throwaway test database.
+"""
+import itertools
+import time
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test import override_settings
+
+from .models import Message, Notification
+from .notifications import stop_notification_writer
+from .services import create_messages, edit_messages
+from .threads import PATH_MAX_DEPTH
+
+User = get_user_model()
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Register a benchmark under its function name"""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def measure(label, func, iterations):
+    """Call func `iterations` times and return (label, seconds per call, queries per call)"""
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count_queries):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - start
+    return label, elapsed / iterations, queries / iterations
+
+
+def make_thread(sender, receiver, size, fan_out):
+    """
+    Create a root message and `size` replies under it, each message taking
+    `fan_out` replies before the next one is used (1 gives a single chain).
+    """
+    root = Message.objects.create(sender=sender, receiver=receiver, content='thread root')
+    parents, replies = [root], []
+    for i in range(size):
+        reply = Message(sender=receiver, receiver=sender, content=f'reply {i}', parent_message=parents[i // fan_out])
+        reply.set_thread_position()
+        parents.append(reply)
+        replies.append(reply)
+    Message.objects.bulk_create(replies, batch_size=1000)
+    return root
+
+
+def replies_per_node(message):
+    """The previous get_all_replies(): one query per message in the thread"""
+    replies = []
+    for reply in message.replies.all().select_related("sender").prefetch_related("replies"):
+        replies.append(reply)
+        replies.extend(replies_per_node(reply))
+    return replies
+
+
+@benchmark
+def reply_threads(iterations):
+    """Loading a 10,000-reply thread: a query per message vs one recursive CTE query"""
+    alice = User.objects.create_user(username='bench-thread-alice', password='benchmark-password')
+    bob = User.objects.create_user(username='bench-thread-bob', password='benchmark-password')
+    shapes = {
+        'flat': make_thread(alice, bob, 10000, fan_out=10000),
+        'fan-out 10': make_thread(alice, bob, 10000, fan_out=10),
+    }
+    chain = make_thread(alice, bob, PATH_MAX_DEPTH, fan_out=1)
+
+    rows = []
+    for shape, root in shapes.items():
+        rows.append(measure(f'{shape}, query per message', lambda: replies_per_node(root), iterations))
+        rows.append(measure(f'{shape}, recursive CTE', lambda: root.get_all_replies(), iterations))
+    rows.append(measure(f'chain of {PATH_MAX_DEPTH}, query per message', lambda: replies_per_node(chain), iterations))
+    rows.append(measure(f'chain of {PATH_MAX_DEPTH}, recursive CTE', lambda: chain.get_all_replies(), iterations))
+    return rows
+
+
+@benchmark
+def conversation_threads(iterations):
+    """A conversation of 50 threads, 10,000 messages: each thread's reply tree vs one thread_root/path scan"""
+    alice = User.objects.create_user(username='bench-conversation-alice', password='benchmark-password')
+    bob = User.objects.create_user(username='bench-conversation-bob', password='benchmark-password')
+    for _ in range(50):
+        make_thread(alice, bob, 199, fan_out=10)
+    roots = Message.objects.filter(sender=alice, receiver=bob, parent_message=None)
+
+    def reply_tree_per_thread():
+        messages = []
+        for root in roots.select_related('sender').order_by('timestamp'):
+            messages.append(root)
+            messages.extend(root.get_all_replies())
+        return messages
+
+    def path_scan():
+        return list(Message.objects.threads_of(roots).select_related('sender'))
+
+    return [
+        measure('reply tree per thread', reply_tree_per_thread, iterations),
+        measure('thread_root/path scan', path_scan, iterations),
+    ]
+
+
+@benchmark
+def message_send(iterations):
+    """Sending a message: notification written by the sender vs queued for the background writer"""
+    alice = User.objects.create_user(username='bench-send-alice', password='benchmark-password')
+    bob = User.objects.create_user(username='bench-send-bob', password='benchmark-password')
+
+    def send():
+        with transaction.atomic():
+            Message.objects.create(sender=alice, receiver=bob, content='hello')
+
+    rows = []
+    with override_settings(MESSAGING_NOTIFICATIONS_DEFERRED=False):
+        rows.append(measure('written by the sender', send, iterations))
+    with override_settings(MESSAGING_NOTIFICATIONS_DEFERRED=True):
+        rows.append(measure('queued', send, iterations))
+        stop_notification_writer()
+    assert Notification.objects.count() == 2 * iterations
+    return rows
+
+
+@benchmark
+def message_import(iterations):
+    """Importing and editing messages: save() one by one (1,000) vs the bulk service (100,000)"""
+    alice = User.objects.create_user(username='bench-import-alice', password='benchmark-password')
+    bob = User.objects.create_user(username='bench-import-bob', password='benchmark-password')
+
+    def new_messages(count):
+        return [Message(sender=alice, receiver=bob, content=f'imported {i}') for i in range(count)]
+
+    def one_by_one(messages):
+        with transaction.atomic():
+            for message in messages:
+                message.save()
+
+    def edited(messages):
+        for message in messages:
+            message.content += ' (edited)'
+        return messages
+
+    rows = []
+    with override_settings(MESSAGING_NOTIFICATIONS_DEFERRED=False):
+        small = new_messages(1000)
+        rows.append(('save() one by one', *measure('', lambda: one_by_one(small), 1)[1:], 1000))
+        rows.append(('save() one by one, edits', *measure('', lambda: one_by_one(edited(small)), 1)[1:], 1000))
+    large = new_messages(100000)
+    rows.append(('create_messages', *measure('', lambda: create_messages(large), 1)[1:], 100000))
+    rows.append(('edit_messages', *measure('', lambda: edit_messages(edited(large)), 1)[1:], 100000))
+    return [(f'{label}: {count / seconds:,.0f} messages/s', seconds, queries) for label, seconds, queries, count in rows]
+
+
+@benchmark
+def message_save(iterations):
+    """Saving a loaded message: marking it read vs editing its content"""
+    alice = User.objects.create_user(username='bench-save-alice', password='benchmark-password')
+    bob = User.objects.create_user(username='bench-save-bob', password='benchmark-password')
+    message_id = create_messages([Message(sender=alice, receiver=bob, content='hello')])[0].pk
+    counter = itertools.count()
+
+    def mark_read():
+        message = Message.objects.get(pk=message_id)
+        message.read = not message.read
+        message.save()
+
+    def edit():
+        message = Message.objects.get(pk=message_id)
+        message.content = f'edit {next(counter)}'
+        message.edited_by = alice
+        message.save()
+
+    return [
+        measure('load + mark read', mark_read, iterations),
+        measure('load + edit content', edit, iterations),
+    ]
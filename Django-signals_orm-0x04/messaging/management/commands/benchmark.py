@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from messaging.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Run messaging micro-benchmarks against a throwaway test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help=f"Benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+        parser.add_argument('--iterations', type=int, default=10)
+
+    def handle(self, *args, **options):
+        names = options['names']
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f"Unknown benchmark(s): {', '.join(sorted(unknown))}")
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            for name in names or BENCHMARKS:
+                self.stdout.write(self.style.MIGRATE_HEADING(f"{name}: {BENCHMARKS[name].__doc__}"))
+                for label, seconds, queries in BENCHMARKS[name](options['iterations']):
+                    self.stdout.write(f"  {label:<40} {seconds * 1e3:>10.1f} ms/call {queries:>8.2f} queries/call")
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -1,4 +1,53 @@
-from django.db import models
+from django.db import connections, models
+from django.db.models.expressions import RawSQL
+
+
+class MessageQuerySet(models.QuerySet):
+    """
+    Default queryset for Message.
+    """
+    def replies_to(self, message, max_depth):
+        """
+        Return every reply under `message`, down to `max_depth` levels, as
+        one query: the ids come from a recursive CTE walking parent_message.
+        """
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        meta = self.model._meta
+        table = quote(meta.db_table)
+        pk = quote(meta.pk.column)
+        parent = quote(meta.get_field('parent_message').column)
+        thread = (
+            f"WITH RECURSIVE thread (id, depth) AS ("
+            f"SELECT {pk}, 1 FROM {table} WHERE {parent} = %s "
+            f"UNION ALL "
+            f"SELECT reply.{pk}, thread.depth + 1 FROM {table} reply "
+            f"JOIN thread ON reply.{parent} = thread.id WHERE thread.depth < %s"
+            f") SELECT id FROM thread"
+        )
+        root = meta.pk.get_db_prep_value(message.pk, connection)
+        return self.filter(pk__in=RawSQL(thread, (root, max_depth)))
+
+    def threads_of(self, roots):
+        """
+        Return every message in the threads started by `roots`, in thread
+        order: a range scan of message_thread_path_idx per thread. Paths
+        start with the root's time-ordered segment, so ordering by path
+        also puts older threads first.
+        """
+        return self.filter(thread_root__in=roots).order_by('path')
+
+    def conversation(self, user, other_user):
+        """
+        Return the messages the two users sent each other, in thread order.
+        Replies from other users are left out; a reply between the two in
+        a thread started by someone else is still listed, in its thread's
+        place.
+        """
+        return self.filter(
+            models.Q(sender=user, receiver=other_user) | models.Q(sender=other_user, receiver=user)
+        ).order_by('path')
+
 
 class UnreadMessagesManager(models.Manager):
     """
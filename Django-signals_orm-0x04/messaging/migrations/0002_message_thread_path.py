@@ -0,0 +1,91 @@
+import django.db.models.deletion
+import django.utils.timezone
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.db import migrations, models
+from django.utils.http import int_to_base36
+
+# Frozen copies of messaging.threads as of this migration
+PATH_TIME_DIGITS = 11
+PATH_TIE_DIGITS = 4
+PATH_SEGMENT_LENGTH = PATH_TIME_DIGITS + PATH_TIE_DIGITS
+PATH_MAX_DEPTH = 100
+
+
+def path_segment(timestamp, pk):
+    epoch = datetime(1970, 1, 1, tzinfo=dt_timezone.utc if timestamp.tzinfo else None)
+    micros = (timestamp - epoch) // timedelta(microseconds=1)
+    tie = pk.int % 36 ** PATH_TIE_DIGITS
+    return int_to_base36(micros).zfill(PATH_TIME_DIGITS) + int_to_base36(tie).zfill(PATH_TIE_DIGITS)
+
+
+def backfill_thread_paths(apps, schema_editor):
+    """
+    Walk every thread down from its first message, giving each message the
+    thread_root, path and depth that save() would have given it.
+
+    save() refuses replies nested deeper than PATH_MAX_DEPTH, but older rows
+    may already be. Those are kept (parent_message is untouched) and filed
+    at PATH_MAX_DEPTH next to their parent, so their path still fits the
+    column and sorts right after it.
+    """
+    Message = apps.get_model('messaging', 'Message')
+
+    messages = {}
+    children = defaultdict(list)
+    for message in Message.objects.only('id', 'parent_message', 'timestamp').iterator(chunk_size=2000):
+        messages[message.pk] = message
+        children[message.parent_message_id].append(message)
+
+    stack = [(message, message) for message in children[None]]
+    updated = []
+    while stack:
+        message, root = stack.pop()
+        parent = messages.get(message.parent_message_id)
+        segment = path_segment(message.timestamp, message.pk)
+        message.thread_root_id = root.pk
+        if parent is None:
+            message.path, message.depth = segment, 0
+        elif parent.depth >= PATH_MAX_DEPTH:
+            message.path, message.depth = parent.path[:-PATH_SEGMENT_LENGTH] + segment, parent.depth
+        else:
+            message.path, message.depth = parent.path + segment, parent.depth + 1
+        updated.append(message)
+        stack.extend((reply, root) for reply in children[message.pk])
+
+    Message.objects.bulk_update(updated, ['thread_root', 'path', 'depth'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='path',
+            field=models.CharField(blank=True, default='', editable=False, max_length=1515),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='thread_root',
+            field=models.ForeignKey(blank=True, db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='thread_messages', to='messaging.message'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread_root', 'path'], name='message_thread_path_idx'),
+        ),
+        migrations.RunPython(backfill_thread_paths, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,10 @@
 import uuid
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth import get_user_model
-from .managers import UnreadMessagesManager
+from .managers import MessageQuerySet, UnreadMessagesManager
+from .threads import PATH_MAX_DEPTH, PATH_MAX_LENGTH, build_reply_tree, get_thread_limits, path_segment
 
 User = get_user_model()
 
@@ -14,7 +17,9 @@ class Message(models.Model):
     sender = models.ForeignKey(User, related_name='sent_messages', on_delete=models.CASCADE)
     receiver = models.ForeignKey(User, related_name='received_messages', on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set on creation like auto_now_add, but already when the instance is
+    # built, so the thread path can be derived from it before saving
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
 
     # Unread/read state for inbox filtering
     read = models.BooleanField(default=False)
@@ -33,24 +38,115 @@ class Message(models.Model):
         on_delete=models.CASCADE
     )
 
+    # Position in the thread, set on save (see messaging.threads)
+    thread_root = models.ForeignKey("self", null=True, blank=True, editable=False,
+        related_name="thread_messages",
+        on_delete=models.CASCADE,
+        db_index=False  # covered by message_thread_path_idx
+    )
+    path = models.CharField(max_length=PATH_MAX_LENGTH, blank=True, default="", editable=False)
+    depth = models.PositiveIntegerField(default=0, editable=False)
+
     # Managers
-    objects = models.Manager()  # default
+    objects = MessageQuerySet.as_manager()  # default
     unread = UnreadMessagesManager()  # custom manager
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["thread_root", "path"], name="message_thread_path_idx"),
+        ]
+
     def __str__(self):
         if self.parent_message:
             return f"Reply by {self.sender} to msg-{self.parent_message.id}: {self.content[:20]}"
         return f"From {self.sender.username} to {self.receiver.username}: {self.content[:20]}"
 
-    def get_all_replies(self):
+    # Fields whose stored values are remembered, so edits can be detected
+    # without reading the row again (see get_saved_value())
+    tracked_fields = ("content",)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_values = {
+            name: value for name, value in zip(field_names, values) if name in cls.tracked_fields
+        }
+        return instance
+
+    def save(self, *args, **kwargs):
+        # A deferred path belongs to a saved message, which has one already
+        if "path" not in self.get_deferred_fields() and not self.path:
+            self.set_thread_position()
+        super().save(*args, **kwargs)
+        self.remember_saved_values()
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using, fields, **kwargs)
+        if fields is None:
+            self.remember_saved_values()
+        else:
+            self.remember_saved_values([name for name in fields if name in self.tracked_fields])
+
+    def remember_saved_values(self, field_names=None):
+        """
+        Record the tracked fields (or those of them in `field_names`) as
+        stored. save(), loading and refreshing from the database do this;
+        call it after bulk_create() or a raw update.
+        """
+        if field_names is None:
+            field_names, saved_values = self.tracked_fields, {}
+        else:
+            saved_values = getattr(self, "_saved_values", {})
+        deferred = self.get_deferred_fields()
+        for name in field_names:
+            if name in deferred:
+                saved_values.pop(name, None)
+            else:
+                saved_values[name] = getattr(self, name)
+        self._saved_values = saved_values
+
+    def get_saved_value(self, field_name):
+        """
+        Return the stored value of a tracked field as of the last load or
+        save, or DEFERRED if this instance doesn't know it.
+        """
+        return getattr(self, "_saved_values", {}).get(field_name, models.DEFERRED)
+
+    def set_thread_position(self):
+        """
+        Set thread_root, path and depth from the parent message.
+        save() calls this for new messages; call it before bulk_create().
+        """
+        segment = path_segment(self.timestamp, self.pk)
+        parent = self.parent_message
+        if parent is None:
+            self.thread_root_id, self.path, self.depth = self.pk, segment, 0
+            return
+        if parent.depth >= PATH_MAX_DEPTH:
+            raise ValidationError(f"Replies can't be nested more than {PATH_MAX_DEPTH} levels deep.")
+        self.thread_root_id = parent.thread_root_id
+        self.path = parent.path + segment
+        self.depth = parent.depth + 1
+
+    def get_reply_tree(self, max_depth=None, max_replies=None):
+        """
+        Fetch the whole reply thread under this message in one query and
+        assemble it in memory (see messaging.threads).
+        """
+        max_depth, max_replies = get_thread_limits(max_depth, max_replies)
+        replies = list(
+            Message.objects.replies_to(self, max_depth)
+            .select_related("sender")
+            .order_by("timestamp", "pk")[:max_replies + 1]
+        )
+        truncated = len(replies) > max_replies
+        return build_reply_tree(self, replies[:max_replies], truncated)
+
+    def get_all_replies(self, max_depth=None, max_replies=None):
         """
-        Recursively fetch all replies to this message.
+        Fetch all replies to this message, each followed by its own replies.
         """
-        replies = []
-        for reply in self.replies.all().select_related("sender").prefetch_related("replies"):
-            replies.append(reply)
-            replies.extend(reply.get_all_replies())
-        return replies
+        return list(self.get_reply_tree(max_depth, max_replies))
     
 
 class Notification(models.Model):
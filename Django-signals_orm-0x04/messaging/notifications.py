@@ -0,0 +1,173 @@
+"""
+Deferred notification writes.
+
+Sending a message used to INSERT the receiver's Notification inside the
+message's own save. Now the post_save handler only registers an on_commit
+callback, which puts (user_id, message_id) pairs on a bounded queue; a
+background thread writes them with bulk_create in batches. Notifications
+for a rolled-back message are never queued.
+
+Backpressure: when the queue is full the sending thread waits up to
+MESSAGING_NOTIFICATION_ENQUEUE_TIMEOUT seconds for room, then writes its
+notifications itself. Nothing is dropped; a backlog slows senders down
+instead of growing without bound.
+
+Shutdown: stop_notification_writer() drains the queue before the thread
+exits, and is registered with atexit when the writer starts.
+
+Settings (all optional):
+    MESSAGING_NOTIFICATIONS_DEFERRED        False writes on commit, on the
+                                            sending thread (True)
+    MESSAGING_NOTIFICATION_QUEUE_SIZE       notifications buffered (10000)
+    MESSAGING_NOTIFICATION_BATCH_SIZE       notifications per INSERT (500)
+    MESSAGING_NOTIFICATION_FLUSH_INTERVAL   seconds to wait for a batch
+                                            to fill (0.2)
+    MESSAGING_NOTIFICATION_ENQUEUE_TIMEOUT  seconds to wait for room in a
+                                            full queue (1.0)
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from functools import partial
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connections, transaction
+
+logger = logging.getLogger(__name__)
+
+# Put on the queue to make the writer drain what is left and exit
+_STOP = object()
+
+
+def write_notifications(pairs, batch_size=500):
+    """
+    Create a Notification for every (user_id, message_id) pair. Pairs whose
+    message was deleted in the meantime are skipped.
+    """
+    from .models import Message, Notification
+
+    def build(pairs):
+        return [Notification(user_id=user_id, message_id=message_id) for user_id, message_id in pairs]
+
+    try:
+        with transaction.atomic():
+            Notification.objects.bulk_create(build(pairs), batch_size=batch_size)
+    except IntegrityError:
+        existing = set(
+            Message.objects.filter(pk__in={message_id for _, message_id in pairs}).values_list('pk', flat=True)
+        )
+        Notification.objects.bulk_create(
+            build(pair for pair in pairs if pair[1] in existing), batch_size=batch_size
+        )
+
+
+class NotificationWriter:
+    """
+    Owns the queue and the background thread writing notifications.
+    """
+
+    def __init__(self, queue_size=10000, batch_size=500, flush_interval=0.2, enqueue_timeout=1.0):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        # Notifications written by senders because the queue stayed full
+        self.overflowed = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='messaging-notifications', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Write everything still queued, then stop the thread"""
+        if self._thread is None:
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def put(self, pairs):
+        """Queue (user_id, message_id) pairs, writing them directly if the queue stays full"""
+        for position, pair in enumerate(pairs):
+            try:
+                self.queue.put(pair, timeout=self.enqueue_timeout)
+            except queue.Full:
+                overflow = pairs[position:]
+                self.overflowed += len(overflow)
+                write_notifications(overflow, self.batch_size)
+                return
+
+    def _run(self):
+        try:
+            while True:
+                batch = [self.queue.get()]
+                # Give a batch a short while to fill up before writing it
+                deadline = time.monotonic() + self.flush_interval
+                while batch[-1] is not _STOP and len(batch) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+
+                stopping = batch[-1] is _STOP
+                pairs = [pair for pair in batch if pair is not _STOP]
+                if pairs:
+                    self._write(pairs)
+                if stopping:
+                    return
+        finally:
+            connections.close_all()
+
+    def _write(self, pairs):
+        close_old_connections()
+        try:
+            write_notifications(pairs, self.batch_size)
+        except Exception:
+            logger.exception("Failed to write %d notifications", len(pairs))
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_notification_writer():
+    """Return the process-wide writer, starting it on first use"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = NotificationWriter(
+                queue_size=getattr(settings, 'MESSAGING_NOTIFICATION_QUEUE_SIZE', 10000),
+                batch_size=getattr(settings, 'MESSAGING_NOTIFICATION_BATCH_SIZE', 500),
+                flush_interval=getattr(settings, 'MESSAGING_NOTIFICATION_FLUSH_INTERVAL', 0.2),
+                enqueue_timeout=getattr(settings, 'MESSAGING_NOTIFICATION_ENQUEUE_TIMEOUT', 1.0),
+            )
+            _writer.start()
+            atexit.register(stop_notification_writer)
+    return _writer
+
+
+def stop_notification_writer():
+    """Drain and stop the process-wide writer; the next notification starts a new one"""
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.stop()
+            _writer = None
+
+
+def deliver_notifications(pairs):
+    if getattr(settings, 'MESSAGING_NOTIFICATIONS_DEFERRED', True):
+        get_notification_writer().put(pairs)
+    else:
+        write_notifications(pairs, getattr(settings, 'MESSAGING_NOTIFICATION_BATCH_SIZE', 500))
+
+
+def notify_on_commit(pairs, using=None):
+    """Deliver notifications for (user_id, message_id) pairs once the current transaction commits"""
+    transaction.on_commit(partial(deliver_notifications, list(pairs)), using=using)
@@ -1,6 +1,8 @@
+from django.db.models import DEFERRED
 from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
 from .models import Message, Notification, MessageHistory
+from .notifications import notify_on_commit
 from django.contrib.auth import get_user_model
 User = get_user_model()
 
@@ -8,42 +10,48 @@ User = get_user_model()
 def create_notification_on_new_message(sender, instance, created, **kwargs):
     """
     Signal to create a notification when a new message is sent.
+    The notification is written after the message commits, off the
+    request path (see messaging.notifications).
     """
     if created:
-        Notification.objects.create(
-            user=instance.receiver,
-            message=instance
-        )
+        notify_on_commit([(instance.receiver_id, instance.pk)], using=kwargs.get('using'))
 
 
 @receiver(pre_save, sender=Message)
-def log_message_edit(sender, instance, **kwargs):
+def log_message_edit(sender, instance, update_fields=None, **kwargs):
     """
     Signal to log the old content of a message before it is updated.
     Triggered only if the message already exists and content is being changed.
+    The old content is the value remembered when the message was loaded,
+    so saves that don't touch content cost no extra query.
     """
-    if not instance.pk:
+    if instance._state.adding:
         # Skip if this is a new message
         return
+    if update_fields is not None and 'content' not in update_fields:
+        return
+    if 'content' in instance.get_deferred_fields():
+        # Content was neither loaded nor assigned, so it can't have changed
+        return
 
-    try:
-        # Get the current version from the database
-        existing_message = Message.objects.get(pk=instance.pk)
-
-        # Check if the content is different
-        if existing_message.content != instance.content:
-            # Save old content to MessageHistory
-            MessageHistory.objects.create(
-                message=existing_message,
-                old_content=existing_message.content
-            )
+    old_content = instance.get_saved_value('content')
+    if old_content is DEFERRED:
+        # Instance not loaded from the database: read the stored content
+        old_content = Message.objects.filter(pk=instance.pk).values_list('content', flat=True).first()
+        if old_content is None:
+            return
 
-            # Mark the message as edited
-            instance.edited = True
+    # Check if the content is different
+    if old_content != instance.content:
+        # Save old content to MessageHistory
+        MessageHistory.objects.create(
+            message=instance,
+            old_content=old_content,
+            edited_by_id=instance.edited_by_id,
+        )
 
-    except Message.DoesNotExist:
-        # In case the message is new or doesn't exist in the DB
-        pass
+        # Mark the message as edited
+        instance.edited = True
 
 
 @receiver(post_delete, sender=User)
@@ -1,10 +1,19 @@
-from django.test import TestCase
+from importlib import import_module
+from unittest.mock import patch
+
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.contrib.auth import get_user_model
-from .models import Message, Notification
+from .models import Message, MessageHistory, Notification
+from .notifications import NotificationWriter, write_notifications
+from .services import create_messages, edit_messages
+from .threads import PATH_MAX_DEPTH
 
 User = get_user_model()
 
 
+@override_settings(MESSAGING_NOTIFICATIONS_DEFERRED=False)
 class MessagingSignalTests(TestCase):
 
     def setUp(self):
@@ -15,11 +24,12 @@ class MessagingSignalTests(TestCase):
         """
         Ensure that when a message is sent, a notification is automatically created for the receiver.
         """
-        message = Message.objects.create(
-            sender=self.sender,
-            receiver=self.receiver,
-            content="Hello Bob!"
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.create(
+                sender=self.sender,
+                receiver=self.receiver,
+                content="Hello Bob!"
+            )
 
         # Check that the notification exists
         notification = Notification.objects.filter(user=self.receiver, message=message).first()
@@ -27,3 +37,311 @@ class MessagingSignalTests(TestCase):
         self.assertFalse(notification.is_read)
         self.assertEqual(notification.user, self.receiver)
         self.assertEqual(notification.message, message)
+
+
+    def test_notification_waits_for_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            Message.objects.create(sender=self.sender, receiver=self.receiver, content="Hello Bob!")
+            self.assertFalse(Notification.objects.exists())
+        self.assertEqual(len(callbacks), 1)
+
+    def test_edit_is_logged_from_loaded_content(self):
+        message = Message.objects.create(sender=self.sender, receiver=self.receiver, content="Hello Bob!")
+        message = Message.objects.get(pk=message.pk)
+        message.content = "Hello Bob, again!"
+        message.edited_by = self.sender
+        # History INSERT and message UPDATE, no SELECT of the old content
+        with self.assertNumQueries(2):
+            message.save()
+
+        history = MessageHistory.objects.get(message=message)
+        self.assertEqual((history.old_content, history.edited_by), ("Hello Bob!", self.sender))
+        self.assertTrue(Message.objects.get(pk=message.pk).edited)
+
+        # The saved content is now the remembered one
+        message.save()
+        self.assertEqual(MessageHistory.objects.count(), 1)
+
+    def test_saves_without_content_change_log_nothing(self):
+        message = Message.objects.create(sender=self.sender, receiver=self.receiver, content="Hello Bob!")
+        message = Message.objects.get(pk=message.pk)
+        message.read = True
+        with self.assertNumQueries(1):
+            message.save()
+
+        message = Message.objects.only('read').get(pk=message.pk)
+        message.read = False
+        with self.assertNumQueries(1):
+            message.save(update_fields=['read'])
+        self.assertFalse(MessageHistory.objects.exists())
+        self.assertFalse(Message.objects.get(pk=message.pk).edited)
+
+    def test_edit_of_deferred_content_reads_stored_content(self):
+        message = Message.objects.create(sender=self.sender, receiver=self.receiver, content="Hello Bob!")
+        message = Message.objects.defer('content').get(pk=message.pk)
+        message.content = "Edited"
+        message.save()
+        self.assertEqual(MessageHistory.objects.get(message=message).old_content, "Hello Bob!")
+
+    def test_refresh_from_db_remembers_reloaded_content(self):
+        message = Message.objects.create(sender=self.sender, receiver=self.receiver, content="Hello Bob!")
+        message = Message.objects.get(pk=message.pk)
+        Message.objects.filter(pk=message.pk).update(content="Changed elsewhere")
+
+        message.refresh_from_db()
+        message.read = True
+        message.save()
+        message.refresh_from_db(fields=['content'])
+        message.save()
+        self.assertFalse(MessageHistory.objects.exists())
+        self.assertFalse(Message.objects.get(pk=message.pk).edited)
+
+
+class NotificationWriterTests(TransactionTestCase):
+
+    def setUp(self):
+        self.sender = User.objects.create_user(username='alice', password='password123')
+        self.receiver = User.objects.create_user(username='bob', password='password123')
+        with override_settings(MESSAGING_NOTIFICATIONS_DEFERRED=False):
+            self.messages = [
+                Message.objects.create(sender=self.sender, receiver=self.receiver, content=str(i))
+                for i in range(5)
+            ]
+        Notification.objects.all().delete()
+        self.pairs = [(self.receiver.pk, message.pk) for message in self.messages]
+
+    def test_queued_notifications_are_written_in_batches_and_drained_on_stop(self):
+        writer = NotificationWriter(batch_size=2, flush_interval=0.01)
+        writer.start()
+        writer.put(self.pairs)
+        writer.stop()
+        self.assertEqual(
+            set(Notification.objects.values_list('message', flat=True)), {m.pk for m in self.messages}
+        )
+
+    def test_full_queue_writes_on_the_sending_thread(self):
+        writer = NotificationWriter(queue_size=2, enqueue_timeout=0)
+        writer.put(self.pairs)
+        self.assertEqual((writer.overflowed, Notification.objects.count()), (3, 3))
+
+        writer.start()
+        writer.stop()
+        self.assertEqual(Notification.objects.count(), 5)
+
+    def test_deleted_messages_are_skipped(self):
+        self.messages[0].delete()
+        write_notifications(self.pairs)
+        self.assertEqual(Notification.objects.count(), 4)
+
+
+class ReplyThreadTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='password123')
+        self.bob = User.objects.create_user(username='bob', password='password123')
+        self.root = self.reply(None, 'root')
+
+    def reply(self, parent, content):
+        return Message.objects.create(
+            sender=self.alice, receiver=self.bob, content=content, parent_message=parent
+        )
+
+    def test_whole_thread_is_loaded_with_one_query(self):
+        first = self.reply(self.root, 'first')
+        nested = self.reply(first, 'nested')
+        second = self.reply(self.root, 'second')
+        self.reply(second, 'other thread')
+
+        with self.assertNumQueries(1):
+            replies = self.root.get_all_replies()
+            senders = [reply.sender.username for reply in replies]
+
+        self.assertEqual([r.content for r in replies], ['first', 'nested', 'second', 'other thread'])
+        self.assertEqual(senders, ['alice'] * 4)
+        self.assertEqual([r.tree_depth for r in replies], [1, 2, 1, 2])
+        self.assertEqual(replies[0].children, [nested])
+        self.assertEqual(first.get_all_replies(), [nested])
+
+    def test_saving_a_subtree_keeps_stored_depths(self):
+        first = self.reply(self.root, 'first')
+        nested = self.reply(first, 'nested')
+        self.reply(nested, 'deeper')
+
+        replies = first.get_all_replies()
+        self.assertEqual([(r.tree_depth, r.depth) for r in replies], [(1, 2), (2, 3)])
+        first.save()
+        for reply in replies:
+            reply.save()
+        self.assertEqual(
+            list(Message.objects.order_by('depth').values_list('content', 'depth')),
+            [('root', 0), ('first', 1), ('nested', 2), ('deeper', 3)],
+        )
+        self.assertEqual(self.reply(replies[-1], 'deepest').depth, 4)
+
+    def test_depth_limit(self):
+        parent = self.root
+        for i in range(5):
+            parent = self.reply(parent, f'level {i + 1}')
+        replies = self.root.get_all_replies(max_depth=3)
+        self.assertEqual([r.content for r in replies], ['level 1', 'level 2', 'level 3'])
+
+    def test_size_limit_keeps_the_oldest_replies(self):
+        for i in range(4):
+            self.reply(self.root, f'reply {i}')
+        tree = self.root.get_reply_tree(max_replies=3)
+        self.assertTrue(tree.truncated)
+        self.assertEqual([r.content for r in tree], ['reply 0', 'reply 1', 'reply 2'])
+        self.assertFalse(self.root.get_reply_tree().truncated)
+
+    def test_deep_threads_do_not_recurse(self):
+        parent, chain = self.root, []
+        for i in range(1500):
+            parent = Message(sender=self.alice, receiver=self.bob, content=str(i), parent_message=parent)
+            chain.append(parent)
+        Message.objects.bulk_create(chain)
+        self.assertEqual(len(self.root.get_all_replies(max_depth=2000)), 1500)
+
+
+class ThreadPathTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='password123')
+        self.bob = User.objects.create_user(username='bob', password='password123')
+
+    def message(self, content, parent=None):
+        return Message.objects.create(
+            sender=self.alice, receiver=self.bob, content=content, parent_message=parent
+        )
+
+    def build_threads(self):
+        first = self.message('first')
+        a = self.message('a', first)
+        b = self.message('b', first)
+        self.message('a.1', a)
+        self.message('b.1', b)
+        second = self.message('second')
+        self.message('c', second)
+        self.message('a.2', a)
+        return first, second
+
+    def test_position_is_set_on_save(self):
+        first = self.message('first')
+        reply = self.message('reply', first)
+        nested = self.message('nested', reply)
+        self.assertEqual((first.thread_root_id, first.depth), (first.pk, 0))
+        self.assertEqual((nested.thread_root_id, nested.depth), (first.pk, 2))
+        self.assertTrue(nested.path.startswith(reply.path) and reply.path.startswith(first.path))
+
+        nested.content = 'edited'
+        nested.save()
+        nested.refresh_from_db()
+        self.assertEqual(nested.depth, 2)
+
+    def test_threads_come_back_in_reply_order_from_one_query(self):
+        first, second = self.build_threads()
+        with self.assertNumQueries(1):
+            contents = [m.content for m in Message.objects.threads_of(Message.objects.filter(parent_message=None))]
+        self.assertEqual(contents, ['first', 'a', 'a.1', 'a.2', 'b', 'b.1', 'second', 'c'])
+        self.assertEqual([m.content for m in Message.objects.threads_of([second])], ['second', 'c'])
+
+    def test_conversation_lists_the_two_users_messages_in_thread_order(self):
+        carol = User.objects.create_user(username='carol', password='password123')
+        first, second = self.build_threads()
+        Message.objects.create(sender=carol, receiver=self.alice, content='from carol', parent_message=first)
+        elsewhere = Message.objects.create(sender=carol, receiver=self.bob, content='carol to bob')
+        Message.objects.create(sender=self.bob, receiver=self.alice, content='reply elsewhere', parent_message=elsewhere)
+
+        contents = [m.content for m in Message.objects.conversation(self.bob, self.alice)]
+        self.assertEqual(contents, ['first', 'a', 'a.1', 'a.2', 'b', 'b.1', 'second', 'c', 'reply elsewhere'])
+
+    def test_nesting_is_limited(self):
+        parent = self.message('root')
+        Message.objects.filter(pk=parent.pk).update(depth=PATH_MAX_DEPTH)
+        parent.refresh_from_db()
+        with self.assertRaises(ValidationError):
+            self.message('too deep', parent)
+
+    def test_migration_backfills_existing_threads(self):
+        self.build_threads()
+        expected = list(Message.objects.values_list('pk', 'thread_root', 'path', 'depth').order_by('pk'))
+        Message.objects.update(thread_root=None, path='', depth=0)
+
+        migration = import_module('messaging.migrations.0002_message_thread_path')
+        migration.backfill_thread_paths(apps, None)
+        self.assertEqual(list(Message.objects.values_list('pk', 'thread_root', 'path', 'depth').order_by('pk')), expected)
+
+    def test_migration_caps_threads_nested_too_deep(self):
+        root = self.message('root')
+        parent = root
+        for i in range(4):
+            parent = self.message(f'reply {i}', parent)
+        Message.objects.update(thread_root=None, path='', depth=0)
+
+        migration = import_module('messaging.migrations.0002_message_thread_path')
+        with patch.object(migration, 'PATH_MAX_DEPTH', 2):
+            migration.backfill_thread_paths(apps, None)
+
+        thread = list(Message.objects.filter(thread_root=root).order_by('path'))
+        self.assertEqual([m.content for m in thread], ['root', 'reply 0', 'reply 1', 'reply 2', 'reply 3'])
+        self.assertEqual([m.depth for m in thread], [0, 1, 2, 2, 2])
+        self.assertTrue(all(len(m.path) == migration.PATH_SEGMENT_LENGTH * (m.depth + 1) for m in thread))
+        self.assertEqual(thread[-1].parent_message_id, thread[-2].pk)
+
+
+class MessageServiceTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='password123')
+        self.bob = User.objects.create_user(username='bob', password='password123')
+
+    def new(self, content, parent=None, **fields):
+        return Message(sender=self.alice, receiver=self.bob, content=content, parent_message=parent, **fields)
+
+    def test_create_messages_matches_saving_one_by_one(self):
+        saved = Message.objects.create(sender=self.alice, receiver=self.bob, content='saved')
+        root = self.new('root')
+        reply = self.new('reply', root)
+        nested = self.new('nested', reply)
+        to_saved = self.new('to saved', parent_message_id=saved.pk)
+        batch = [nested, to_saved, reply, root] + [self.new(f'bulk {i}') for i in range(50)]
+
+        # the parent of to_saved, then a savepoint around the messages and
+        # notifications
+        with self.assertNumQueries(5):
+            create_messages(batch, batch_size=100)
+
+        self.assertEqual(Notification.objects.filter(user=self.bob).count(), len(batch))
+        self.assertEqual((nested.thread_root_id, nested.depth), (root.pk, 2))
+        self.assertEqual((to_saved.thread_root_id, to_saved.depth), (saved.pk, 1))
+        self.assertEqual(
+            [m.content for m in Message.objects.threads_of([root])], ['root', 'reply', 'nested']
+        )
+
+    def test_edit_messages_records_history_for_changed_content(self):
+        messages = create_messages([self.new(f'message {i}') for i in range(3)])
+        messages[0].content = 'edited'
+        messages[2].content = 'edited too'
+
+        # old contents, history and the update, inside a savepoint
+        with self.assertNumQueries(5):
+            changed = edit_messages(messages, edited_by=self.alice)
+
+        self.assertEqual(changed, [messages[0], messages[2]])
+        self.assertEqual(
+            sorted(MessageHistory.objects.values_list('old_content', 'edited_by')),
+            [('message 0', self.alice.pk), ('message 2', self.alice.pk)],
+        )
+        self.assertEqual(
+            list(Message.objects.filter(edited=True, edited_by=self.alice).order_by('content').values_list('content', flat=True)),
+            ['edited', 'edited too'],
+        )
+
+    def test_edit_messages_records_each_messages_editor(self):
+        messages = create_messages([self.new('from alice'), self.new('from bob')])
+        messages[0].content, messages[0].edited_by = 'edited by alice', self.alice
+        messages[1].content, messages[1].edited_by = 'edited by bob', self.bob
+        edit_messages(messages)
+        self.assertEqual(
+            sorted(MessageHistory.objects.values_list('old_content', 'edited_by')),
+            [('from alice', self.alice.pk), ('from bob', self.bob.pk)],
+        )
@@ -0,0 +1,105 @@
+"""
+Reply threads.
+
+Every message stores its place in its thread: thread_root (the message that
+started it), depth, and a materialized path. A path is the parent's path
+plus a fixed-width segment that sorts by creation time, so ordering a
+thread by path lists every message right after its parent, siblings
+oldest first. The (thread_root, path) index turns a whole thread into one
+range scan.
+
+Message.get_reply_tree() loads a whole thread with one query (see
+MessageQuerySet.replies_to) and hands the rows to build_reply_tree(), which
+links them under their parents in O(N) without recursion, so deep threads
+can't overflow the stack.
+
+Threads are bounded by two settings:
+
+    MESSAGING_THREAD_MAX_DEPTH = 100        # reply levels below the message
+    MESSAGING_THREAD_MAX_REPLIES = 10000    # replies loaded per thread
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils.http import int_to_base36
+
+DEFAULT_MAX_DEPTH = 100
+DEFAULT_MAX_REPLIES = 10000
+
+# 11 base36 digits of microseconds since the epoch (enough until the year
+# 5000), then 4 from the message id to order messages created at the same
+# microsecond
+PATH_TIME_DIGITS = 11
+PATH_TIE_DIGITS = 4
+PATH_SEGMENT_LENGTH = PATH_TIME_DIGITS + PATH_TIE_DIGITS
+
+# Replies can be nested this many levels below the message starting a thread
+PATH_MAX_DEPTH = 100
+PATH_MAX_LENGTH = PATH_SEGMENT_LENGTH * (PATH_MAX_DEPTH + 1)
+
+
+def path_segment(timestamp, pk):
+    """The fixed-width path segment of a message created at `timestamp`"""
+    epoch = datetime(1970, 1, 1, tzinfo=dt_timezone.utc if timestamp.tzinfo else None)
+    micros = (timestamp - epoch) // timedelta(microseconds=1)
+    tie = pk.int % 36 ** PATH_TIE_DIGITS
+    return int_to_base36(micros).zfill(PATH_TIME_DIGITS) + int_to_base36(tie).zfill(PATH_TIE_DIGITS)
+
+
+def get_thread_limits(max_depth=None, max_replies=None):
+    """Fill in the limits the caller didn't pass from settings"""
+    if max_depth is None:
+        max_depth = getattr(settings, 'MESSAGING_THREAD_MAX_DEPTH', DEFAULT_MAX_DEPTH)
+    if max_replies is None:
+        max_replies = getattr(settings, 'MESSAGING_THREAD_MAX_REPLIES', DEFAULT_MAX_REPLIES)
+    return max_depth, max_replies
+
+
+class ReplyTree:
+    """
+    The replies under `root`. Each reply gets a `children` list (oldest
+    first) and its `tree_depth` below `root`; the stored `depth` counts
+    from the thread's first message instead. Iterating yields the replies
+    depth-first, every reply followed by its own replies.
+    `truncated` is set when the thread was cut at max_replies.
+    """
+
+    def __init__(self, root, replies, truncated=False):
+        self.root = root
+        self.replies = replies
+        self.truncated = truncated
+
+    def __iter__(self):
+        stack = list(reversed(self.replies))
+        while stack:
+            reply = stack.pop()
+            yield reply
+            stack.extend(reversed(reply.children))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def build_reply_tree(root, replies, truncated=False):
+    """
+    Link `replies`, ordered oldest first, under their parents. Replies
+    whose parent isn't among them (cut off by a limit) are left out.
+    """
+    children = {root.pk: []}
+    for reply in replies:
+        if reply.pk == root.pk:
+            # Only a parent_message cycle can lead back to the root
+            continue
+        reply.children = children.setdefault(reply.pk, [])
+        children.setdefault(reply.parent_message_id, []).append(reply)
+
+    # Depths are assigned walking down from the root, which also skips
+    # replies that aren't connected to it
+    root.tree_depth = 0
+    stack = [root]
+    while stack:
+        parent = stack.pop()
+        for reply in children[parent.pk]:
+            reply.tree_depth = parent.tree_depth + 1
+            stack.append(reply)
+    return ReplyTree(root, children[root.pk], truncated)
@@ -24,20 +24,16 @@ def delete_user(request):
 def conversation_view(request, user_id):
     """
     Fetch all messages between the logged-in user and another user,
-    with threaded replies. Optimized with select_related, prefetch_related, and .only().
+    with threaded replies. One query returns them already in reply order;
+    each message's depth gives its indentation.
     """
     other_user = get_object_or_404(User, pk=user_id)
 
     messages = (
-        Message.objects.filter(
-            sender=request.user, receiver=other_user
-        ) | Message.objects.filter(
-            sender=other_user, receiver=request.user
-        )
-    ).select_related("sender", "receiver", "parent_message") \
-     .prefetch_related("replies__sender") \
-     .only("id", "sender", "receiver", "content", "timestamp", "parent_message") \
-     .order_by("timestamp")
+        Message.objects.conversation(request.user, other_user)
+        .select_related("sender", "receiver")
+        .only("id", "sender", "receiver", "content", "timestamp", "parent_message", "depth")
+    )
 
     return render(request, "messaging/conversation.html", {
         "messages": messages,